@@ -46,7 +46,8 @@ setup(
     packages=find_packages(exclude=['ez_setup']),
     test_suite='nose.collector',
     tests_require=[
-        'WebTest >= 1.2', 'BeautifulSoup < 4.0', 'pytidylib', 'poster', 'nose'],
+        'WebTest >= 1.2', 'BeautifulSoup < 4.0', 'pytidylib', 'poster', 'nose',
+        'mock', 'mongomock'],
     message_extractors={
         'vulcanforge': [
             ('**.py', 'python', None),
@@ -60,6 +61,8 @@ setup(
     add_repo_visualizer_hook = vulcanrepo.command:AddRepoVisualizerHook
     clear_repo_caches = vulcanrepo.command:ClearRepoCaches
     ensure_repo_hooks = vulcanrepo.command:EnsureDefaultRepoHooks
+    repo_benchmark = vulcanrepo.command:RepoBenchmark
+    send_repo_digests = vulcanrepo.command:SendRepoDigests
 
     """,
     zip_safe=False
@@ -2,55 +2,155 @@ import re
 import logging
 
 import bson
+import tg
+from paste.deploy.converters import asint
 from pylons import app_globals as g, tmpl_context as c
 from vulcanforge.artifact.api import ArtifactAPI
 from vulcanforge.artifact.model import Shortlink
+from vulcanforge.common.util.model import pymongo_db_collection
 from vulcanforge.project.model import Project
 
+from vulcanrepo.base.model import CommitIndex
+
 LOG = logging.getLogger(__name__)
 
 REPO_INDEX_ID_RE = re.compile(r'^Repo\.')
+SVN_REV_RE = re.compile(r'^r(?P<num>\d+)$')
+
+
+class RepoArtifactResolver(object):
+    """Resolves repo index ids and shortlinks to RepositoryFile and
+    RepositoryFolder objects.
+
+    Index ids are grouped by app config so that the app context is pushed
+    and the repository loaded once per group, and each commit is looked up
+    once. Index ids refer to a full commit id, so whether a path exists at a
+    commit (and whether it is a file or folder) never changes; that is cached
+    (for `scm.artifact.path_cache_ttl` seconds, a day by default) to skip
+    verifying the path against the repository next time.
+
+    """
+    PATH_CACHE_NAME = '{app_config_id}.{object_id}.paths'
+
+    def __init__(self):
+        self.commits = {}
+
+    def get_commit(self, repo, rev):
+        key = (repo._id, rev)
+        if key not in self.commits:
+            self.commits[key] = repo.commit(rev)
+        return self.commits[key]
+
+    def _path_cache_name(self, repo, ci):
+        return self.PATH_CACHE_NAME.format(
+            app_config_id=repo.app_config_id, object_id=ci.object_id)
+
+    def get_path(self, repo, rev, path):
+        ci = self.get_commit(repo, rev)
+        if ci is None:
+            return None
+        if not g.cache or rev != ci.object_id:
+            return ci.get_path(path)
+        cache_name = self._path_cache_name(repo, ci)
+        kind = g.cache.hget(cache_name, path)
+        if kind == '':
+            return None
+        elif kind is not None:
+            artifact = ci.get_path(path, verify=False)
+            if kind == 'Folder' and artifact.kind != 'Folder':
+                artifact = artifact.folder_cls(ci, path)
+            return artifact
+        artifact = ci.get_path(path)
+        g.cache.hset(cache_name, path, artifact.kind if artifact else '')
+        g.cache.redis.expire(cache_name, asint(
+            tg.config.get('scm.artifact.path_cache_ttl', 86400)))
+        return artifact
+
+    def resolve_index_ids(self, index_ids):
+        """Get the artifacts for many repo index ids.
+
+        :return: dict of index_id: artifact (or None)
+
+        """
+        result = dict.fromkeys(index_ids)
+        groups = {}
+        for index_id in index_ids:
+            try:
+                _, ac_id, ci_oid, path = index_id.split('.', 3)
+                ac_id = bson.ObjectId(ac_id)
+            except (ValueError, bson.errors.InvalidId):
+                LOG.warn('Invalid repo index_id {}'.format(index_id))
+                continue
+            groups.setdefault(ac_id, []).append((index_id, ci_oid, path))
+        for ac_id, entries in groups.iteritems():
+            try:
+                with g.context_manager.push(app_config_id=ac_id):
+                    repo = c.app.repo
+                    for index_id, ci_oid, path in entries:
+                        try:
+                            result[index_id] = self.get_path(
+                                repo, ci_oid, path)
+                        except Exception:
+                            LOG.warn('Error looking up repo index_id %s',
+                                     index_id)
+            except Exception:
+                LOG.warn('Error looking up repo index_ids {}'.format(
+                    [entry[0] for entry in entries]))
+        return result
+
+    def find_commit_app_configs(self, project, ci_oid):
+        """App configs of the repositories in project with a commit that
+        matches the shorthand commit id ci_oid, found through the commit
+        index (or the svn commits, for revision numbers) rather than by
+        asking each repository.
+
+        """
+        from vulcanrepo.svn.model import SVNCommit
+        tool_acs = {}
+        for ac in project.app_configs:
+            tool_acs.setdefault(ac.tool_name.lower(), []).append(ac._id)
+        svn_match = SVN_REV_RE.match(ci_oid)
+        if svn_match:
+            if not tool_acs.get('svn'):
+                return []
+            db, coll = pymongo_db_collection(SVNCommit)
+            ac_ids = set(coll.distinct('app_config_id', {
+                'app_config_id': {'$in': tool_acs['svn']},
+                'commit_num': int(svn_match.group('num'))
+            }))
+        else:
+            if not tool_acs.get('git'):
+                return []
+            ac_ids = set(entry.app_config_id for entry in CommitIndex.find(
+                ci_oid, app_config_ids=tool_acs['git']))
+        return [ac for ac in project.app_configs if ac._id in ac_ids]
+
+    def resolve_shortlink(self, parsed_link, match):
+        artifact = None
+        ci_oid, path = match.group('commit'), match.group('path')
+        project = Project.by_shortname(parsed_link['project'])
+        if project:
+            if parsed_link['app']:
+                app_configs = [parsed_link['app']]
+            else:
+                app_configs = self.find_commit_app_configs(project, ci_oid)
+            for ac in app_configs:
+                app = project.app_instance(ac)
+                if app and hasattr(app, 'repo'):
+                    artifact = self.get_path(app.repo, ci_oid, path)
+                    if artifact:
+                        break
+        return artifact
 
 
 def repo_get_by_index_id(index_id, match=None):
-    artifact = None
-    try:
-        _, ac_id, ci_oid, path = index_id.split('.', 3)
-        with g.context_manager.push(app_config_id=bson.ObjectId(ac_id)):
-            ci = c.app.repo.commit(ci_oid)
-            if ci:
-                artifact = ci.get_path(path)
-    except Exception:
-        LOG.warn('Error looking up repo? index_id {}'.format(index_id))
-    return artifact
+    return RepoArtifactResolver().resolve_index_ids([index_id])[index_id]
 
 REPO_SHORTLINK_RE = re.compile(r'^\((?P<commit>[a-z0-9]+)\)(?P<path>/.*)')
 
 
-def _get_by_slink_with_context(repo, ci_oid, path):
-    ci = repo.commit(ci_oid)
-    if ci:
-        return ci.get_path(path)
-
-
 def repo_get_by_shortlink(parsed_link, match):
-    artifact = None
-    ci_oid, path = match.group('commit'), match.group('path')
-    project = Project.by_shortname(parsed_link['project'])
-    if project:
-        if parsed_link['app']:
-            app = project.app_instance(parsed_link['app'])
-            if app and hasattr(app, 'repo'):
-                artifact = _get_by_slink_with_context(app.repo, ci_oid, path)
-        else:
-            for ac in project.app_configs:
-                app = project.app_instance(ac)
-                if hasattr(app, 'repo'):
-                    artifact = _get_by_slink_with_context(
-                        app.repo, ci_oid, path)
-                    if artifact:
-                        break
-    return artifact
+    return RepoArtifactResolver().resolve_shortlink(parsed_link, match)
 
 
 def repo_ref_id_by_link(parsed_link, match, upsert=True):
@@ -80,3 +180,11 @@ REPO_SHORTLINK.update({
 class RepoArtifactAPI(ArtifactAPI):
     INDEX_ID_EPHEMERALS = REPO_INDEX_ID
     SHORTLINK_EPHERMERALS = REPO_SHORTLINK
+
+    def get_repo_artifacts_by_index_ids(self, index_ids):
+        """Resolve many repo index ids at once (see RepoArtifactResolver)
+
+        :return: dict of index_id: artifact (or None)
+
+        """
+        return RepoArtifactResolver().resolve_index_ids(index_ids)
@@ -183,7 +183,7 @@ class RepositoryApp(Application):
     @exceptionless([], log)
     def sidebar_menu(self):
         if not self.repo or self.repo.status != 'ready':
-            return [SitemapEntry(self.repo.status)]
+            return [SitemapEntry(self.repo.status_label)]
         links = [
             SitemapEntry('Stats',
                          url=self.url + 'stats',
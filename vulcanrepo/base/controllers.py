@@ -37,8 +37,9 @@ from vulcanforge.discussion.controllers import AppDiscussionController
 import vulcanforge.discussion.widgets
 from vulcanforge.project.model import Project
 from vulcanforge.stats import STATS_CACHE_TIMEOUT
-from vulcanrepo import tasks as repo_tasks
+from vulcanrepo import instrument, profiler, tasks as repo_tasks
 from vulcanrepo.stats import CommitAggregator, CommitQuerySchema
+from . import last_commits
 from .model import Commit
 from .widgets import (
     SCMLogWidget,
@@ -53,16 +54,15 @@ TEMPLATE_DIR = 'jinja:vulcanrepo.base:templates/'
 
 
 # Methods for retrieving repo artifacts from the request
-def get_commit(rev, args, depth=10):
+def get_commit(rev, args):
+    rev, args = c.app.repo.split_ref(rev, args)
     try:
         commit = c.app.repo.commit(rev)
     except:
         commit = None
-        
+
     if not commit:
-        if not args or not depth:
-            raise exc.HTTPNotFound()
-        return get_commit('{}/{}'.format(rev, args[0]), args[1:], depth - 1)
+        raise exc.HTTPNotFound()
     return commit, rev, args
 
 
@@ -111,9 +111,11 @@ class RepoStatsController(BaseController):
     @cache_rendered(timeout=STATS_CACHE_TIMEOUT)
     @validate(CommitQuerySchema())
     def commit_aggregate(self, date_start=None, date_end=None, bins=None,
-                         order=None, label=None, user=None):
+                         order=None, label=None, user=None, sums=None):
         if bins is None:
             bins = ['daily']
+        if sums and not set(sums) <= set(CommitAggregator.SUM_FIELDS):
+            raise exc.HTTPBadRequest('Unknown sums {}'.format(sums))
         agg = CommitAggregator(
             date_start=date_start,
             date_end=date_end,
@@ -121,7 +123,8 @@ class RepoStatsController(BaseController):
             repo=c.app.repo,
             order=order,
             label=label,
-            user=user
+            user=user,
+            sums=sums
         )
         agg.run()
         return agg.fix_results()
@@ -156,6 +159,7 @@ class BaseRepositoryController(BaseController):
 
     @expose(TEMPLATE_DIR + 'tree.html')
     @expose('json', render_params={"sanitize": False})
+    @profiler.profiled()
     def folder(self, rev, *args, **kw):
         """Render the contents of a given folder within the file browser"""
 
@@ -175,10 +179,13 @@ class BaseRepositoryController(BaseController):
         else:
             data = {}
 
+        instrument.incr('cache.tree_json.{}'.format('hit' if data else 'miss'))
         if data:
+            commits = last_commits.load_commits(c.folder)
             for path, entry in data.iteritems():
-                if 'commit' in entry.get('extra', {}):
-                    entry['extra']['commit'] = Markup(entry['extra']['commit'])
+                extra = entry.get('extra', {})
+                if extra.get('commit_id') in commits:
+                    extra['commit'] = Markup(commits[extra['commit_id']])
         else:
             for entry in c.folder.ls(include_self=True):
                 entry.setdefault('extra', {})
@@ -208,65 +215,89 @@ class BaseRepositoryController(BaseController):
         return dict(rev=rev, data=JSONSafe(data))
 
     @expose('json', render_params={"sanitize": False})
+    @profiler.profiled()
     def dir_last_commits(self, rev, *args, **kwargs):
         """
         Get last commit data about each file/folder in the given folder.
 
+        Entries reference their last commit by `commit_id`; the rendered
+        commits are returned once each in `commits`.
+
+        If `progressive` is set and many entries are not cached, the cached
+        entries are returned immediately along with the `pending` paths,
+        which are computed by tasks. The client polls until none are
+        pending.
+
         """
         c.commit, c.folder, rev = get_commit_and_obj(rev, *args)
+        progressive = asbool(kwargs.get('progressive'))
+        author_widget = self.Widgets.commit_author_widget
         data = {}
+        commits = {}
 
         # try to load cached data
         paths = None
         cache_result = False
+        resolved, resolved_commits = {}, {}
         if g.cache:
             tree_data = g.cache.hget_json(c.folder.cache_name, 'tree_json')
+            instrument.incr('cache.tree_json.{}'.format(
+                'hit' if tree_data else 'miss'))
             if tree_data:
                 cache_result = True
+                commits = last_commits.load_commits(c.folder)
+                if progressive:
+                    resolved, resolved_commits = last_commits.load_results(
+                        c.folder)
+                    commits.update(resolved_commits)
                 paths = []
                 path_i = len(c.folder.path)
                 for path, info in tree_data.iteritems():
-                    if not info.get('extra', {}).get('commit'):
+                    extra = info.setdefault('extra', {})
+                    if path in resolved:
+                        extra['commit_id'] = resolved[path]
+                    elif 'commit_id' not in extra:
                         paths.append(path[path_i:])
-                    else:
-                        data[path] = {
-                            'extra': {
-                                'commit': Markup(info['extra']['commit'])
-                            }
-                        }
+                        continue
+                    data[path] = {'extra': {'commit_id': extra['commit_id']}}
                 if not paths:  # we have all the info we need
-                    return {'data': data}
-
-        commit_info = c.folder.ls_commits(include_self=True, paths=paths)
-        for path, last_commit in commit_info.iteritems():
-            # commit text
-            commit_text = ''
-            if last_commit['href'] is not None:
-                # generate avatar
-                author_content = self.Widgets.commit_author_widget.display(
-                    last_commit)
-                commit_text = (
-                    u'{0} <a href="{href}">[{shortlink}]</a>{summary}').format(
-                        author_content,
-                        summary=cgi.escape(last_commit['summary']),
-                        shortlink=last_commit['shortlink'],
-                        href=last_commit['href']
-                )
-
-            data[path] = {
-                'extra': {'commit': Markup(commit_text)}
-            }
+                    if resolved:
+                        g.cache.hset_json(
+                            c.folder.cache_name, 'tree_json', tree_data)
+                        last_commits.save_commits(c.folder, commits)
+                        last_commits.clear_results(
+                            c.folder, resolved, resolved_commits)
+                    return last_commits.payload(data, commits)
+                if progressive and \
+                        len(paths) > last_commits.progressive_threshold():
+                    if last_commits.mark_pending(c.folder):
+                        for chunk in last_commits.chunk_paths(paths):
+                            repo_tasks.last_commits.post(
+                                c.commit.url_rev, c.folder.path, chunk)
+                    result = last_commits.payload(data, commits)
+                    result['pending'] = [c.folder.path + p for p in paths]
+                    return result
+
+        entries, new_commits = last_commits.compute_last_commits(
+            c.folder, author_widget, paths=paths)
+        commits.update(new_commits)
+        for path, ci_id in entries.iteritems():
+            data[path] = {'extra': {'commit_id': ci_id}}
             if cache_result:
                 tree_data[path].setdefault('extra', {})
-                tree_data[path]['extra'].setdefault('commit', {})
-                tree_data[path]['extra']['commit'] = commit_text
+                tree_data[path]['extra']['commit_id'] = ci_id
 
         if cache_result:
             g.cache.hset_json(c.folder.cache_name, 'tree_json', tree_data)
+            last_commits.save_commits(c.folder, commits)
+            if resolved:
+                last_commits.clear_results(
+                    c.folder, resolved, resolved_commits)
 
-        return {'data': data}
+        return last_commits.payload(data, commits)
 
     @expose('json')
+    @profiler.profiled()
     def last_commit(self, rev, *args, **kwargs):
         """
         returns {
@@ -299,6 +330,7 @@ class BaseRepositoryController(BaseController):
         return result
 
     @expose(TEMPLATE_DIR + 'file.html')
+    @profiler.profiled()
     def file(self, rev, *args, **kw):
         """Visualize a file within the forge. If the parameter format = raw,
         download the raw file instead.
@@ -386,6 +418,7 @@ class BaseRepositoryController(BaseController):
         return result
 
     @expose(TEMPLATE_DIR + 'log.html')
+    @profiler.profiled()
     def history(self, rev, *args, **kw):
         """Display log starting from given revision"""
         c.commit, rev, _ = get_commit(rev, args)
@@ -412,6 +445,15 @@ class BaseRepositoryController(BaseController):
         result.update(kw)
         return result
 
+    @expose('json')
+    def profile_trace(self, profile_id, **kw):
+        """Full trace of a request profiled with the `_profile` parameter"""
+        g.security.require_access(c.app, 'admin')
+        trace = profiler.load_trace(profile_id)
+        if trace is None:
+            raise exc.HTTPNotFound()
+        return trace
+
     @with_trailing_slash
     @expose(TEMPLATE_DIR + 'fork.html')
     def fork(self, to_name=None, to_label=None, project_name=None):
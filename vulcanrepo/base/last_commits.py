@@ -0,0 +1,166 @@
+"""
+Last commit information for the entries of a folder in the file browser.
+
+Entries reference their last commit by id and each distinct commit is
+rendered once, so that a folder whose entries share a few commits does not
+repeat the same markup. The commit id of each entry is kept in the
+`tree_json` cached for the folder (see `BaseRepositoryController.folder`)
+and the rendered commits in its `commits_json` field.
+
+For large folders the entries are resolved progressively by the
+`last_commits` task, which stores each result in its own field of the folder
+cache hash as it is computed so that concurrent tasks do not overwrite each
+other. The controller folds the results back into `tree_json` once all of
+the entries are resolved. The tasks are queued by the request that sets the
+folder's pending key first (it expires after
+`scm.last_commits.task_timeout` seconds, in case they fail).
+
+"""
+import cgi
+import json
+import time
+
+from markupsafe import Markup
+from paste.deploy.converters import asint
+from pylons import app_globals as g
+import tg
+
+RESULT_PREFIX = 'last_commit.'
+COMMIT_PREFIX = 'last_commit_ci.'
+PENDING_FIELD = 'last_commits_pending'
+COMMITS_FIELD = 'commits_json'
+
+
+def render_last_commit(last_commit, author_content):
+    """Markup summarizing the last commit to touch a file or folder"""
+    return u'{0} <a href="{href}">[{shortlink}]</a>{summary}'.format(
+        author_content,
+        summary=cgi.escape(last_commit['summary']),
+        shortlink=last_commit['shortlink'],
+        href=last_commit['href']
+    )
+
+
+def render_last_commits(commit_infos, author_widget):
+    """Render each distinct commit in commit_infos once, looking up all of
+    the authors together.
+
+    :return: dict of commit id: markup
+
+    """
+    commits = dict((info['id'], info) for info in commit_infos
+                   if info['href'] is not None)
+    authors = author_widget.display_many(commits.values())
+    return dict(
+        (ci_id, render_last_commit(info, authors[ci_id]))
+        for ci_id, info in commits.iteritems())
+
+
+def compute_last_commits(folder, author_widget, paths=None,
+                         include_self=True):
+    """Find the last commit for the given paths (relative to folder) or for
+    all of its entries.
+
+    :return: (entries, commits) where entries is a dict of full path: commit
+        id (or None) and commits a dict of commit id: markup
+
+    """
+    commit_info = folder.ls_commits(include_self=include_self, paths=paths)
+    entries = dict(
+        (path, info['id'] if info['href'] is not None else None)
+        for path, info in commit_info.iteritems())
+    commits = render_last_commits(commit_info.itervalues(), author_widget)
+    return entries, commits
+
+
+def is_cache_field(field):
+    """Whether a field of a folder cache hash is managed here"""
+    return field in (COMMITS_FIELD, PENDING_FIELD) or \
+        field.startswith((RESULT_PREFIX, COMMIT_PREFIX))
+
+
+def load_commits(folder):
+    """Rendered commits referenced by the folder's cached tree_json"""
+    return g.cache.hget_json(folder.cache_name, COMMITS_FIELD) or {}
+
+
+def save_commits(folder, commits):
+    g.cache.hset_json(folder.cache_name, COMMITS_FIELD, commits)
+
+
+def store_results(folder, entries, commits):
+    """Save results of a progressive computation in the folder cache"""
+    fields = {}
+    for path, ci_id in entries.iteritems():
+        fields[RESULT_PREFIX + path] = json.dumps(ci_id)
+    for ci_id, text in commits.iteritems():
+        fields[COMMIT_PREFIX + ci_id] = json.dumps(text)
+    if fields:
+        g.cache.redis.hmset(folder.cache_name, fields)
+
+
+def load_results(folder):
+    """Results of a progressive computation saved so far, as (entries,
+    commits)
+
+    """
+    entries, commits = {}, {}
+    for field, value in g.cache.redis.hgetall(folder.cache_name).iteritems():
+        if field.startswith(RESULT_PREFIX):
+            entries[field[len(RESULT_PREFIX):]] = json.loads(value)
+        elif field.startswith(COMMIT_PREFIX):
+            commits[field[len(COMMIT_PREFIX):]] = json.loads(value)
+    return entries, commits
+
+
+def pending_key(folder):
+    """Key of the lock held while tasks compute the folder's entries"""
+    return '{}.{}'.format(folder.cache_name, PENDING_FIELD)
+
+
+def is_pending_key(key):
+    return key.endswith('.' + PENDING_FIELD)
+
+
+def clear_results(folder, entries, commits):
+    fields = [RESULT_PREFIX + path for path in entries]
+    fields.extend(COMMIT_PREFIX + ci_id for ci_id in commits)
+    g.cache.redis.hdel(folder.cache_name, *fields)
+    g.cache.redis.delete(pending_key(folder))
+
+
+def mark_pending(folder):
+    """Flag that tasks are computing the folder's entries, returning False if
+    they already are (and have not timed out).
+
+    """
+    timeout = asint(tg.config.get('scm.last_commits.task_timeout', 300))
+    return bool(g.cache.redis.set(
+        pending_key(folder), time.time(), nx=True, ex=timeout))
+
+
+def chunk_paths(paths, parallelism=None):
+    """Split paths among at most `parallelism` tasks"""
+    if parallelism is None:
+        parallelism = asint(tg.config.get('scm.last_commits.parallelism', 4))
+    parallelism = max(1, min(parallelism, len(paths)))
+    return [paths[i::parallelism] for i in range(parallelism)]
+
+
+def progressive_threshold():
+    """Folders with fewer unresolved entries are computed inline"""
+    return asint(tg.config.get('scm.last_commits.progressive_threshold', 50))
+
+
+def payload(data, commits):
+    """Response of dir_last_commits: the entries and the commits they
+    reference
+
+    """
+    referenced = set(
+        entry['extra']['commit_id'] for entry in data.itervalues())
+    return {
+        'data': data,
+        'commits': dict((ci_id, Markup(commits[ci_id]))
+                        for ci_id in referenced if ci_id in commits)
+    }
@@ -8,4 +8,9 @@ from .repo import (
     RepoContentRelation,
     RepositoryThread
 )
-from .hook import PostCommitHook
\ No newline at end of file
+from .hook import PostCommitHook
+from .rollup import CommitRollup
+from .commit_index import CommitIndex
+from .fork import CommitCopier
+from .digest import CommitDigest
+from .content_loader import RepoContentLoader
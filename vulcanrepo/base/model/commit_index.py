@@ -0,0 +1,144 @@
+"""
+Index of the repositories that contain each commit.
+
+Commits are stored per repository (forks hold their own copies), so finding
+which repositories own a commit id would otherwise mean asking each of the
+commit collections or each repository. CommitIndex holds one small document
+per (commit id, repository), maintained by `Repository.refresh`, so that the
+owners of a full or abbreviated commit id are found with a single indexed
+read.
+
+Documents carry the first `PREFIX_LENGTH` characters of the commit id in
+`prefix`, which makes a suitable shard key: prefix lookups go to a single
+shard and commits spread evenly across them. Svn commit ids
+(`<repository id>:<revision>`) all start alike, so their prefix is taken
+from a hash of the id instead; they are only ever looked up in full.
+
+"""
+import hashlib
+import re
+
+from ming import schema as S
+from ming.odm import FieldProperty
+from ming.odm.declarative import MappedClass
+from pymongo import UpdateOne
+from vulcanforge.common.model.session import repository_orm_session
+from vulcanforge.common.util.model import pymongo_db_collection
+
+PREFIX_LENGTH = 4
+
+
+def prefix_of(oid):
+    """Shard key of the entries of the commit id oid"""
+    if ':' in oid:  # svn
+        return hashlib.md5(oid).hexdigest()[:PREFIX_LENGTH]
+    return oid[:PREFIX_LENGTH]
+
+
+class CommitIndex(MappedClass):
+    """A repository containing a commit"""
+
+    class __mongometa__:
+        session = repository_orm_session
+        name = 'repo_commit_index'
+        unique_indexes = [('prefix', 'object_id', 'repository_id')]
+        indexes = [('repository_id',)]
+
+    _id = FieldProperty(S.ObjectId)
+    prefix = FieldProperty(str)
+    object_id = FieldProperty(str)
+    repository_id = FieldProperty(S.ObjectId)
+    app_config_id = FieldProperty(S.ObjectId)
+    # tool name of the repository (Git, SVN)
+    tool = FieldProperty(str)
+
+    @classmethod
+    def add(cls, repo, object_ids, batch_size=1000):
+        """Record that repo contains the given commits, returning their
+        number
+
+        """
+        db, coll = pymongo_db_collection(cls)
+        requests = []
+        count = 0
+        for oid in object_ids:
+            count += 1
+            requests.append(UpdateOne({
+                'prefix': prefix_of(oid),
+                'object_id': oid,
+                'repository_id': repo._id
+            }, {
+                '$setOnInsert': {
+                    'app_config_id': repo.app_config_id,
+                    'tool': repo.tool_name
+                }
+            }, upsert=True))
+            if len(requests) >= batch_size:
+                coll.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            coll.bulk_write(requests, ordered=False)
+        return count
+
+    @classmethod
+    def add_all(cls, repo, batch_size=1000):
+        """Record that repo contains every commit stored for it, streaming
+        their ids, and return their number
+
+        """
+        db, commits = pymongo_db_collection(repo.commit_cls)
+        cursor = commits.find(
+            {'repository_id': repo._id}, {'_id': 0, 'object_id': 1}
+        ).batch_size(batch_size)
+        return cls.add(
+            repo, (doc['object_id'] for doc in cursor), batch_size)
+
+    @classmethod
+    def remove_repo(cls, repo):
+        cls.query.remove({'repository_id': repo._id})
+
+    @classmethod
+    def lookup_query(cls, oid, app_config_ids=None, repository_ids=None):
+        """Query for the entries of the commits whose id is or starts with
+        oid, optionally limited to the given apps or repositories.
+
+        """
+        if ':' in oid:
+            query = {'prefix': prefix_of(oid), 'object_id': oid}
+        elif len(oid) < PREFIX_LENGTH:
+            query = {'prefix': {'$regex': '^' + re.escape(oid)}}
+        else:
+            query = {'prefix': oid[:PREFIX_LENGTH]}
+            if len(oid) > PREFIX_LENGTH:
+                query['object_id'] = {'$regex': '^' + re.escape(oid)}
+        if app_config_ids is not None:
+            query['app_config_id'] = {'$in': list(app_config_ids)}
+        if repository_ids is not None:
+            query['repository_id'] = {'$in': list(repository_ids)}
+        return query
+
+    @classmethod
+    def find(cls, oid, app_config_ids=None, repository_ids=None):
+        """Entries of the commits whose id is or starts with oid"""
+        return cls.query.find(
+            cls.lookup_query(oid, app_config_ids, repository_ids))
+
+    @classmethod
+    def resolve(cls, oid, repository_id):
+        """The full id of the commit of the repository identified by the
+        abbreviated id oid, or None if there is no such commit or oid is
+        ambiguous.
+
+        """
+        entries = cls.find(oid, repository_ids=[repository_id]).limit(2).all()
+        if len(entries) == 1:
+            return entries[0].object_id
+
+    @classmethod
+    def contains(cls, oid, repository_id):
+        """Whether the repository contains the commit with the full id oid"""
+        return cls.query.find({
+            'prefix': prefix_of(oid),
+            'object_id': oid,
+            'repository_id': repository_id
+        }).count() > 0
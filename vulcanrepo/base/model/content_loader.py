@@ -0,0 +1,123 @@
+"""
+Batch dereferencing of repository content specs (see RepoBaseSpec and
+RepoContentRelation).
+
+Dereferencing a spec instantiates the app of its app config to get at the
+repository, looks up the commit and verifies the path exists in it. A
+`RepoContentLoader` does this for many specs at once: the app configs (and
+their projects) are loaded with a query each, every repository is
+instantiated once and every (app config, rev) commit is looked up once. The
+content objects returned are lazy, only verifying the path when first used.
+
+"""
+from ming.odm import mapper, state
+from pylons import tmpl_context as c
+from vulcanforge.project.model import AppConfig, Project
+
+_UNRESOLVED = object()
+
+
+class LazyRepoContent(object):
+    """Stands in for the file or folder at path in commit, which is only
+    looked up (and verified to exist) the first time it is used
+
+    """
+
+    def __init__(self, commit, path):
+        self._commit = commit
+        self._path = path
+        self._content = _UNRESOLVED
+
+    def _resolve(self):
+        if self._content is _UNRESOLVED:
+            self._content = self._commit.get_path(self._path)
+        return self._content
+
+    def __nonzero__(self):
+        return self._resolve() is not None
+
+    def __getattr__(self, name):
+        content = self._resolve()
+        if content is None:
+            raise AttributeError('{} does not exist at {}'.format(
+                self._path, self._commit.object_id))
+        return getattr(content, name)
+
+    def __repr__(self):
+        return '<LazyRepoContent {}@{}>'.format(
+            self._path, self._commit.object_id)
+
+
+class RepoContentLoader(object):
+    """Dereferences repository content specs, sharing the repositories and
+    commits among them
+
+    """
+
+    def __init__(self):
+        self.repos = {}
+        self.commits = {}
+
+    def load_repos(self, app_config_ids):
+        """Instantiate the repositories of app_config_ids not loaded yet"""
+        missing = set(app_config_ids).difference(self.repos)
+        if not missing:
+            return
+        app = getattr(c, 'app', None)
+        if app and app.config._id in missing:
+            self.repos[app.config._id] = getattr(app, 'repo', None)
+            missing.discard(app.config._id)
+        app_configs = AppConfig.query.find({'_id': {'$in': list(missing)}})
+        app_configs = app_configs.all()
+        projects = dict((p._id, p) for p in Project.query.find({
+            '_id': {'$in': list(set(ac.project_id for ac in app_configs))}
+        }))
+        for ac in app_configs:
+            project = projects.get(ac.project_id)
+            if project is None:
+                continue
+            App = ac.load()
+            self.repos[ac._id] = getattr(App(project, ac), 'repo', None)
+        for ac_id in missing:
+            self.repos.setdefault(ac_id, None)
+
+    def get_commit(self, app_config_id, rev):
+        key = (app_config_id, rev)
+        if key not in self.commits:
+            self.load_repos([app_config_id])
+            repo = self.repos[app_config_id]
+            self.commits[key] = repo.commit(rev) if repo else None
+        return self.commits[key]
+
+    def load(self, specs, lazy=True):
+        """Get the content objects for specs, in order. Objects are None
+        when the app or commit does not exist; missing paths are found when
+        a lazy object is used (or right away when lazy is False).
+
+        """
+        self.load_repos(spec.app_config_id for spec in specs)
+        result = []
+        for spec in specs:
+            ci = self.get_commit(spec.app_config_id, spec.rev)
+            if ci is None:
+                result.append(None)
+            elif lazy:
+                result.append(LazyRepoContent(ci, spec.path))
+            else:
+                result.append(ci.get_path(spec.path))
+        return result
+
+    def prefetch(self, instances, name='blob', lazy=True):
+        """Dereference the RepoContentRelation called name of instances
+        (of a single class) at once, so that accessing it does not load
+        anything else
+
+        """
+        if not instances:
+            return
+        cls = instances[0].__class__
+        relation = mapper(cls).get_property(name)
+        spec_prop = relation.get_spec_property()
+        specs = [spec_prop.__get__(instance, cls) for instance in instances]
+        for instance, obj in zip(instances, self.load(specs, lazy=lazy)):
+            state(instance).extra_state[relation] = obj
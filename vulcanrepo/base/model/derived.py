@@ -1,30 +1,43 @@
 from datetime import datetime
+import heapq
 import logging
 import re
 import json
 import urllib
 
 import ming.schema
+import tg
 from ming.odm import (
     FieldProperty,
     ForeignIdProperty,
-    session
+    session,
+    state
 )
 from ming.utils import LazyProperty
+from paste.deploy.converters import asint
 from pylons import tmpl_context as c, app_globals as g
+from pymongo import DeleteMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from vulcanforge.artifact.model import Artifact, ArtifactReference, Shortlink
 from vulcanforge.auth.model import User
 from vulcanforge.common.model.base import BaseMappedClass
-from vulcanrepo.base.model import RepoVersionSpec, RepoContentRelation
+from vulcanrepo.base.model import (
+    RepoVersionSpec,
+    RepoContentRelation,
+    RepoContentLoader
+)
+from vulcanrepo.base.model.fork import DUPLICATE_KEY
 from vulcanforge.common.exceptions import NoSuchAppError
 from vulcanforge.common.model.session import (
     main_orm_session,
     repository_orm_session
 )
 from vulcanforge.common.util import push_config
+from vulcanforge.common.util.model import pymongo_db_collection
 from vulcanforge.common.util.json_util import strict_load
 from vulcanforge.neighborhood.model import Neighborhood
 from vulcanforge.project.model import AppConfig, Project
+from vulcanrepo.tasks import post_process_derived
 
 LOG = logging.getLogger(__name__)
 BLOB_URL_RE = re.compile(r'''
@@ -55,6 +68,8 @@ class RepoDerivedObject(BaseMappedClass):
             ('blob_spec.app_config_id', 'blob_spec.path',
              'blob_spec.version_id')
         ]
+        # one object per file (see DerivedObjectSynchronizer)
+        unique_indexes = [('blob_spec.app_config_id', 'blob_spec.path')]
 
     _id = FieldProperty(ming.schema.ObjectId)
     project_id = ForeignIdProperty(
@@ -76,12 +91,12 @@ class RepoDerivedObject(BaseMappedClass):
     author_ids = FieldProperty([ming.schema.ObjectId], if_missing=[])
     mod_date = FieldProperty(datetime, if_missing=datetime.utcnow)
 
-    def __json__(self):
+    def __json__(self, app_url=None):
         return {
             'id': self._id,
             'title': self.blob_spec.path,
             'display_name': self.display_name,
-            'file_url': self.get_blob_url(),
+            'file_url': self.get_blob_url(app_url=app_url),
             'file_path': self.blob_spec.path,
             'version': self.version
         }
@@ -168,7 +183,12 @@ class RepoDerivedObject(BaseMappedClass):
         author = blob.commit.user
         if author and author._id not in new.author_ids:
             new.author_ids.append(author._id)
-        session(cls).flush(new)
+        try:
+            session(cls).flush(new)
+        except DuplicateKeyError:
+            # created concurrently, bring that one up to date instead
+            session(cls).expunge(new)
+            return cls.from_blob(blob, process=process, **kw)
 
         LOG.debug('postprocess %s? %s', blob.url(), process)
         if process:
@@ -176,6 +196,26 @@ class RepoDerivedObject(BaseMappedClass):
 
         return new
 
+    @classmethod
+    def load_blobs(cls, objects, lazy=True, loader=None):
+        """Dereference the blobs of many objects at once (see
+        RepoContentLoader)
+
+        """
+        if loader is None:
+            loader = RepoContentLoader()
+        loader.prefetch(objects, 'blob', lazy=lazy)
+        return objects
+
+    @classmethod
+    def sync_from_commits(cls, repo, commits, match, process=True, **kw):
+        """Upserts the derived objects of the files matching match changed by
+        commits, in bulk (see DerivedObjectSynchronizer)
+
+        """
+        return DerivedObjectSynchronizer(cls, repo, match, process).sync(
+            commits, **kw)
+
     @LazyProperty
     def neighborhood(self):
         return Neighborhood.query.get(_id=self.neighborhood_id)
@@ -214,13 +254,17 @@ class RepoDerivedObject(BaseMappedClass):
         """For markdown embeds and displaying artifact links"""
         return '{path}_{_id}'.format(path=self.path, _id=self._id)
 
-    def get_blob_url(self):
+    def get_blob_url(self, app_url=None):
         """Get url for underlying repository file. Faster than calling
         self.blob.url() because it makes no calls to the underlying repository
 
+        :param app_url: url of the app config, if already known
+
         """
-        if self.app_config:
-            return self.app_config.url() + \
+        if app_url is None and self.app_config:
+            app_url = self.app_config.url()
+        if app_url:
+            return app_url + \
                    'file/' + \
                    self.blob_spec.rev.split(':')[-1] + \
                    self.blob_spec.path
@@ -280,6 +324,305 @@ class RepoDerivedObject(BaseMappedClass):
         return loader(self.blob.open())
 
 
+class DerivedObjectSynchronizer(object):
+    """Brings the derived objects of a repository up to date with a range of
+    commits, as `from_blob` would for each file, in a few bulk operations.
+
+    The change set of the commits is reduced to the newest version of each
+    matching file and the paths removed, from the paths in their diffs. The
+    existing objects for those paths are loaded with a single query, the
+    upserts, version increments, moves and deletions are computed in memory
+    and everything is written with one bulk write.
+    `post_process` is then run on the new and changed objects by at most
+    `scm.derived.post_process_concurrency` tasks (0 runs it inline).
+
+    :param cls: RepoDerivedObject subclass
+    :param repo: Repository the commits belong to
+    :param match: callable(path) selecting the files cls derives from
+
+    """
+
+    def __init__(self, cls, repo, match, process=True, concurrency=None):
+        self.cls = cls
+        self.repo = repo
+        self.match = match
+        self.process = process
+        if concurrency is None:
+            concurrency = asint(tg.config.get(
+                'scm.derived.post_process_concurrency', 4))
+        self.concurrency = concurrency
+
+    @staticmethod
+    def oldest_first(commits):
+        """Order commits from oldest to newest: by revision number (svn), or
+        with each commit after its parents among commits, the older
+        committed first when they are unrelated (git)
+
+        """
+        commits = list(commits)
+        if all(getattr(ci, 'commit_num', None) is not None
+               for ci in commits):
+            return sorted(commits, key=lambda ci: ci.commit_num)
+        by_id = dict((ci.object_id, ci) for ci in commits)
+        waiting = dict((ci.object_id, 0) for ci in commits)
+        children = {}
+        for ci in commits:
+            for parent_id in set(ci.parent_ids or []):
+                if parent_id in by_id:
+                    waiting[ci.object_id] += 1
+                    children.setdefault(parent_id, []).append(ci)
+        ready = [(ci.committed.date, ci.object_id) for ci in commits
+                 if not waiting[ci.object_id]]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            ci = by_id[heapq.heappop(ready)[1]]
+            ordered.append(ci)
+            for child in children.get(ci.object_id, []):
+                waiting[child.object_id] -= 1
+                if not waiting[child.object_id]:
+                    heapq.heappush(
+                        ready, (child.committed.date, child.object_id))
+        return ordered
+
+    def changes(self, commits):
+        """Reduce the diffs of commits (in any order) to the newest blob of
+        each matching file and the paths and folders removed. Only the
+        paths are compared: file objects are created for the matching
+        files alone, without verifying them.
+
+        Files copied (or renamed) from a tracked file, and the tracked files
+        in copied folders, are mapped to the path they were copied from, so
+        that the objects of moved files can follow them.
+
+        :return: ({path: blob}, {path: copied from path},
+            set of removed paths, set of removed folders)
+
+        """
+        blobs, sources, removed, removed_folders = {}, {}, set(), set()
+        commits = self.oldest_first(commits)
+
+        def add(commit, path, source=None):
+            blobs[path] = commit.get_path(path, verify=False)
+            removed.discard(path)
+            if source:
+                sources[path] = sources.get(source, source)
+            else:
+                sources.pop(path, None)
+
+        def remove(path):
+            if path.endswith('/'):
+                removed_folders.add(path)
+                for blob_path in blobs.keys():
+                    if blob_path.startswith(path):
+                        del blobs[blob_path]
+            elif self.match(path):
+                removed.add(path)
+                blobs.pop(path, None)
+
+        for commit in commits:
+            diffs = commit.diffs
+            for copied in diffs.copied:
+                old, new = copied['old'], copied['new']
+                if new.endswith('/'):
+                    for path in self._tracked_under(
+                            old, blobs, removed, removed_folders):
+                        add(commit, new + path[len(old):], path)
+                elif self.match(new):
+                    add(commit, new, old if self.match(old) else None)
+                # renames are not listed as removed (git)
+                if not old.endswith('/') and self.match(old) and \
+                        old not in diffs.removed and \
+                        commit.get_path(old) is None:
+                    remove(old)
+            for path in diffs.removed:
+                remove(path)
+            for path in diffs.added + diffs.changed:
+                if not path.endswith('/') and self.match(path):
+                    add(commit, path)
+        return blobs, sources, removed, removed_folders
+
+    def _tracked_under(self, folder, blobs, removed, removed_folders):
+        """Paths of the tracked files in folder, stored or pending"""
+        db, coll = pymongo_db_collection(self.cls)
+        paths = set(coll.distinct('blob_spec.path', {
+            'blob_spec.app_config_id': self.repo.app_config_id,
+            'blob_spec.path': {'$regex': '^' + re.escape(folder)}
+        }))
+        paths = set(
+            path for path in paths if path not in removed and
+            not any(path.startswith(f) for f in removed_folders))
+        paths.update(path for path in blobs if path.startswith(folder))
+        return sorted(paths)
+
+    def _existing(self, paths):
+        existing = {}
+        cursor = self.cls.query.find({
+            'blob_spec.app_config_id': self.repo.app_config_id,
+            'blob_spec.path': {'$in': list(paths)}
+        })
+        for obj in cursor:
+            existing[obj.blob_spec.path] = obj
+            # written around the session below
+            session(self.cls).expunge(obj)
+        return existing
+
+    def _new_doc(self, blob, kw):
+        obj = self.cls(**kw)
+        obj.blob = blob
+        author = blob.commit.user
+        if author:
+            obj.author_ids.append(author._id)
+        doc = dict(state(obj).document)
+        session(self.cls).expunge(obj)
+        return doc
+
+    @staticmethod
+    def _insert_op(doc):
+        """Insert doc unless the path has an object already"""
+        return UpdateOne({
+            'blob_spec.app_config_id': doc['blob_spec']['app_config_id'],
+            'blob_spec.path': doc['blob_spec']['path']
+        }, {'$setOnInsert': doc}, upsert=True)
+
+    def _increment_op(self, old, blob, kw):
+        fields = dict(kw, blob_spec=RepoVersionSpec.value_from_obj(blob))
+        fields.setdefault('mod_date', blob.commit.committed.date)
+        update = {'$set': fields, '$inc': {'version': 1}}
+        author = blob.commit.user
+        if author:
+            update['$addToSet'] = {'author_ids': author._id}
+        return UpdateOne({'_id': old._id}, update)
+
+    def _remove_op(self, removed, removed_folders, keep, moved_ids):
+        clauses = []
+        if removed:
+            clauses.append({'blob_spec.path': {'$in': list(removed)}})
+        for folder in removed_folders:
+            clauses.append({'blob_spec.path': {
+                '$regex': '^' + re.escape(folder)}})
+        if not clauses:
+            return None
+        query = {
+            'blob_spec.app_config_id': self.repo.app_config_id,
+            '$or': clauses,
+            'blob_spec.path': {'$nin': list(keep)}
+        }
+        if moved_ids:
+            query['_id'] = {'$nin': moved_ids}
+        return DeleteMany(query)
+
+    @staticmethod
+    def _is_removed(path, removed, removed_folders):
+        return path in removed or \
+            any(path.startswith(folder) for folder in removed_folders)
+
+    def sync(self, commits, **kw):
+        """Upsert the objects for the files changed by commits and delete
+        those of the files removed
+
+        :param kw: fields set on the new and changed objects
+        :return: ids of the new and changed objects
+
+        """
+        blobs, sources, removed, removed_folders = self.changes(commits)
+        paths = set(blobs).union(sources.values())
+        existing = self._existing(paths) if paths else {}
+        ops, changed_ids, moved_ids = [], [], []
+        for path, blob in sorted(blobs.iteritems()):
+            old = existing.get(path)
+            source_path = sources.get(path)
+            source = existing.get(source_path)
+            if old is None and source is not None and \
+                    source._id not in moved_ids and \
+                    source_path not in blobs and \
+                    self._is_removed(source_path, removed, removed_folders):
+                # moved: point the object of the source at the new path
+                ops.append(self._increment_op(source, blob, kw))
+                changed_ids.append(source._id)
+                moved_ids.append(source._id)
+            elif old is None:
+                doc = self._new_doc(blob, kw)
+                ops.append(self._insert_op(doc))
+                changed_ids.append(doc['_id'])
+            elif old.blob_spec.version_id != blob.version_id:
+                ops.append(self._increment_op(old, blob, kw))
+                changed_ids.append(old._id)
+        remove_op = self._remove_op(
+            removed, removed_folders, blobs, moved_ids)
+        if remove_op is not None:
+            ops.append(remove_op)
+        if ops:
+            db, coll = pymongo_db_collection(self.cls)
+            try:
+                coll.bulk_write(ops, ordered=False)
+            except BulkWriteError as err:
+                # a concurrent sync inserted the object of a path first
+                errors = err.details.get('writeErrors', [])
+                if any(e['code'] != DUPLICATE_KEY for e in errors):
+                    raise
+        LOG.debug('Synced %d %s objects of %s', len(changed_ids),
+                  self.cls.__name__, self.repo)
+        if self.process and changed_ids:
+            self.post_process(changed_ids)
+        return changed_ids
+
+    def post_process(self, object_ids):
+        if self.concurrency <= 0:
+            for obj in self.cls.query.find({'_id': {'$in': object_ids}}):
+                obj.post_process()
+            return
+        cls_path = '{}:{}'.format(self.cls.__module__, self.cls.__name__)
+        chunk_size = -(-len(object_ids) // self.concurrency)
+        for i in xrange(0, len(object_ids), chunk_size):
+            post_process_derived.post(cls_path, object_ids[i:i + chunk_size])
+
+
+class DerivedObjectSerializer(object):
+    """Serializes listings of derived objects (as their `__json__`) without
+    a lookup per object.
+
+    The app configs of the objects are loaded with a single query, and each
+    app url computed once, so that file urls are built from `blob_spec`
+    alone. Fields that read the repository are only included when asked
+    for, in which case the blobs of all the objects are dereferenced in one
+    batch first (see RepoContentLoader).
+
+    :param blob_fields: dict of field name: callable(obj) for the fields
+        read from the repository
+
+    """
+
+    def __init__(self, blob_fields=None, loader=None):
+        self.blob_fields = blob_fields or {}
+        self.loader = loader or RepoContentLoader()
+
+    def app_urls(self, objects):
+        ac_ids = list(set(obj.app_config_id for obj in objects))
+        return dict(
+            (ac._id, ac.url())
+            for ac in AppConfig.query.find({'_id': {'$in': ac_ids}}))
+
+    def serialize(self, objects):
+        objects = list(objects)
+        if not objects:
+            return []
+        app_urls = self.app_urls(objects)
+        if self.blob_fields:
+            by_cls = {}
+            for obj in objects:
+                by_cls.setdefault(obj.__class__, []).append(obj)
+            for cls_objects in by_cls.values():
+                self.loader.prefetch(cls_objects, 'blob')
+        result = []
+        for obj in objects:
+            data = obj.__json__(app_url=app_urls.get(obj.app_config_id, ''))
+            for name, field in self.blob_fields.iteritems():
+                data[name] = field(obj)
+            result.append(data)
+        return result
+
+
 class RepoAbstraction(Artifact):
     """Artifacts abstracted from a repository object.
 
@@ -0,0 +1,107 @@
+"""
+Pending commit notifications, coalesced into digests.
+
+Refresh queues the commits it adds instead of posting feed entries and
+notifications itself. A digest is sent by the `send_commit_digest` task as
+soon as the repository has not sent one for `scm.notify.digest_window`
+seconds; commits pushed within the window are held back and go out with the
+next digest, which the `send_repo_digests` command (run periodically) posts
+the task for once the window has ended.
+
+Only the newest `scm.notify.digest_max_commits` commits of a digest are
+listed (with a feed entry each); the rest are summarized.
+
+"""
+from datetime import datetime, timedelta
+
+import tg
+from paste.deploy.converters import asint
+from ming import schema as S
+from ming.odm import FieldProperty
+from ming.odm.declarative import MappedClass
+from pymongo import ReturnDocument
+from vulcanforge.common.model.session import repository_orm_session
+from vulcanforge.common.util.model import pymongo_db_collection
+
+
+def digest_window():
+    return timedelta(
+        seconds=asint(tg.config.get('scm.notify.digest_window', 300)))
+
+
+def digest_max_commits():
+    return asint(tg.config.get('scm.notify.digest_max_commits', 50))
+
+
+class CommitDigest(MappedClass):
+    """Commits of a repository awaiting notification"""
+
+    class __mongometa__:
+        session = repository_orm_session
+        name = 'repo_commit_digest'
+        unique_indexes = [('repository_id',)]
+        indexes = [('count', 'last_sent')]
+
+    _id = FieldProperty(S.ObjectId)
+    repository_id = FieldProperty(S.ObjectId)
+    app_config_id = FieldProperty(S.ObjectId)
+    # newest commits queued, oldest first
+    commit_ids = FieldProperty([str], if_missing=[])
+    # number of commits queued, including those not listed
+    count = FieldProperty(int, if_missing=0)
+    first_queued = FieldProperty(datetime, if_missing=None)
+    last_sent = FieldProperty(datetime, if_missing=None)
+
+    @classmethod
+    def queue(cls, repo, object_ids):
+        """Add commits to the digest of repo, returning when it is due (None
+        if it is due now)
+
+        """
+        object_ids = list(object_ids)
+        max_commits = digest_max_commits()
+        db, coll = pymongo_db_collection(cls)
+        doc = coll.find_one_and_update({'repository_id': repo._id}, {
+            # only the newest are listed, so do not send the others
+            '$push': {'commit_ids': {
+                '$each': object_ids[-max_commits:],
+                '$slice': -max_commits
+            }},
+            '$inc': {'count': len(object_ids)},
+            '$min': {'first_queued': datetime.utcnow()},
+            '$setOnInsert': {'app_config_id': repo.app_config_id}
+        }, upsert=True, return_document=ReturnDocument.AFTER)
+        last_sent = doc.get('last_sent')
+        if last_sent is not None:
+            due = last_sent + digest_window()
+            if due > datetime.utcnow():
+                return due
+
+    @classmethod
+    def take(cls, repo):
+        """Remove and return the queued commits of repo as (commit_ids,
+        count), marking the digest as sent
+
+        """
+        db, coll = pymongo_db_collection(cls)
+        doc = coll.find_one_and_update(
+            {'repository_id': repo._id, 'count': {'$gt': 0}},
+            {'$set': {
+                'commit_ids': [],
+                'count': 0,
+                'last_sent': datetime.utcnow()
+            }, '$unset': {'first_queued': ''}})
+        if doc is None:
+            return [], 0
+        return doc['commit_ids'], doc['count']
+
+    @classmethod
+    def overdue(cls):
+        """Digests holding commits whose window has ended"""
+        return cls.query.find({
+            'count': {'$gt': 0},
+            '$or': [
+                {'last_sent': None},
+                {'last_sent': {'$lte': datetime.utcnow() - digest_window()}}
+            ]
+        })
@@ -0,0 +1,135 @@
+"""
+Bulk copying of commit documents between repositories, used to initialize
+forks without analyzing the commits again.
+
+When the mongo server supports it (4.4+, which can `$merge` into the
+collection being aggregated) the copy runs entirely on the server as an
+aggregation pipeline; otherwise the source documents are streamed in batches
+and written with unordered `insert_many` calls. Commits the target repository
+already has are left alone in both cases, thanks to the unique (object_id,
+repository_id) index.
+
+"""
+import logging
+
+from pymongo.errors import BulkWriteError
+from vulcanforge.common.util.model import pymongo_db_collection
+
+LOG = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+def supports_merge(db):
+    """Whether the server can $merge into the collection being aggregated"""
+    return tuple(db.client.server_info()['versionArray'][:2]) >= (4, 4)
+
+
+def _log_progress(repo, copied, total):
+    if total:
+        LOG.info('Copied %d/%d commits to %s', copied, total, repo)
+    else:
+        LOG.info('Copied %d commits to %s', copied, repo)
+
+
+class CommitCopier(object):
+    """Copies the commit documents matching a query to repo.
+
+    :param repo: target Repository. Its `fork_commit_fields` and
+        `fork_commit_doc` methods rewrite the copied documents.
+    :param batch_size: number of documents written at once when streaming
+    :param progress: callable(copied, total) called after each batch
+        (total is None when unknown); logs by default
+
+    """
+
+    def __init__(self, repo, batch_size=1000, progress=None):
+        self.repo = repo
+        self.batch_size = batch_size
+        self.progress = progress or (
+            lambda copied, total: _log_progress(repo, copied, total))
+        self.db, self.coll = pymongo_db_collection(repo.commit_cls)
+        self.copied = 0
+
+    def copy(self, query, total=None, use_merge=None):
+        """Copy the commits matching query, returning the number of commits
+        the target repository gained.
+
+        """
+        if use_merge is None:
+            use_merge = supports_merge(self.db)
+        if use_merge:
+            return self._merge(query, total)
+        return self._stream(query, total)
+
+    def _count(self):
+        return self.coll.count({'repository_id': self.repo._id})
+
+    def _merge(self, query, total=None):
+        before = self._count()
+        self.coll.aggregate([
+            {'$match': query},
+            {'$project': {'_id': 0}},
+            {'$addFields': self.repo.fork_commit_fields()},
+            {'$merge': {
+                'into': self.coll.name,
+                'on': ['object_id', 'repository_id'],
+                'whenMatched': 'keepExisting',
+                'whenNotMatched': 'insert'
+            }}
+        ], allowDiskUse=True)
+        copied = self._count() - before
+        self.copied += copied
+        self.progress(self.copied, total)
+        return copied
+
+    def _insert(self, docs):
+        try:
+            result = self.coll.insert_many(docs, ordered=False)
+            inserted = len(result.inserted_ids)
+        except BulkWriteError as err:
+            errors = err.details.get('writeErrors', [])
+            if any(e['code'] != DUPLICATE_KEY for e in errors):
+                raise
+            inserted = err.details.get('nInserted', 0)
+        self.copied += inserted
+        return inserted
+
+    def _stream(self, query, total=None):
+        copied = 0
+        seen = set()
+        docs = []
+        for doc in self.coll.find(query).batch_size(self.batch_size):
+            if doc['object_id'] in seen:
+                continue
+            seen.add(doc['object_id'])
+            del doc['_id']
+            docs.append(self.repo.fork_commit_doc(doc))
+            if len(docs) >= self.batch_size:
+                copied += self._insert(docs)
+                docs = []
+                self.progress(self.copied, total)
+        if docs:
+            copied += self._insert(docs)
+            self.progress(self.copied, total)
+        return copied
+
+    def copy_ids(self, object_ids, source_query=None, use_merge=None):
+        """Copy the commits with the given ids from any other repository,
+        querying for them `batch_size` ids at a time.
+
+        """
+        if source_query is None:
+            source_query = {'repository_id': {'$ne': self.repo._id}}
+        object_ids = list(object_ids)
+        if use_merge is None:
+            use_merge = supports_merge(self.db)
+        copied = 0
+        for i in range(0, len(object_ids), self.batch_size):
+            query = dict(source_query, object_id={
+                '$in': object_ids[i:i + self.batch_size]})
+            if use_merge:
+                copied += self._merge(query, len(object_ids))
+            else:
+                copied += self._stream(query, len(object_ids))
+        return copied
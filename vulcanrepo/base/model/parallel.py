@@ -0,0 +1,140 @@
+"""
+Parallel analysis of commits for large refreshes (full refreshes, initial
+clones and imports).
+
+Analyzing a commit (`Repository.commit_info`) only reads the underlying
+repository, so the commits can be split among a pool of worker processes.
+The workers return the commit fields (with the lines changed, when they are
+captured) and the refreshing process writes them to the database a batch at
+a time, in the original (topological) order.
+
+Configuration:
+
+    scm.refresh.parallelism = 4  ; worker processes (1 disables)
+    scm.refresh.parallel.threshold = 500  ; minimum number of commits
+    scm.refresh.parallel.chunk_size = 50  ; commits per worker task
+    scm.refresh.parallel.max_pending = 8  ; chunks in flight (2 per worker)
+    scm.refresh.parallel.memory_limit = 1024  ; MB of address space/worker
+    scm.refresh.parallel.max_tasks_per_child = 100  ; recycle workers
+
+The number of chunks in flight bounds the memory used by results waiting to
+be written, and the memory limit that of each worker. Chunks a worker fails
+to analyze are returned without fields, and analyzed serially instead.
+
+"""
+import logging
+import multiprocessing
+import resource
+from collections import deque
+from itertools import islice
+
+import tg
+from paste.deploy.converters import asint
+
+LOG = logging.getLogger(__name__)
+
+# repository analyzed by this worker process, and whether it counts the
+# lines changed by the commits
+_repo = None
+_line_stats = False
+
+
+def _init_worker(repo, memory_limit, line_stats=False):
+    global _repo, _line_stats
+    if memory_limit:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    # do not share the parent's connections to the repository
+    repo.reset_clients()
+    _repo = repo
+    _line_stats = line_stats
+
+
+def _analyze(object_ids):
+    result = []
+    for object_id in object_ids:
+        try:
+            info = _repo.commit_info(object_id)
+        except Exception:
+            LOG.exception('Error analyzing %s in %s', object_id, _repo)
+            info = None
+        result.append((object_id, info))
+    if _line_stats:
+        # left out of the fields on error, to be counted by the parent
+        try:
+            stats = _repo.line_stats(object_ids)
+        except Exception:
+            LOG.exception('Error counting lines changed in %s', _repo)
+        else:
+            for object_id, info in result:
+                if info is not None:
+                    info['line_stats'] = stats.get(object_id)
+    return result
+
+
+def _config_int(name, default):
+    return asint(tg.config.get('scm.refresh.' + name, default))
+
+
+class ParallelAnalyzer(object):
+    """Analyzes the commits of repo in worker processes"""
+
+    def __init__(self, repo, processes=None, chunk_size=None,
+                 max_pending=None, memory_limit=None,
+                 max_tasks_per_child=None, line_stats=False):
+        self.repo = repo
+        self.line_stats = line_stats
+        if processes is None:
+            processes = _config_int('parallelism', 1)
+        self.processes = processes
+        if chunk_size is None:
+            chunk_size = _config_int('parallel.chunk_size', 50)
+        self.chunk_size = max(1, chunk_size)
+        if max_pending is None:
+            max_pending = _config_int('parallel.max_pending', processes * 2)
+        self.max_pending = max(1, max_pending)
+        if memory_limit is None:
+            memory_limit = _config_int('parallel.memory_limit', 0)
+        self.memory_limit = memory_limit
+        if max_tasks_per_child is None:
+            max_tasks_per_child = _config_int(
+                'parallel.max_tasks_per_child', 0)
+        self.max_tasks_per_child = max_tasks_per_child or None
+
+    @classmethod
+    def should_use(cls, repo, commit_ids):
+        """Whether refreshing commit_ids warrants worker processes"""
+        return (repo.supports_parallel_refresh and
+                _config_int('parallelism', 1) > 1 and
+                len(commit_ids) >= _config_int('parallel.threshold', 500))
+
+    def iter_info(self, commit_ids):
+        """Yield (object_id, commit fields or None) for commit_ids, in order
+        """
+        chunks = (commit_ids[i:i + self.chunk_size]
+                  for i in xrange(0, len(commit_ids), self.chunk_size))
+        pool = multiprocessing.Pool(
+            self.processes, _init_worker,
+            (self.repo, self.memory_limit, self.line_stats),
+            self.max_tasks_per_child)
+        try:
+            pending = deque(
+                (chunk, pool.apply_async(_analyze, (chunk,)))
+                for chunk in islice(chunks, self.max_pending))
+            while pending:
+                chunk, async_result = pending.popleft()
+                try:
+                    results = async_result.get()
+                except Exception:
+                    LOG.exception('Worker failed analyzing %d commits of %s',
+                                  len(chunk), self.repo)
+                    results = [(object_id, None) for object_id in chunk]
+                for chunk in islice(chunks, 1):
+                    pending.append(
+                        (chunk, pool.apply_async(_analyze, (chunk,))))
+                for item in results:
+                    yield item
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,221 @@
+"""
+Batch creation of the artifact references and shortlinks of commits.
+
+`ArtifactReference.from_artifact` and `Shortlink.from_artifact` handle one
+artifact at a time, with a few queries per commit and per link.
+`CommitReferenceExtractor` handles a batch of commits of one repository
+instead:
+
+* the shortlinks in the commit messages (`get_link_content`) are found with
+  a precompiled pattern and parsed once per distinct link,
+* the projects, app configs and shortlinks they refer to are looked up with
+  one query each for the whole batch (ephemeral links, such as repository
+  paths, are still resolved by their handlers, once per distinct link),
+* the references and shortlinks of the commits are built through their
+  Ming classes and upserted with one bulk write per collection.
+
+An extractor keeps the links it resolved, so reusing one for the batches
+of a task resolves each distinct link once.
+
+"""
+import logging
+import re
+from cPickle import dumps
+
+import bson
+from ming.odm import session, state
+from pymongo import UpdateOne
+from vulcanforge.artifact.model import ArtifactReference, Shortlink
+from vulcanforge.common.util.model import pymongo_db_collection
+from vulcanforge.project.model import AppConfig, Project
+
+LOG = logging.getLogger(__name__)
+
+SHORTLINK_RE = re.compile(r'(?<!\[)\[([^\]\[]+)\]')
+
+
+def parse_link(text):
+    """Split the text of a shortlink into (project, app, artifact), where
+    project and app are None when omitted
+
+    """
+    parts = text.strip().split(':')
+    if len(parts) == 3:
+        return tuple(parts)
+    elif len(parts) == 2:
+        return None, parts[0], parts[1]
+    elif len(parts) == 1:
+        return None, None, parts[0]
+
+
+def find_links(text):
+    """Distinct parsed shortlinks in text, in order of appearance"""
+    links = []
+    for match in SHORTLINK_RE.finditer(text or ''):
+        link = parse_link(match.group(1))
+        if link and link[2] and link not in links:
+            links.append(link)
+    return links
+
+
+class CommitReferenceExtractor(object):
+    """Creates the references and shortlinks of commits of repo in bulk"""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.app_config = repo.app_config
+        # ref_id (or None) by parsed link, across the batches extracted
+        self.resolved = {}
+
+    @staticmethod
+    def ephemerals():
+        from vulcanrepo.artifact import RepoArtifactAPI
+        return RepoArtifactAPI.SHORTLINK_EPHERMERALS.items()
+
+    def _lookup(self, links):
+        """Resolve links through the shortlinks collection, with a query
+        per collection for all of them
+
+        """
+        shortnames = set(link[0] for link in links if link[0])
+        projects = {}
+        if shortnames:
+            for project in Project.query.find(
+                    {'shortname': {'$in': list(shortnames)}}):
+                projects[project.shortname] = project._id
+        project_ids = set(projects.values())
+        project_ids.add(self.app_config.project_id)
+
+        mount_points = set(link[1] for link in links if link[1])
+        app_configs = {}
+        if mount_points:
+            for ac in AppConfig.query.find({
+                    'project_id': {'$in': list(project_ids)},
+                    'options.mount_point': {'$in': list(mount_points)}}):
+                app_configs[(ac.project_id, ac.options.mount_point)] = ac._id
+
+        candidates = {}
+        for shortlink in Shortlink.query.find({
+                'project_id': {'$in': list(project_ids)},
+                'link': {'$in': list(set(link[2] for link in links))}}):
+            candidates.setdefault(
+                (shortlink.project_id, shortlink.link), []).append(shortlink)
+
+        for link in links:
+            shortname, mount_point, artifact = link
+            if shortname:
+                project_id = projects.get(shortname)
+            else:
+                project_id = self.app_config.project_id
+            matches = candidates.get((project_id, artifact), [])
+            if mount_point:
+                ac_id = app_configs.get((project_id, mount_point))
+                matches = [s for s in matches if s.app_config_id == ac_id]
+            else:
+                # prefer the repository's own tool
+                matches.sort(
+                    key=lambda s: s.app_config_id != self.app_config._id)
+            if matches:
+                self.resolved[link] = matches[0].ref_id
+
+    def _resolve_ephemeral(self, link):
+        shortname, mount_point, artifact = link
+        parsed_link = {
+            'project': shortname or self.app_config.project.shortname,
+            'app': mount_point,
+            'artifact': artifact
+        }
+        for regex, handlers in self.ephemerals():
+            match = regex.match(artifact)
+            if match:
+                try:
+                    return handlers['ref_id'](parsed_link, match, upsert=True)
+                except Exception:
+                    LOG.exception('Error resolving shortlink %s', artifact)
+                    return None
+
+    def resolve(self, links):
+        """Resolve links to ref ids, skipping those resolved before
+
+        :return: dict of link: ref_id (or None)
+
+        """
+        new_links = [link for link in links if link not in self.resolved]
+        if new_links:
+            self._lookup(new_links)
+            for link in new_links:
+                if link not in self.resolved:
+                    self.resolved[link] = self._resolve_ephemeral(link)
+        return dict((link, self.resolved[link]) for link in links)
+
+    @staticmethod
+    def _new_doc(cls, **kw):
+        """Document of a new cls object, as its schema makes it"""
+        obj = cls(**kw)
+        doc = dict(state(obj).document)
+        session(cls).expunge(obj)
+        return doc
+
+    @staticmethod
+    def _upsert_op(query, doc, fields):
+        """Upsert doc on query, updating only fields of an existing one"""
+        on_insert = dict(
+            (k, v) for k, v in doc.iteritems() if k not in fields)
+        update = {'$set': dict((k, doc[k]) for k in fields)}
+        if on_insert:
+            update['$setOnInsert'] = on_insert
+        return UpdateOne(query, update, upsert=True)
+
+    def _reference_op(self, ci, references):
+        doc = self._new_doc(
+            ArtifactReference,
+            _id=ci.index_id(),
+            artifact_reference=dict(
+                cls=bson.Binary(dumps(ci.__class__)),
+                project_id=self.app_config.project_id,
+                app_config_id=self.app_config._id,
+                artifact_id=ci._id),
+            references=references)
+        return self._upsert_op({'_id': doc['_id']}, doc, ['references'])
+
+    def _shortlink_op(self, ci):
+        doc = self._new_doc(
+            Shortlink,
+            ref_id=ci.index_id(),
+            project_id=self.app_config.project_id,
+            app_config_id=self.app_config._id,
+            link=ci.shorthand_id(),
+            url=ci.url())
+        return self._upsert_op(
+            {'ref_id': doc['ref_id']}, doc,
+            ['project_id', 'app_config_id', 'link', 'url'])
+
+    def extract(self, commits):
+        """Upsert the references and shortlinks of commits
+
+        :return: the ref ids of the commits
+
+        """
+        links = {}
+        for ci in commits:
+            ci.set_context(self.repo)
+            links[ci._id] = find_links(ci.get_link_content())
+        resolved = self.resolve(
+            set(link for ci_links in links.values() for link in ci_links))
+
+        reference_ops, shortlink_ops, ref_ids = [], [], []
+        for ci in commits:
+            references = []
+            for link in links[ci._id]:
+                ref_id = resolved[link]
+                if ref_id and ref_id not in references:
+                    references.append(ref_id)
+            reference_ops.append(self._reference_op(ci, references))
+            shortlink_ops.append(self._shortlink_op(ci))
+            ref_ids.append(ci.index_id())
+        if reference_ops:
+            db, coll = pymongo_db_collection(ArtifactReference)
+            coll.bulk_write(reference_ops, ordered=False)
+            db, coll = pymongo_db_collection(Shortlink)
+            coll.bulk_write(shortlink_ops, ordered=False)
+        return ref_ids
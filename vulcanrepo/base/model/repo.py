@@ -9,12 +9,17 @@ import string
 import re
 from datetime import datetime
 from operator import itemgetter
-from itertools import chain, izip_longest
+from itertools import chain, islice, izip_longest
 from urlparse import urlparse
 
+import bson
 import tg
+from paste.deploy.converters import asbool, asint
 from pylons import tmpl_context as c, app_globals as g
+import pymongo
 import pymongo.errors
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from ming import schema as S
 from ming.utils import LazyProperty
 from ming.odm import FieldProperty, RelationProperty, session, state
@@ -24,23 +29,30 @@ from vulcanforge.common import helpers as h
 from vulcanforge.common.model.session import repository_orm_session
 from vulcanforge.artifact.tasks import add_artifacts
 from vulcanforge.common.util import ConfigProxy
+from vulcanforge.common.util.model import pymongo_db_collection
 from vulcanforge.artifact.model import (
     Artifact,
     Feed,
-    ArtifactApiMixin,
-    ArtifactReference,
-    Shortlink
+    ArtifactApiMixin
 )
 from vulcanforge.auth.model import User
 from vulcanforge.common.util.filesystem import import_object
 from vulcanforge.discussion.model import Thread
-from vulcanforge.project.model import AppConfig, Project
+from vulcanforge.project.model import Project
 from vulcanforge.notification.model import Notification
 from vulcanforge.taskd import model_task
 from vulcanforge.visualize.base import VisualizableMixIn
 
+from vulcanrepo import instrument
 from vulcanrepo.exceptions import RepoNoJoin
 from .hook import PostCommitHook
+from .rollup import CommitRollup
+from .commit_index import CommitIndex
+from .fork import CommitCopier, DUPLICATE_KEY
+from .parallel import ParallelAnalyzer
+from .digest import CommitDigest
+from .references import CommitReferenceExtractor
+from .content_loader import RepoContentLoader
 
 log = logging.getLogger(__name__)
 config = ConfigProxy(
@@ -369,6 +381,11 @@ class Repository(Artifact):
     BATCH_SIZE = 100
     post_receive_template = string.Template('#!/bin/bash\ncurl -s -k $url\n')
     commit_cls = None
+    REFRESH_PHASES = ('ingest', 'index', 'notify', 'hooks')
+    # whether commit_info is implemented (see ParallelAnalyzer)
+    supports_parallel_refresh = False
+    # lazy clients of the underlying repository (reset in worker processes)
+    client_attrs = ()
 
     class __mongometa__:
         name = 'generic-repository'
@@ -388,6 +405,22 @@ class Repository(Artifact):
         args=[None],
         kwargs=None
     ))])
+    # set once the CommitRollup statistics are built (to the newest commit
+    # _id at the time)
+    stats_rollup_id = FieldProperty(S.ObjectId, if_missing=None)
+    # progress of an unfinished refresh (see refresh)
+    refresh_checkpoint = FieldProperty(dict(
+        phase=str,
+        # newest commit _id before the refresh
+        since=S.ObjectId,
+        # last commit ingested
+        last_oid=str,
+        done=int,
+        total=int,
+        all_commits=bool,
+        notify=bool,
+        with_hooks=bool,
+        updated=datetime), if_missing=None)
 
     def __init__(self, **kw):
         log.info("Repository init. keyword arguments: %s" % kw)
@@ -477,17 +510,65 @@ class Repository(Artifact):
         """
         pass
 
-    def init_as_clone(self, source_name, source_url):
-        """Initialize as clone of another repository"""
+    def init_as_clone(self, source_name, source_url, source_repo=None):
+        """Initialize as clone of another repository
+
+        :param source_repo: the Repository cloned, if it is on this host
+
+        """
         self.upstream_repo.name = source_name
         self.upstream_repo.url = source_url
         session(self.__class__).flush(self)
-        self.clone_from(source_url)
+        self.clone_from(source_url, source_repo=source_repo)
+
+    def clone_from(self, source_url, source_repo=None):
+        """Clone from a given source repository. Implement in subclass
 
-    def clone_from(self, source_url):
-        """Clone from a given source repository. Implement in subclass"""
+        When source_repo is given, implementations should clone it cheaply
+        and use `copy_commits_from` rather than analyze every commit again.
+
+        """
         raise NotImplementedError('clone_from')
 
+    def copy_commits_from(self, source):
+        """Copy the commit metadata of source, a repository this one was just
+        cloned from, so that refresh only analyzes the commits that differ.
+
+        """
+        with instrument.timer('fork.copy_commits'):
+            CommitCopier(self, batch_size=self.BATCH_SIZE * 10).copy(
+                {'repository_id': source._id})
+
+        # the copies are indexed in the background (see index_commits)
+        count = CommitIndex.add_all(self)
+        self.index_commits.post()
+        log.info('Copied %d commits from %s to %s', count, source, self)
+        return count
+
+    def fork_commit_fields(self):
+        """Aggregation expressions of the fields to set on commit documents
+        copied to this repository (see `CommitCopier`)
+
+        """
+        return {
+            'repository_id': self._id,
+            'app_config_id': self.app_config_id,
+            'rolled_up': False,
+            'rollup_claim': None,
+            'indexed': False
+        }
+
+    def fork_commit_doc(self, doc):
+        """Rewrite a commit document copied to this repository"""
+        doc.update({
+            'repository_id': self._id,
+            'app_config_id': self.app_config_id,
+            'rolled_up': False,
+            'rollup_claim': None,
+            'indexed': False
+        })
+        return doc
+
     def refresh_heads(self):
         """Store metadata about current state of the repo, including latest
         commit.
@@ -500,7 +581,43 @@ class Repository(Artifact):
         repository representation.
 
         """
-        raise NotImplementedError('refresh_commit')
+        self.apply_commit_info(ci, self.commit_info(ci.object_id))
+
+    def commit_info(self, object_id):
+        """Analyze a commit, returning its author, log, diffs etc. as a
+        dictionary of commit fields.
+
+        This is called from worker processes by parallel refreshes, so it
+        must only read the underlying repository (not the database).
+        Implement in subclass.
+
+        """
+        raise NotImplementedError('commit_info')
+
+    def apply_commit_info(self, ci, info):
+        for name, value in info.iteritems():
+            setattr(ci, name, value)
+
+    def reset_clients(self):
+        """Drop the clients of the underlying repository, so that they are
+        created afresh when next used (e.g. in a forked process)
+
+        """
+        for name in self.client_attrs:
+            self.__dict__.pop(name, None)
+
+    @property
+    def capture_line_stats(self):
+        return asbool(tg.config.get('scm.line_stats', False))
+
+    def line_stats(self, commit_ids):
+        """Count the lines inserted and deleted by each of the given commits
+        (against the first parent), for each file and in total.
+
+        :return: dict of commit id: {insertions, deletions, files}
+
+        """
+        raise NotImplementedError('line_stats')
 
     def new_commits(self, all_commits=False):
         """Find any new commit ids that have not been analyzed by the forge. If
@@ -514,6 +631,15 @@ class Repository(Artifact):
         """Get a commit by revision string|int."""
         raise NotImplementedError('commit')
 
+    def split_ref(self, rev, args):
+        """Separate a revision from the path elements that follow it in a
+        url, for revisions that may contain slashes.
+
+        :return: (rev, remaining args)
+
+        """
+        return rev, args
+
     def url(self):
         return self.app_config.url()
 
@@ -631,7 +757,8 @@ class Repository(Artifact):
         for hook, args, kwargs in self.get_hooks():
             log.info('Running Postcommit hook %s on %d commits' % (
                 hook.shortname, len(commits)))
-            hook.run(commits, args=args, kwargs=kwargs)
+            with instrument.timer('hook.{}'.format(hook.shortname)):
+                hook.run(commits, args=args, kwargs=kwargs)
             log.info('Hook complete')
 
     @model_task
@@ -652,6 +779,98 @@ class Repository(Artifact):
                 filter(lambda x: x is not None, batch_commit_ids))
         log.info('Post Commit Hooks complete')
 
+    @property
+    def indexing_key(self):
+        return '{}.index_commits'.format(self._id)
+
+    def _claim_indexing(self, claim):
+        """Claim (or keep claiming) the indexing of the repository's commits
+        for the task holding claim, returning False if another task holds
+        it. A claim lapses `scm.index.claim_timeout` seconds after it was
+        last made, in case its task died.
+
+        """
+        if not g.cache:  # indexing twice is only wasteful
+            return True
+        redis = g.cache.redis
+        timeout = asint(tg.config.get('scm.index.claim_timeout', 600))
+        if redis.set(self.indexing_key, claim, nx=True, ex=timeout):
+            return True
+        if redis.get(self.indexing_key) == claim:
+            redis.expire(self.indexing_key, timeout)
+            return True
+        return False
+
+    def _release_indexing(self, claim):
+        if g.cache and g.cache.redis.get(self.indexing_key) == claim:
+            g.cache.redis.delete(self.indexing_key)
+
+    def _unindexed_commits(self, limit):
+        return self.commit_cls.query.find({
+            'repository_id': self._id,
+            'indexed': {'$ne': True}
+        }).sort('_id', 1).limit(limit).all()
+
+    def _mark_indexed(self, commits):
+        db, coll = pymongo_db_collection(self.commit_cls)
+        coll.update_many(
+            {'_id': {'$in': [ci._id for ci in commits]}},
+            {'$set': {'indexed': True}})
+
+    def index_artifacts(self, commits, extractor=None):
+        """Create the artifact references and shortlinks of commits, and
+        add them to the artifact index
+
+        :param extractor: CommitReferenceExtractor to reuse, so that the
+            links it resolved are not resolved again
+
+        """
+        if extractor is None:
+            extractor = CommitReferenceExtractor(self)
+        ref_ids = extractor.extract(commits)
+        add_artifacts(ref_ids, update_solr=False)
+        return ref_ids
+
+    @model_task
+    def index_commits(self, attempt=0):
+        """Index the commits that are not yet, one batch of
+        `scm.index.batch_size` commits per task.
+
+        A single task indexes each repository at a time: it posts itself
+        again for the next batch, so that large imports do not flood the
+        task queue, and retries a failed batch up to `scm.index.max_retries`
+        times. The batch is indexed `BATCH_SIZE` commits at a time, renewing
+        the task's claim and flagging the commits as indexed after each.
+
+        """
+        claim = str(bson.ObjectId())
+        if not self._claim_indexing(claim):
+            return
+        batch_size = asint(tg.config.get('scm.index.batch_size', 500))
+        commits = self._unindexed_commits(batch_size)
+        extractor = CommitReferenceExtractor(self)
+        try:
+            for i in xrange(0, len(commits), self.BATCH_SIZE):
+                if i and not self._claim_indexing(claim):
+                    log.warn('Lost the claim on indexing %s', self)
+                    return
+                chunk = commits[i:i + self.BATCH_SIZE]
+                with instrument.timer('index.commits'):
+                    self.index_artifacts(chunk, extractor)
+                self._mark_indexed(chunk)
+        except Exception:
+            self._release_indexing(claim)
+            if attempt < asint(tg.config.get('scm.index.max_retries', 3)):
+                log.warn('Error indexing commits of %s, retrying', self,
+                         exc_info=True)
+                self.index_commits.post(attempt=attempt + 1)
+                return
+            raise
+        self._release_indexing(claim)
+        # commits added while indexing are left to the next task
+        if commits and self._unindexed_commits(1):
+            self.index_commits.post()
+
     def get_hooks(self):
         """
         Generator that yields:
@@ -676,14 +895,46 @@ class Repository(Artifact):
             author_name=ci.user.display_name if ci.user else None
         )
 
-    def notify_commits(self, commit_msgs, last_commit=None):
+    @model_task
+    def send_commit_digest(self):
+        """Post the feed entries and notification for the commits queued in
+        the repository's CommitDigest
+
+        """
+        commit_ids, count = CommitDigest.take(self)
+        if not count:
+            return
+        order = dict((oid, i) for i, oid in enumerate(commit_ids))
+        commits = sorted(self.commit_cls.query.find({
+            'repository_id': self._id,
+            'object_id': {'$in': commit_ids}
+        }), key=lambda ci: order[ci.object_id])
+        for ci in commits:
+            ci.set_context(self)
+            self.post_commit_feed(ci)
+        if count > len(commits):
+            Feed.post(
+                self,
+                title='New commits',
+                description='%d more new commits' % (count - len(commits))
+            )
+        self.notify_commits(
+            [ci.notification_message for ci in commits],
+            last_commit=commits[-1] if commits else None,
+            total=count)
+
+    def notify_commits(self, commit_msgs, last_commit=None, total=None):
         """Create notification(s) for this repository given a list of commit
         messages.
 
+        :param total: number of new commits, if more than the messages given
+
         """
-        if len(commit_msgs) > 1:
+        if total is None:
+            total = len(commit_msgs)
+        if total > 1:
             subject = '%d new commits to %s %s' % (
-                len(commit_msgs),
+                total,
                 self.app.project.name,
                 self.app.config.options.mount_label)
         elif last_commit:
@@ -697,6 +948,9 @@ class Repository(Artifact):
                 self.app.project.name,
             )
         text = '\n\n'.join(commit_msgs)
+        if total > len(commit_msgs):
+            text += '\n\n... and {} earlier commits'.format(
+                total - len(commit_msgs))
         # pass last committer to notification as user
         author = last_commit.user if last_commit else None
         notification = Notification.post(
@@ -710,74 +964,289 @@ class Repository(Artifact):
 
     def refresh(self, all_commits=False, notify=True, with_hooks=True,
                 update_status=True):
-        """Find any new commits in the repository and update"""
-        self.refresh_heads()  # updates repository metadata
-        if update_status:
-            self.status = 'analyzing'
-            session(self.__class__).flush()
+        """Find any new commits in the repository and update.
 
-        commit_ids = self.new_commits(all_commits)
-        log.info('Refreshing %d new commits in %s', len(commit_ids), self)
+        Progress is checkpointed in `refresh_checkpoint`, so that a refresh
+        that was interrupted (e.g. by its worker dying) is resumed by the
+        next one rather than started over. A refresh started while another
+        is under way leaves the new commits to it (which then looks for new
+        commits once more), so that each commit is processed once.
 
-        sess = session(self.commit_cls)
-        commit_msgs = []
-        ref_ids = []
-        new_commit_ids = []
-        lc = None
-
-        # Add commit objects to the db
-        for i, oid in enumerate(commit_ids):
-            ci, isnew = self.commit_cls.upsert(oid, self._id)
-            # race condition if not all_commits
-            if not isnew and not all_commits:
-                sess.expunge(ci)
-                continue
-
-            # refresh and create metadata
-            ci.set_context(self)
-            self.refresh_commit(ci)
-            ArtifactReference.from_artifact(ci)
-            Shortlink.from_artifact(ci)
-            ref_ids.append(ci.index_id())
-            lc = ci
+        """
+        with instrument.timer('refresh'):
+            checkpoint = self.refresh_checkpoint
+            if checkpoint is not None and not self._checkpoint_stale(
+                    checkpoint):
+                # another refresh is under way: have it look for new
+                # commits again once it is done
+                self._request_refresh()
+                log.info('Refresh of %s under way, requested another', self)
+                return 0
+            count = 0
+            if checkpoint is not None:
+                log.info('Resuming refresh of %s at %s', self,
+                         checkpoint['phase'])
+                count += self._refresh(dict(checkpoint), update_status)
+            count += self._refresh(self._new_checkpoint(
+                all_commits, notify, with_hooks), update_status)
+            while self._refresh_requested():
+                count += self._refresh(self._new_checkpoint(
+                    False, notify, with_hooks), update_status)
+            return count
 
-            # periodic flushing for large commit collections
-            if (i + 1) % self.BATCH_SIZE == 0:
-                sess.flush()
-                sess.clear()
+    @property
+    def refresh_request_key(self):
+        return '{}.refresh_requested'.format(self._id)
+
+    def _request_refresh(self):
+        if g.cache:
+            timeout = asint(
+                tg.config.get('scm.refresh.checkpoint_timeout', 900))
+            g.cache.redis.set(self.refresh_request_key, 1, ex=timeout)
 
-            # Collect Notifications
-            if notify:
-                self.post_commit_feed(ci)
-                commit_msgs.append(ci.notification_message)
+    def _refresh_requested(self):
+        """Whether a refresh was requested while this one was under way,
+        clearing the request
+
+        """
+        return bool(g.cache and g.cache.redis.delete(
+            self.refresh_request_key))
+
+    def _new_checkpoint(self, all_commits, notify, with_hooks):
+        last = self.commit_cls.query.find({'repository_id': self._id}).sort(
+            '_id', pymongo.DESCENDING).limit(1).first()
+        return {
+            'phase': self.REFRESH_PHASES[0],
+            'since': last._id if last else None,
+            'last_oid': None,
+            'done': 0,
+            'total': 0,
+            'all_commits': all_commits,
+            'notify': notify,
+            'with_hooks': with_hooks,
+            'updated': datetime.utcnow()
+        }
 
-            new_commit_ids.append(oid)
+    def _checkpoint_stale(self, checkpoint):
+        timeout = asint(tg.config.get('scm.refresh.checkpoint_timeout', 900))
+        age = datetime.utcnow() - checkpoint['updated']
+        return age.total_seconds() > timeout
 
-        # Send Notifications
-        if notify and commit_msgs:
-            self.notify_commits(commit_msgs, last_commit=lc)
+    def _checkpoint(self, checkpoint, **kwargs):
+        checkpoint.update(kwargs, updated=datetime.utcnow())
+        self.refresh_checkpoint = dict(checkpoint)
+        session(self.__class__).flush(self)
 
-        sess.flush()
-        sess.clear()
+    @property
+    def status_label(self):
+        """Status, with the progress of the refresh under way if any"""
+        checkpoint = self.refresh_checkpoint
+        if self.status == 'analyzing' and checkpoint is not None:
+            return '{} ({} {}/{})'.format(
+                self.status, checkpoint['phase'], checkpoint['done'],
+                checkpoint['total'])
+        return self.status
+
+    def _refresh(self, checkpoint, update_status):
+        with instrument.timer('refresh.heads'):
+            self.refresh_heads()  # updates repository metadata
+        if update_status:
+            self.status = 'analyzing'
+            session(self.__class__).flush()
 
-        # Index the commits
-        if ref_ids:
-            add_artifacts(ref_ids, update_solr=False)
+        if checkpoint['phase'] in self.REFRESH_PHASES:
+            start = self.REFRESH_PHASES.index(checkpoint['phase'])
+        else:  # a phase since folded into another
+            start = self.REFRESH_PHASES.index('index')
+        for phase in self.REFRESH_PHASES[start:]:
+            if phase != checkpoint['phase']:
+                self._checkpoint(checkpoint, phase=phase, done=0)
+            with instrument.timer('refresh.' + phase):
+                getattr(self, '_refresh_' + phase)(checkpoint)
 
         log.info('Refreshed repository %s.', self)
+        self.refresh_checkpoint = None
         if update_status:
             self.status = 'ready'
-            session(self.__class__).flush()
+        session(self.__class__).flush()
+        return checkpoint['total']
 
-        # Run Pluggable Post Commit Hooks
-        if with_hooks:
-            if all_commits:
-                self.run_batched_post_commit_hooks.post()
-            else:
-                # do individual queries to maintain order
-                self.run_post_commit_hooks.post(new_commit_ids)
+    def _refreshed_ids(self, checkpoint):
+        """Object ids of the commits added by a refresh (all of them if it
+        refreshes all commits), in order, checkpointing after each batch
 
-        return len(commit_ids)
+        """
+        query = {'repository_id': self._id}
+        if not checkpoint['all_commits'] and checkpoint['since'] is not None:
+            query['_id'] = {'$gt': checkpoint['since']}
+        db, coll = pymongo_db_collection(self.commit_cls)
+        cursor = coll.find(query, {'object_id': 1}).sort('_id', 1)
+        object_ids = []
+        for doc in cursor.batch_size(self.BATCH_SIZE):
+            object_ids.append(doc['object_id'])
+            if len(object_ids) % self.BATCH_SIZE == 0:
+                self._checkpoint(checkpoint, done=len(object_ids))
+        return object_ids
+
+    def _discard_unanalyzed(self, checkpoint):
+        """Remove the empty commit documents left by an interrupted refresh
+        (refreshes used to insert them before analyzing the commits), so
+        that they are found and analyzed again
+
+        """
+        query = {'repository_id': self._id, 'message': None}
+        if checkpoint['since'] is not None:
+            query['_id'] = {'$gt': checkpoint['since']}
+        db, coll = pymongo_db_collection(self.commit_cls)
+        result = coll.delete_many(query)
+        if result.deleted_count:
+            log.info('Refreshing %d unanalyzed commits in %s again',
+                     result.deleted_count, self)
+
+    def _refresh_ingest(self, checkpoint):
+        """Add commit objects to the db, a batch at a time. Commits are only
+        written once analyzed, so an interrupted refresh leaves nothing
+        behind that the next one would take for analyzed.
+
+        """
+        self._discard_unanalyzed(checkpoint)
+        with instrument.timer('refresh.new_commits'):
+            commit_ids = self.new_commits(checkpoint['all_commits'])
+        if checkpoint['last_oid'] in commit_ids:
+            # resuming an interrupted refresh of all commits
+            commit_ids = commit_ids[
+                commit_ids.index(checkpoint['last_oid']) + 1:]
+        log.info('Refreshing %d new commits in %s', len(commit_ids), self)
+        done = checkpoint['done']
+        self._checkpoint(checkpoint, total=done + len(commit_ids))
+
+        # analyze large sets of commits in worker processes
+        if ParallelAnalyzer.should_use(self, commit_ids):
+            commit_infos = ParallelAnalyzer(
+                self, line_stats=self.capture_line_stats
+            ).iter_info(commit_ids)
+        else:
+            commit_infos = ((oid, None) for oid in commit_ids)
+
+        count = 0
+        try:
+            for i in xrange(0, len(commit_ids), self.BATCH_SIZE):
+                batch = list(islice(commit_infos, self.BATCH_SIZE))
+                docs = self._commit_docs(batch)
+                with instrument.timer('refresh.write'):
+                    count += self._write_commits(
+                        docs, checkpoint['all_commits'])
+                self._checkpoint(checkpoint, last_oid=batch[-1][0],
+                                 done=done + i + len(batch))
+        finally:
+            commit_infos.close()
+        instrument.incr('refresh.commits', count)
+
+    def _commit_docs(self, batch):
+        """Documents of the commits of batch, a list of (object_id, commit
+        fields or None if they were not analyzed yet)
+
+        :return: list of (document, names of the analyzed fields)
+
+        """
+        infos = []
+        for oid, info in batch:
+            if info is None:
+                with instrument.timer('refresh.commit'):
+                    info = self.commit_info(oid)
+            infos.append((oid, info))
+        if self.capture_line_stats:
+            # count lines changed by the commits the workers did not
+            missing = [oid for oid, info in infos if 'line_stats' not in info]
+            if missing:
+                with instrument.timer('refresh.line_stats'):
+                    line_stats = self.line_stats(missing)
+                for oid, info in infos:
+                    info.setdefault('line_stats', line_stats.get(oid))
+        sess = session(self.commit_cls)
+        docs = []
+        for oid, info in infos:
+            ci = self.commit_cls.new_by_object_id(oid, self._id)
+            self.apply_commit_info(ci, info)
+            docs.append((dict(state(ci).document), set(info)))
+            # written around the session (see _write_commits)
+            sess.expunge(ci)
+        return docs
+
+    def _write_commits(self, docs, overwrite):
+        """Insert commit documents with a single unordered bulk write,
+        returning the number of commits written
+
+        :param overwrite: update the analyzed fields of the commits that
+            exist already, rather than leave them alone
+
+        """
+        db, coll = pymongo_db_collection(self.commit_cls)
+        requests = []
+        for doc, analyzed in docs:
+            key = {'repository_id': self._id, 'object_id': doc['object_id']}
+            if overwrite:
+                update = {
+                    '$set': dict(
+                        (k, v) for k, v in doc.iteritems() if k in analyzed),
+                    '$setOnInsert': dict(
+                        (k, v) for k, v in doc.iteritems()
+                        if k not in analyzed and k not in key)
+                }
+            else:
+                update = {'$setOnInsert': doc}
+            requests.append(UpdateOne(key, update, upsert=True))
+        if not requests:
+            return 0
+        try:
+            result = coll.bulk_write(requests, ordered=False)
+        except BulkWriteError as err:
+            # a concurrent refresh inserted some of the commits
+            errors = err.details.get('writeErrors', [])
+            if any(e['code'] != DUPLICATE_KEY for e in errors):
+                raise
+            return err.details.get('nUpserted', 0)
+        if overwrite:
+            return result.upserted_count + result.matched_count
+        return result.upserted_count
+
+    def _refresh_notify(self, checkpoint):
+        """Queue the commits for the next digest (see CommitDigest)"""
+        if not checkpoint['notify']:
+            return
+        object_ids = self._refreshed_ids(checkpoint)
+        if not object_ids:
+            return
+        # held back commits are sent by send_repo_digests
+        if CommitDigest.queue(self, object_ids) is None:
+            self.send_commit_digest.post()
+
+    def _refresh_index(self, checkpoint):
+        object_ids = self._refreshed_ids(checkpoint)
+
+        # Record the repository as an owner of its new commits
+        with instrument.timer('refresh.commit_index'):
+            CommitIndex.add(self, object_ids)
+
+        # Update the commit statistics
+        with instrument.timer('refresh.rollups'):
+            CommitRollup.update(self)
+
+        # References and artifact index entries are created in the
+        # background
+        if object_ids:
+            self.index_commits.post()
+
+    def _refresh_hooks(self, checkpoint):
+        """Run Pluggable Post Commit Hooks"""
+        if not checkpoint['with_hooks']:
+            return
+        if checkpoint['all_commits']:
+            self.run_batched_post_commit_hooks.post()
+        else:
+            # do individual queries to maintain order
+            self.run_post_commit_hooks.post(
+                self._refreshed_ids(checkpoint))
 
     def push_upstream_context(self):
         """Enter context of upstream repository"""
@@ -796,6 +1265,9 @@ class Commit(Artifact):
         session = repository_orm_session
         name = 'repo_commit'
         unique_indexes = [('object_id', 'repository_id')]
+        indexes = [('repository_id', 'rolled_up'),
+                   ('repository_id', 'rollup_claim'),
+                   ('repository_id', 'indexed')]
 
     type_s = 'Commit'
 
@@ -815,6 +1287,19 @@ class Commit(Artifact):
         email=str,
         date=datetime))
     message = FieldProperty(str)
+    # lines changed, captured on refresh when scm.line_stats is enabled
+    line_stats = FieldProperty(dict(
+        insertions=int,
+        deletions=int,
+        files=[dict(path=str, insertions=int, deletions=int)]
+    ), if_missing=None)
+    # whether the commit is counted in the CommitRollup statistics, and the
+    # rollup update counting it (see CommitRollup)
+    rolled_up = FieldProperty(bool, if_missing=False)
+    rollup_claim = FieldProperty(S.ObjectId, if_missing=None)
+    # whether the artifact references and shortlinks of the commit exist
+    # (see Repository.index_commits)
+    indexed = FieldProperty(bool, if_missing=False)
 
     tool_version = FieldProperty({str: str}, if_missing={'repo': '1'})
 
@@ -998,20 +1483,15 @@ class RepoBaseSpec(FieldProperty):
             self.set_from_obj(instance, value)
         super(RepoBaseSpec, self).__set__(instance, value)
 
-    def get_obj(self, instance, cls=None):
+    def get_obj(self, instance, cls=None, loader=None):
+        """Dereference the spec. Pass a RepoContentLoader to share
+        repositories and commits with other specs.
+
+        """
+        if loader is None:
+            loader = RepoContentLoader()
         spec = self.__get__(instance, cls)
-        app = None
-        if getattr(c, 'app', None) and spec.app_config_id == c.app.config._id:
-            app = c.app
-        else:
-            ac = AppConfig.query.get(_id=spec.app_config_id)
-            if ac:
-                App = ac.load()
-                app = App(ac.project, ac)
-        if app and getattr(app, 'repo', None):
-            ci = app.repo.commit(spec.rev)
-            if ci:
-                return ci.get_path(spec.path)
+        return loader.load([spec], lazy=False)[0]
 
 
 class RepoCommitPathSpec(RepoBaseSpec):
@@ -1067,14 +1547,19 @@ class RepoVersionSpec(RepoBaseSpec):
         'version_id': str
     })
 
-    def set_from_obj(self, instance, obj):
-        """set from a file or folder obj"""
-        value = {
+    @staticmethod
+    def value_from_obj(obj):
+        """the stored value for a file or folder obj"""
+        return {
             'app_config_id': obj.repo.app_config_id,
             'rev': obj.commit.object_id,
             'path': obj.path,
             'version_id': obj.version_id
         }
+
+    def set_from_obj(self, instance, obj):
+        """set from a file or folder obj"""
+        value = self.value_from_obj(obj)
         super(RepoVersionSpec, self).__set__(instance, value)
 
 
@@ -0,0 +1,235 @@
+"""
+Commit statistics rolled up by day, week and month.
+
+Each CommitRollup document counts the commits an author made to a repository
+within a period, and the lines they changed. They are maintained
+incrementally by `Repository.refresh`: every commit document not flagged
+`rolled_up` has yet to be rolled up. CommitAggregator answers from the
+rollups plus that tail instead of scanning every commit.
+
+Concurrent updates (and updates interrupted part way) must not count a
+commit twice, so commits are rolled up in claims:
+
+* an update claims the commits that are neither rolled up nor claimed by
+  setting their `rollup_claim` to a new ObjectId (each commit is claimed by
+  a single update),
+* the counts of the claimed commits are added to the rollups, each of which
+  records the claims added to it so that adding a claim again does nothing,
+* the claimed commits are flagged `rolled_up`.
+
+Claims older than `scm.stats.rollup_claim_timeout` seconds (600 by default)
+were interrupted, and are finished by the next update.
+
+The rollups mirror the `authored` field of the commits (with the date
+truncated to the start of the period) so that the same query and grouping
+expressions apply to both.
+
+"""
+import logging
+from datetime import datetime, timedelta
+
+import tg
+from bson import ObjectId
+from paste.deploy.converters import asint
+from ming import schema as S
+from ming.odm import FieldProperty, session
+from ming.odm.declarative import MappedClass
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from vulcanforge.common.model.session import repository_orm_session
+from vulcanforge.common.util.model import pymongo_db_collection
+
+LOG = logging.getLogger(__name__)
+
+PERIODS = ('day', 'week', 'month')
+# summed fields of the rollups
+SUMS = ('count', 'insertions', 'deletions')
+DUPLICATE_KEY = 11000
+
+
+def period_start(date, period):
+    """Start of the period containing date. Weeks start on Sunday and are
+    split at the start of the year, as with the mongo $week operator, so
+    that every date of a week has the same $year and $week.
+
+    """
+    day = datetime(date.year, date.month, date.day)
+    if period == 'day':
+        return day
+    elif period == 'week':
+        return max(day - timedelta(days=day.isoweekday() % 7),
+                   day.replace(month=1, day=1))
+    elif period == 'month':
+        return day.replace(day=1)
+    raise ValueError('Unknown period {}'.format(period))
+
+
+def claim_timeout():
+    return timedelta(seconds=asint(
+        tg.config.get('scm.stats.rollup_claim_timeout', 600)))
+
+
+class CommitRollup(MappedClass):
+    """Number of commits by an author to a repository within a period"""
+
+    class __mongometa__:
+        session = repository_orm_session
+        name = 'repo_commit_rollup'
+        unique_indexes = [(
+            'repository_id', 'period', 'authored.date', 'authored.name',
+            'authored.email')]
+        indexes = [('app_config_id', 'period', 'authored.date')]
+
+    _id = FieldProperty(S.ObjectId)
+    repository_id = FieldProperty(S.ObjectId)
+    app_config_id = FieldProperty(S.ObjectId)
+    period = FieldProperty(str)
+    authored = FieldProperty(dict(
+        name=str,
+        email=str,
+        date=datetime))
+    count = FieldProperty(int, if_missing=0)
+    # lines changed, if captured (see Repository.capture_line_stats)
+    insertions = FieldProperty(int, if_missing=0)
+    deletions = FieldProperty(int, if_missing=0)
+    # commit claims added to the counts
+    claims = FieldProperty([S.ObjectId], if_missing=[])
+
+    @classmethod
+    def tail_query(cls, repos):
+        """Query for the commits of repos that have not been rolled up"""
+        return {
+            'repository_id': {'$in': [repo._id for repo in repos]},
+            'rolled_up': {'$ne': True}
+        }
+
+    @classmethod
+    def _claim(cls, repo, query, reset=False):
+        """Claim the commits of repo matching query, returning the claim or
+        None if there are none
+
+        :param reset: roll up the commits again even if they were already
+
+        """
+        db, commits = pymongo_db_collection(repo.commit_cls)
+        claim = ObjectId()
+        fields = {'rollup_claim': claim}
+        if reset:
+            fields['rolled_up'] = False
+        result = commits.update_many(
+            dict(query, repository_id=repo._id), {'$set': fields})
+        if result.modified_count:
+            return claim
+
+    @classmethod
+    def _stale_claims(cls, repo):
+        db, commits = pymongo_db_collection(repo.commit_cls)
+        before = ObjectId.from_datetime(datetime.utcnow() - claim_timeout())
+        return commits.distinct('rollup_claim', {
+            'repository_id': repo._id,
+            'rolled_up': {'$ne': True},
+            'rollup_claim': {'$lt': before}
+        })
+
+    @classmethod
+    def _roll(cls, repo, claim):
+        """Add the commits of claim to the rollups and flag them as rolled
+        up, returning the number of commits rolled up
+
+        """
+        db, commits = pymongo_db_collection(repo.commit_cls)
+        db, rollups = pymongo_db_collection(cls)
+        query = {
+            'repository_id': repo._id,
+            'rollup_claim': claim,
+            'rolled_up': {'$ne': True}
+        }
+        rows = commits.aggregate([
+            {'$match': dict(query, **{'authored.date': {'$ne': None}})},
+            {'$group': {
+                '_id': {
+                    'year': {'$year': '$authored.date'},
+                    'month': {'$month': '$authored.date'},
+                    'day': {'$dayOfMonth': '$authored.date'},
+                    'name': '$authored.name',
+                    'email': '$authored.email'
+                },
+                'count': {'$sum': 1},
+                'insertions': {'$sum': '$line_stats.insertions'},
+                'deletions': {'$sum': '$line_stats.deletions'}
+            }}
+        ])
+        increments = {}
+        total = 0
+        for row in rows:
+            date = datetime(
+                row['_id']['year'], row['_id']['month'], row['_id']['day'])
+            for period in PERIODS:
+                key = (period, period_start(date, period),
+                       row['_id'].get('name'), row['_id'].get('email'))
+                inc = increments.setdefault(key, dict.fromkeys(SUMS, 0))
+                for field in SUMS:
+                    inc[field] += row[field]
+            total += row['count']
+        requests = []
+        for (period, date, name, email), inc in increments.iteritems():
+            # matches nothing if the claim was added already, in which case
+            # the upsert fails on the unique index
+            requests.append(UpdateOne({
+                'repository_id': repo._id,
+                'period': period,
+                'authored.date': date,
+                'authored.name': name,
+                'authored.email': email,
+                'claims': {'$ne': claim}
+            }, {
+                '$inc': inc,
+                '$push': {'claims': claim},
+                '$setOnInsert': {'app_config_id': repo.app_config_id}
+            }, upsert=True))
+        if requests:
+            try:
+                rollups.bulk_write(requests, ordered=False)
+            except BulkWriteError as err:
+                errors = err.details.get('writeErrors', [])
+                if any(e['code'] != DUPLICATE_KEY for e in errors):
+                    raise
+        commits.update_many(query, {
+            '$set': {'rolled_up': True},
+            '$unset': {'rollup_claim': ''}
+        })
+        rollups.update_many(
+            {'repository_id': repo._id, 'claims': claim},
+            {'$pull': {'claims': claim}})
+        return total
+
+    @classmethod
+    def update(cls, repo):
+        """Roll up the commits added to repo since the last update"""
+        if repo.stats_rollup_id is None:
+            return cls.rebuild(repo)
+        count = 0
+        for claim in cls._stale_claims(repo):
+            LOG.info('Finishing interrupted rollup %s of %s', claim, repo)
+            count += cls._roll(repo, claim)
+        claim = cls._claim(
+            repo, {'rolled_up': {'$ne': True}, 'rollup_claim': None})
+        if claim is not None:
+            count += cls._roll(repo, claim)
+        return count
+
+    @classmethod
+    def rebuild(cls, repo):
+        """Discard and recompute the rollups of repo"""
+        cls.query.remove({'repository_id': repo._id})
+        db, commits = pymongo_db_collection(repo.commit_cls)
+        last = list(commits.find({'repository_id': repo._id}, {'_id': 1}).sort(
+            '_id', -1).limit(1))
+        if not last:
+            return 0
+        claim = cls._claim(repo, {}, reset=True)
+        count = cls._roll(repo, claim) if claim is not None else 0
+        repo.stats_rollup_id = last[0]['_id']
+        session(repo).flush(repo)
+        LOG.info('Rolled up %d commits in %s', count, repo)
+        return count
@@ -0,0 +1,90 @@
+"""
+Flattened snapshots of a whole repository tree, used to traverse it (walk,
+find_files, ...) without a call to the underlying repository per folder.
+
+Entries are kept in parallel arrays ordered by path. Paths are absolute and
+folder paths end with a slash, as with RepositoryFolder.
+
+"""
+import bisect
+
+FILE, DIR = 'f', 'd'
+
+
+def normalize_path(path, kind):
+    if path.startswith('//'):
+        path = path[1:]
+    if not path.startswith('/'):
+        path = '/' + path
+    if kind == DIR and not path.endswith('/'):
+        path += '/'
+    return path
+
+
+def parent_path(path):
+    return path[:path.rstrip('/').rfind('/') + 1]
+
+
+class TreeSnapshot(object):
+    """Paths and kinds of every file and folder of a tree, ordered by path.
+    Subclasses add the arrays of the other fields they need.
+
+    """
+
+    def __init__(self, paths, kinds):
+        self.paths = paths
+        self.kinds = kinds
+        self._index = None
+        self._children = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = dict((p, i) for i, p in enumerate(self.paths))
+        return self._index
+
+    def find(self, path):
+        """Index of the file or folder at path, or None"""
+        i = self.index.get(path)
+        if i is None and not path.endswith('/'):
+            i = self.index.get(path + '/')
+        return i
+
+    def is_dir(self, i):
+        return self.kinds[i] == DIR
+
+    def children(self, folder):
+        """Indexes of the entries directly in folder"""
+        if self._children is None:
+            self._children = {}
+            for i, path in enumerate(self.paths):
+                if path != '/':
+                    self._children.setdefault(
+                        parent_path(path), []).append(i)
+        return self._children.get(folder, [])
+
+    def descendants(self, folder):
+        """Indexes of the entries beneath folder, ordered by path"""
+        start = bisect.bisect_right(self.paths, folder)
+        end = bisect.bisect_left(self.paths, folder + u'\uffff')
+        return xrange(start, end)
+
+    def walk(self, folder, ignore=()):
+        """Indexes of the entries beneath folder, breadth first (as
+        RepositoryFolder.walk), skipping those with a name in ignore and
+        their contents
+
+        """
+        entries = []
+        for i in self.descendants(folder):
+            names = self.paths[i][len(folder):].rstrip('/').split('/')
+            if not any(name in ignore for name in names):
+                entries.append((len(names), self.paths[i], i))
+        return [i for _, _, i in sorted(entries)]
+
+    def files(self, folder):
+        """Indexes of the files beneath folder, ordered by path"""
+        return [i for i in self.descendants(folder) if not self.is_dir(i)]
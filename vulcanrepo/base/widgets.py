@@ -11,6 +11,8 @@ from vulcanforge.resources.widgets import JSLink, CSSLink
 from vulcanforge.auth.model import User
 from vulcanforge.auth.widgets import Avatar
 
+from vulcanrepo import instrument
+
 TEMPLATE_DIR = 'jinja:vulcanrepo.base:templates/widgets/'
 
 
@@ -85,36 +87,100 @@ class CommitAuthorWidget(ew_core.Widget):
         if value.get('author_email'):
             if g.cache:
                 cache_key = self.cache_key(kwargs={'size': size})
-                cache_name = self.cache_name.format(
-                    email=value['author_email'])
+                cache_name = self.author_cache_name(value)
                 author_content = g.cache.hget(cache_name, cache_key)
+                instrument.incr('cache.commit_author.{}'.format(
+                    'hit' if author_content else 'miss'))
                 if author_content:
                     return Markup(author_content)
 
+            user = None
             if load_user:
                 user = User.by_email_address(value['author_email'])
-                if user:
-                    author_content = self.avatar_widget.display(
-                        user=user, size=size, compact=True)
-            if not author_content:
-                try:
-                    EmailValidator().to_python(value['author_email'], None)
-                except Invalid:
-                    return ''
-                author_content = (
-                    '<img class="emboss x{size}" src="{src}" '
-                    'alt="{author}" title="{author}" />').format(
-                    src=g.user_or_gravatar(value['author_email'], size=size),
-                    author=cgi.escape(value['author_name']),
-                    size=size
-                )
-
-            if load_user and g.cache:
+            author_content = self.render(value, size=size, user=user)
+
+            if load_user and g.cache and author_content:
                 g.cache.hset(cache_name, cache_key, author_content)
         elif value.get('author_name'):
             author_content = cgi.escape(value['author_name'])
         return Markup(author_content)
 
+    def render(self, value, size=16, user=None):
+        if user:
+            return self.avatar_widget.display(
+                user=user, size=size, compact=True)
+        try:
+            EmailValidator().to_python(value['author_email'], None)
+        except Invalid:
+            return ''
+        return (
+            '<img class="emboss x{size}" src="{src}" '
+            'alt="{author}" title="{author}" />').format(
+            src=g.user_or_gravatar(value['author_email'], size=size),
+            author=cgi.escape(value['author_name']),
+            size=size
+        )
+
+    def author_id(self, value):
+        return value.get('author_email') or value.get('author_name')
+
+    def author_cache_name(self, value):
+        if value.get('author_email'):
+            return self.cache_name.format(email=value['author_email'])
+
+    def get_cached(self, values, size=16):
+        """Cached avatars for values (keyed by author_id), fetched in one
+        round trip
+
+        """
+        cached = {}
+        if not g.cache:
+            return cached
+        cache_key = self.cache_key(kwargs={'size': size})
+        names = [(self.author_id(value), self.author_cache_name(value))
+                 for value in values]
+        names = [(author, name) for author, name in names if name]
+        pipeline = g.cache.redis.pipeline(transaction=False)
+        for author, name in names:
+            pipeline.hget(name, cache_key)
+        for (author, name), content in zip(names, pipeline.execute()):
+            if content:
+                cached[author] = content.decode('utf-8')
+        instrument.incr('cache.commit_author.hit', len(cached))
+        instrument.incr('cache.commit_author.miss', len(names) - len(cached))
+        return cached
+
+    def render_many(self, values, size=16, **kw):
+        """Render the authors of values that were not cached, keyed by
+        author_id
+
+        """
+        rendered = {}
+        for value in values:
+            if value.get('author_email'):
+                author_content = self.render(value, size=size)
+            else:
+                author_content = cgi.escape(value.get('author_name') or '')
+            rendered[self.author_id(value)] = author_content
+        return rendered
+
+    def display_many(self, values, size=16, **kw):
+        """Render the author of each of many commit infos, returning a dict
+        keyed by commit id. Each distinct author is rendered only once.
+
+        """
+        authors = {}
+        for value in values:
+            authors.setdefault(self.author_id(value), value)
+        rendered = self.get_cached(authors.values(), size=size)
+        missing = [value for author, value in authors.iteritems()
+                   if author not in rendered]
+        if missing:
+            rendered.update(self.render_many(missing, size=size, **kw))
+        return dict(
+            (value['id'], Markup(rendered.get(self.author_id(value)) or ''))
+            for value in values)
+
 
 class SCMCommitBrowserWidget(ew_core.Widget):
     template = TEMPLATE_DIR + 'commit_browser.html'
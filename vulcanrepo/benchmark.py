@@ -0,0 +1,362 @@
+"""
+Benchmark suite for the repository hot paths.
+
+Synthetic git and svn repositories of a configurable size are generated on
+the local filesystem using the `git`, `svn` and `svnadmin` executables, wrapped
+in throwaway Repository documents and then exercised through the same model
+methods used by the web application and the refresh task.
+
+Results are emitted as JSON so that runs against different revisions of the
+code can be compared to catch performance regressions. See the
+`repo_benchmark` paster command.
+
+The benchmark writes to whatever database the ini file points at, so it
+should be run against a scratch mongod (or another local stand-in).
+
+"""
+import os
+import json
+import time
+import random
+import shutil
+import string
+import logging
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+from ming.odm import ThreadLocalODMSession
+
+from vulcanrepo.base.model import CommitRollup, CommitIndex
+from vulcanrepo.stats import CommitAggregator
+
+LOG = logging.getLogger(__name__)
+
+
+class SyntheticRepoSpec(object):
+    """Describes the shape of a generated repository"""
+
+    def __init__(self, commits=100, files=100, blob_size=1024, folders=10,
+                 changes=5, seed=0):
+        """
+        :param commits: number of commits to generate
+        :param files: number of files in each tree
+        :param blob_size: size of each file, in bytes
+        :param folders: number of folders the files are spread across
+        :param changes: number of files modified by each commit after the
+            first
+        :param seed: random seed, so that runs are reproducible
+
+        """
+        self.commits = commits
+        self.files = files
+        self.blob_size = blob_size
+        self.folders = max(folders, 1)
+        self.changes = changes
+        self.seed = seed
+
+    def __json__(self):
+        return {
+            'commits': self.commits,
+            'files': self.files,
+            'blob_size': self.blob_size,
+            'folders': self.folders,
+            'changes': self.changes,
+            'seed': self.seed
+        }
+
+    def file_paths(self):
+        """Relative paths of the files in each tree"""
+        paths = []
+        for i in range(self.files):
+            folder = i % self.folders
+            paths.append(os.path.join(
+                'folder{}'.format(folder),
+                'sub{}'.format(folder % 3),
+                'file{}.txt'.format(i)))
+        return paths
+
+    def content(self, rand):
+        chars = string.ascii_letters + string.digits + '\n'
+        return ''.join(rand.choice(chars) for _ in xrange(self.blob_size))
+
+    def populate(self, work_dir, commit_fn):
+        """Write the trees to work_dir, calling commit_fn(message) after
+        each revision of the working copy.
+
+        """
+        rand = random.Random(self.seed)
+        paths = self.file_paths()
+        for i in range(self.commits):
+            if i == 0:
+                to_write = paths
+            else:
+                to_write = rand.sample(paths, min(self.changes, len(paths)))
+            for path in to_write:
+                full_path = os.path.join(work_dir, path)
+                dirname = os.path.dirname(full_path)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                with open(full_path, 'w') as fp:
+                    fp.write(self.content(rand))
+            commit_fn('Synthetic commit {}'.format(i))
+
+
+def _run(args, cwd=None, env=None):
+    full_env = os.environ.copy()
+    if env:
+        full_env.update(env)
+    subprocess.check_output(args, cwd=cwd, env=full_env,
+                            stderr=subprocess.STDOUT)
+
+
+def build_git_repo(path, spec):
+    """Generate a bare git repository at path"""
+    work_dir = tempfile.mkdtemp(prefix='vulcanrepo-bench-')
+    env = {
+        'GIT_AUTHOR_NAME': 'Benchmark',
+        'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+        'GIT_COMMITTER_NAME': 'Benchmark',
+        'GIT_COMMITTER_EMAIL': 'benchmark@example.com'
+    }
+    try:
+        _run(['git', 'init', '-q', work_dir])
+
+        def commit(message):
+            _run(['git', 'add', '-A'], cwd=work_dir, env=env)
+            _run(['git', 'commit', '-q', '-m', message], cwd=work_dir, env=env)
+
+        spec.populate(work_dir, commit)
+        _run(['git', 'clone', '-q', '--bare', work_dir, path])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def build_svn_repo(path, spec):
+    """Generate an svn repository at path"""
+    work_dir = tempfile.mkdtemp(prefix='vulcanrepo-bench-')
+    try:
+        _run(['svnadmin', 'create', path])
+        _run(['svn', 'checkout', '-q', 'file://' + path, work_dir])
+
+        def commit(message):
+            _run(['svn', 'add', '-q', '--force', '.'], cwd=work_dir)
+            _run(['svn', 'commit', '-q', '-m', message, '--username',
+                  'benchmark'], cwd=work_dir)
+
+        spec.populate(work_dir, commit)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class RepoBenchmark(object):
+    """Times the hot paths of a single synthetic repository.
+
+    :param repo_cls: Repository subclass to benchmark
+    :param spec: SyntheticRepoSpec
+    :param rounds: number of times each operation is timed
+    :param downloads: number of files read for the raw download benchmark
+
+    """
+    builders = {
+        'git': build_git_repo,
+        'svn': build_svn_repo
+    }
+
+    def __init__(self, repo_cls, spec, rounds=3, downloads=20):
+        self.repo_cls = repo_cls
+        self.spec = spec
+        self.rounds = rounds
+        self.downloads = downloads
+        self.results = {}
+        self.repo = None
+        self.fs_path = None
+
+    def setup(self):
+        self.fs_path = tempfile.mkdtemp(prefix='vulcanrepo-bench-') + '/'
+        name = 'benchmark-{}'.format(int(time.time()))
+        if self.repo_cls.repo_id == 'git':
+            name += '.git'
+        LOG.info('Generating %s repository with %d commits',
+                 self.repo_cls.repo_id, self.spec.commits)
+        self.builders[self.repo_cls.repo_id](
+            os.path.join(self.fs_path, name), self.spec)
+        self.repo = self.repo_cls(
+            name=name,
+            tool=self.repo_cls.repo_id,
+            fs_path=self.fs_path,
+            status='ready',
+            post_commit_hooks=[])
+        ThreadLocalODMSession.flush_all()
+
+    def teardown(self):
+        if self.repo is not None:
+            self.repo_cls.commit_cls.query.remove({
+                'repository_id': self.repo._id})
+            CommitRollup.query.remove({'repository_id': self.repo._id})
+            CommitIndex.remove_repo(self.repo)
+            self.repo_cls.query.remove({'_id': self.repo._id})
+        if self.fs_path:
+            shutil.rmtree(self.fs_path, ignore_errors=True)
+
+    def time(self, name, func, before=None):
+        """Time func over self.rounds rounds, calling before (untimed) prior
+        to each round.
+
+        """
+        timings = []
+        for i in range(self.rounds):
+            if before is not None:
+                before()
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+            ThreadLocalODMSession.flush_all()
+            ThreadLocalODMSession.close_all()
+        self.results[name] = {
+            'min': min(timings),
+            'max': max(timings),
+            'mean': sum(timings) / len(timings),
+            'rounds': len(timings)
+        }
+        LOG.info('%s: %.4fs', name, self.results[name]['min'])
+        return self.results[name]
+
+    def _repo(self):
+        """Fresh copy of the repository, as sessions are closed between
+        rounds
+
+        """
+        return self.repo_cls.query.get(_id=self.repo._id)
+
+    def _latest(self):
+        repo = self._repo()
+        if repo.repo_id == 'git':
+            return repo.latest('master')
+        return repo.latest()
+
+    def _clear_commits(self):
+        self.repo_cls.commit_cls.query.remove({
+            'repository_id': self.repo._id})
+        CommitRollup.query.remove({'repository_id': self.repo._id})
+        CommitIndex.remove_repo(self.repo)
+        self.repo_cls.query.update(
+            {'_id': self.repo._id},
+            {'$set': {'stats_rollup_id': None, 'refresh_checkpoint': None}})
+
+    def _refresh(self):
+        self._repo().refresh(
+            notify=False, with_hooks=False, update_status=False)
+
+    def bench_refresh(self):
+        self.time('refresh', self._refresh, before=self._clear_commits)
+
+    def bench_index_commits(self):
+        def index_commits():
+            repo = self._repo()
+            repo.index_artifacts(repo._unindexed_commits(0))
+        self.time('index_commits', index_commits)
+
+    def bench_new_commits(self):
+        self.time('new_commits', lambda: self._repo().new_commits())
+        self.time('new_commits.all',
+                  lambda: self._repo().new_commits(all_commits=True))
+
+    def bench_ls_commits(self):
+        def ls_commits():
+            self._latest().tree.ls_commits(include_self=True)
+        self.time('ls_commits', ls_commits)
+
+    def bench_find_files(self):
+        def find_files():
+            list(self._latest().tree.find_files())
+        self.time('find_files', find_files)
+
+    def bench_raw_download(self):
+        paths = self.spec.file_paths()[:self.downloads]
+
+        def download():
+            ci = self._latest()
+            for path in paths:
+                for chunk in ci.get_path('/' + path).open():
+                    pass
+        self.time('raw_download', download)
+
+    def bench_commit_aggregate(self):
+        for bins in (['daily'], ['user']):
+            for use_rollups in (True, False):
+                def aggregate():
+                    agg = CommitAggregator(
+                        repo=self._repo(), bins=bins, use_rollups=use_rollups)
+                    agg.run()
+                name = 'commit_aggregate.' + '.'.join(bins)
+                if not use_rollups:
+                    name += '.raw'
+                self.time(name, aggregate)
+
+    def run(self):
+        self.setup()
+        try:
+            self.bench_refresh()
+            self.bench_index_commits()
+            self.bench_new_commits()
+            self.bench_ls_commits()
+            self.bench_find_files()
+            self.bench_raw_download()
+            self.bench_commit_aggregate()
+        finally:
+            self.teardown()
+        return self.results
+
+
+def run_benchmarks(repo_classes, spec, rounds=3, downloads=20):
+    """Run the benchmark suite against each Repository class and return a
+    JSON-serializable results dictionary.
+
+    """
+    results = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'spec': spec.__json__(),
+            'rounds': rounds
+        },
+        'results': {}
+    }
+    for repo_cls in repo_classes:
+        bench = RepoBenchmark(repo_cls, spec, rounds, downloads)
+        for name, timing in bench.run().iteritems():
+            key = '{}.{}'.format(repo_cls.repo_id, name)
+            results['results'][key] = timing
+    return results
+
+
+def compare_results(current, baseline, threshold=0.2):
+    """Compare two results dictionaries, returning a list of
+    (name, baseline_min, current_min, ratio) for each benchmark that got
+    slower by more than threshold (a fraction).
+
+    The fastest round is compared, as it is the least sensitive to noise.
+
+    """
+    regressions = []
+    for name, timing in sorted(current['results'].iteritems()):
+        base = baseline['results'].get(name)
+        if not base or not base['min']:
+            continue
+        ratio = timing['min'] / base['min']
+        if ratio > 1 + threshold:
+            regressions.append((name, base['min'], timing['min'], ratio))
+    return regressions
+
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def dump_results(results, path):
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
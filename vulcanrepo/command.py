@@ -8,7 +8,9 @@ from vulcanforge.neighborhood.model import Neighborhood
 from vulcanforge.visualize.model import VisualizerConfig
 from vulcanforge.project.model import AppConfig
 
-from vulcanrepo.base.model import PostCommitHook
+from vulcanrepo import benchmark, instrument
+from vulcanrepo.base import last_commits
+from vulcanrepo.base.model import PostCommitHook, CommitDigest
 from vulcanrepo.base.model.hook import VisualizerManager
 from vulcanrepo.git.model import GitRepository
 from vulcanrepo.svn.model import SVNRepository
@@ -137,10 +139,15 @@ def clear_caches():
         q = {'tool_name': {'$in': repo_tool_names}}
         repos = [str(x._id) for x in AppConfig.query.find(q)]
         for r in repos:
-            keys = [x for x in g.cache.redis.keys(r + ".*")
-                    if 'tree_json' in g.cache.redis.hkeys(x)]
-            for k in keys:
-                g.cache.redis.hdel(k, 'tree_json')
+            for k in g.cache.redis.keys(r + ".*"):
+                if last_commits.is_pending_key(k):
+                    g.cache.redis.delete(k)
+                    continue
+                fields = [f for f in g.cache.redis.hkeys(k)
+                          if f == 'tree_json' or
+                          last_commits.is_cache_field(f)]
+                if fields:
+                    g.cache.redis.hdel(k, *fields)
 
 
 class ClearRepoCaches(base.Command):
@@ -183,3 +190,124 @@ class EnsureDefaultRepoHooks(base.Command):
         self.basic_setup()
         ensure_hooks()
         ThreadLocalODMSession.flush_all()
+
+
+def send_digests():
+    """Queue the commit digests whose window has ended"""
+    count = 0
+    for digest in CommitDigest.overdue():
+        with g.context_manager.push(app_config_id=digest.app_config_id):
+            if c.app and c.app.repo:
+                c.app.repo.send_commit_digest.post()
+                count += 1
+    return count
+
+
+class SendRepoDigests(base.Command):
+
+    min_args = 1
+    max_args = 1
+
+    usage = "ini_file"
+    summary = "Send overdue repository commit digests (run periodically)"
+
+    parser = base.Command.standard_parser(verbose=True)
+
+    def command(self):
+        self.basic_setup()
+        self.log.info('Queued %d commit digests', send_digests())
+        ThreadLocalODMSession.flush_all()
+
+
+class RepoBenchmark(base.Command):
+    summary = ('Benchmark repository refresh, browse and download on '
+               'generated repositories')
+    usage = '<ini file> [options] <project_shortname>.<repo_mount_point>'
+    min_args = 2
+    max_args = 2
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option(
+        '-n', '--neighborhood', dest='neighborhood',
+        help='url_prefix of neighborhood')
+    parser.add_option(
+        '-k', '--kind', dest='kind', default='git,svn',
+        help='comma separated repository kinds to benchmark (git,svn)')
+    parser.add_option(
+        '--commits', dest='commits', type='int', default=100,
+        help='number of commits to generate')
+    parser.add_option(
+        '--files', dest='files', type='int', default=100,
+        help='number of files per tree')
+    parser.add_option(
+        '--folders', dest='folders', type='int', default=10,
+        help='number of folders the files are spread across')
+    parser.add_option(
+        '--blob-size', dest='blob_size', type='int', default=1024,
+        help='size of each file in bytes')
+    parser.add_option(
+        '--changes', dest='changes', type='int', default=5,
+        help='number of files modified per commit')
+    parser.add_option(
+        '--rounds', dest='rounds', type='int', default=3,
+        help='number of timed rounds per benchmark')
+    parser.add_option(
+        '-o', '--output', dest='output', default=None,
+        help='write JSON results to this file')
+    parser.add_option(
+        '-b', '--baseline', dest='baseline', default=None,
+        help='JSON results of a previous run to compare against')
+    parser.add_option(
+        '-t', '--threshold', dest='threshold', type='float', default=0.2,
+        help='fractional slowdown reported as a regression')
+
+    def command(self):
+        """The repository tool given provides the project and app context
+        for the generated repositories, which are removed afterwards.
+
+        """
+        # before basic_setup creates the mongo clients
+        instrument.install_mongo_listener()
+        self.basic_setup()
+        if self.options.neighborhood:
+            neighborhood = Neighborhood.by_prefix(self.options.neighborhood)
+        else:
+            neighborhood = None
+        shortname, mount_point = self.args[1].split('.')
+        g.context_manager.set(shortname, mount_point,
+                              neighborhood=neighborhood)
+        if not c.app:
+            raise RuntimeError(
+                "Tool at {}.{} not found".format(shortname, mount_point))
+
+        repo_classes = []
+        for kind in self.options.kind.split(','):
+            if kind == 'git':
+                repo_classes.append(GitRepository)
+            elif kind == 'svn':
+                repo_classes.append(SVNRepository)
+            else:
+                raise RuntimeError('Unknown repository kind {}'.format(kind))
+
+        spec = benchmark.SyntheticRepoSpec(
+            commits=self.options.commits,
+            files=self.options.files,
+            blob_size=self.options.blob_size,
+            folders=self.options.folders,
+            changes=self.options.changes)
+        results = benchmark.run_benchmarks(
+            repo_classes, spec, rounds=self.options.rounds)
+        if self.options.output:
+            benchmark.dump_results(results, self.options.output)
+        for name, timing in sorted(results['results'].iteritems()):
+            print '{:<40} {:>10.4f}s'.format(name, timing['min'])
+
+        if self.options.baseline:
+            regressions = benchmark.compare_results(
+                results,
+                benchmark.load_results(self.options.baseline),
+                self.options.threshold)
+            for name, before, after, ratio in regressions:
+                print 'REGRESSION {}: {:.4f}s -> {:.4f}s ({:.0%})'.format(
+                    name, before, after, ratio - 1)
+            if regressions:
+                return 1
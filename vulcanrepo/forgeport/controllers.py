@@ -1,12 +1,14 @@
-import os
+import calendar
 
 from bson import ObjectId
 from pylons import app_globals as g
 from tg.decorators import expose
+from vulcanforge.auth.model import User
 from vulcanforge.common.controllers import BaseController
 from vulcanforge.project.model import AppConfig
 
 from vulcanrepo.forgeport.model import ForgeProjectFile
+from vulcanrepo.svn.model import SVNRepository
 
 
 class ForgePortRestController(BaseController):
@@ -14,29 +16,23 @@ class ForgePortRestController(BaseController):
     def _check_security(self):
         g.security.require_authenticated()
 
-    def projects_for_app_config(self, app_config):
-        """Get ForgePort Projects (not VF Projects) for a given app config"""
-        repo = app_config.instantiate().repo
-        ci = repo.latest()
+    def projects_for_app_config(self, app_config, repo, forge_projects,
+                                users):
+        """Get ForgePort Projects (not VF Projects) for a given app config,
+        from the catalog maintained by the ForgePortHook
 
-        # find design projects
+        """
         owner_map = {}
-        dp_query = {"app_config_id": app_config._id}
-        for forge_project in ForgeProjectFile.query.find(dp_query):
-            parent_path = os.path.dirname(forge_project.blob_spec.path) + '/'
-            parent_dir = ci.get_path(parent_path)
-            if not parent_dir:
-                continue
-
+        for forge_project in forge_projects:
+            last_modified = forge_project.last_modified
             project_spec = {
                 "name": forge_project.display_name,
-                "svnUrl": repo.clone_url('https') + os.path.dirname(
-                    forge_project.path),
-                "lastModified": int(parent_dir.get_timestamp())
+                "svnUrl": repo.clone_url('https') + forge_project.folder_path,
+                "lastModified": calendar.timegm(last_modified.utctimetuple())
             }
             creator_id = forge_project.creator_id
             if creator_id not in owner_map:
-                creator = forge_project.creator
+                creator = users.get(creator_id)
                 if creator:
                     username = creator.username
                     display_name = creator.display_name
@@ -74,8 +70,28 @@ class ForgePortRestController(BaseController):
 
         team_map = {}
         ac_ids = [ObjectId(d["app_config_id_s"]) for d in repo_result.docs]
+        repos = dict((repo.app_config_id, repo) for repo in
+                     SVNRepository.query.find({"app_config_id": {
+                         "$in": ac_ids}}))
+        forge_projects = {}
+        # forge projects whose folder was missing when the catalog was
+        # built have no last_modified (see ForgeProjectFile.update_catalog)
+        for forge_project in ForgeProjectFile.query.find({
+                "app_config_id": {"$in": ac_ids},
+                "last_modified": {"$ne": None}}):
+            forge_projects.setdefault(
+                forge_project.app_config_id, []).append(forge_project)
+        creator_ids = set(
+            forge_project.creator_id
+            for ac_forge_projects in forge_projects.values()
+            for forge_project in ac_forge_projects)
+        users = dict((user._id, user) for user in User.query.find({
+            "_id": {"$in": list(creator_ids)}}))
         for ac in AppConfig.query.find({"_id": {"$in": ac_ids}}):
-            repo_spec = self.projects_for_app_config(ac)
+            if ac._id not in repos:
+                continue
+            repo_spec = self.projects_for_app_config(
+                ac, repos[ac._id], forge_projects.get(ac._id, []), users)
 
             if ac.project_id not in team_map:
                 team_map[ac.project_id] = {
@@ -1,17 +1,19 @@
-from vulcanrepo.base.model.hook import CommitPlugin
+import posixpath
+
+from vulcanrepo.base.model.hook import MultiCommitPlugin
 from vulcanrepo.forgeport.model import ForgeProjectFile
 
 
-class ForgePortHook(CommitPlugin):
+class ForgePortHook(MultiCommitPlugin):
     description = u"Tracks .forgeproject.manifest.json files for forge port"
     FILENAME = '.forgeproject.manifest.json'
 
-    def on_submit(self, commit):
-        for blob in commit.files_added:
-            if blob.name == self.FILENAME:
-                ForgeProjectFile.from_blob(blob)
-        for blob in commit.files_removed:
-            if blob.name == self.FILENAME:
-                forge_project = ForgeProjectFile.get_from_blob(blob)
-                if forge_project:
-                    forge_project.delete()
\ No newline at end of file
+    def is_manifest(self, path):
+        return posixpath.basename(path) == self.FILENAME
+
+    def on_submit(self, commits):
+        if commits:
+            repo = commits[0].repo
+            ForgeProjectFile.sync_from_commits(
+                repo, commits, self.is_manifest)
+            ForgeProjectFile.update_catalog(repo, commits)
@@ -1,9 +1,16 @@
 import json
+import posixpath
+from datetime import datetime
 
 from ming.odm import FieldProperty
 from ming.odm.property import ForeignIdProperty
+from pymongo import DeleteMany, UpdateOne
+from vulcanforge.common.util.model import pymongo_db_collection
 
-from vulcanrepo.base.model.derived import RepoDerivedObject
+from vulcanrepo.base.model.derived import (
+    DerivedObjectSynchronizer,
+    RepoDerivedObject
+)
 from vulcanforge.auth.model import User
 
 
@@ -19,9 +26,62 @@ class ForgeProjectFile(RepoDerivedObject):
             ('blob_spec.app_config_id', 'blob_spec.path',
              'blob_spec.version_id')
         ]
+        unique_indexes = [('blob_spec.app_config_id', 'blob_spec.path')]
 
     name = FieldProperty(str, if_missing=None)
     creator_id = ForeignIdProperty(User, if_missing=None)
+    # last change to the project folder (see update_catalog)
+    last_modified = FieldProperty(datetime, if_missing=None)
+
+    @classmethod
+    def update_catalog(cls, repo, commits):
+        """Record the last time commits changed the folder of each forge
+        project of repo, so that listing them does not read the repository,
+        and drop the forge projects whose folder they removed
+
+        """
+        folders = {}
+        for forge_project in cls.query.find({
+                'blob_spec.app_config_id': repo.app_config_id}):
+            folders.setdefault(forge_project.folder_path, []).append(
+                forge_project._id)
+        if not folders:
+            return
+        modified, removed = {}, set()
+        for commit in DerivedObjectSynchronizer.oldest_first(commits):
+            diffs = commit.diffs
+            paths = diffs.added + diffs.changed + diffs.removed + \
+                [copied['new'] for copied in diffs.copied]
+            gone = [path for path in diffs.removed if path.endswith('/')]
+            gone.extend(
+                copied['old'] for copied in diffs.copied
+                if copied['old'].endswith('/') and
+                commit.get_path(copied['old']) is None)
+            for folder in folders:
+                prefix = folder.rstrip('/') + '/'
+                if any(prefix.startswith(path) for path in gone):
+                    removed.add(folder)
+                elif any(path.startswith(prefix) for path in paths):
+                    removed.discard(folder)
+                    date = commit.committed.date
+                    if folder not in modified or modified[folder] < date:
+                        modified[folder] = date
+        ops = [
+            UpdateOne({'_id': _id}, {'$max': {'last_modified': last_date}})
+            for folder, last_date in modified.iteritems()
+            if folder not in removed
+            for _id in folders[folder]]
+        removed_ids = [
+            _id for folder in removed for _id in folders[folder]]
+        if removed_ids:
+            ops.append(DeleteMany({'_id': {'$in': removed_ids}}))
+        if ops:
+            db, coll = pymongo_db_collection(cls)
+            coll.bulk_write(ops, ordered=False)
+
+    @property
+    def folder_path(self):
+        return posixpath.dirname(self.blob_spec.path)
 
     @property
     def creator(self):
@@ -44,4 +104,5 @@ class ForgeProjectFile(RepoDerivedObject):
         if self.name:
             return self.name
         else:
-            return self.blob.parent.name
+            # name of the containing folder, without reading the repository
+            return posixpath.basename(self.folder_path)
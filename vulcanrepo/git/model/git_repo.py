@@ -24,18 +24,47 @@ from vulcanforge.cache.decorators import cache_str
 from vulcanforge.artifact.model import VersionedArtifact
 from vulcanforge.auth.model import User
 
+from vulcanrepo import instrument
 from vulcanrepo.base.model import (
     RepositoryFile,
     RepositoryFolder,
     Commit,
-    Repository
+    Repository,
+    CommitIndex,
+    CommitCopier
 )
+from vulcanrepo.base.model.snapshot import DIR, normalize_path
+from .refs import (
+    ABBREV_CACHE,
+    ABBREV_RE,
+    SHA_RE,
+    ref_map,
+    refs_key,
+    split_ref
+)
+from .tree import GitTree
 
 LOG = logging.getLogger(__name__)
 GIT_ADD_SCRIPT = os.path.join(
     __file__, os.path.pardir, 'scripts/git-commit-to-bare.bash')
 
 
+if git is not None:
+    class InstrumentedGit(git.cmd.Git):
+        """Times each git subprocess call"""
+
+        def execute(self, command, *args, **kwargs):
+            name = 'git.subprocess'
+            if isinstance(command, (list, tuple)) and len(command) > 1:
+                name = 'git.' + command[1]
+            with instrument.timer(name, command):
+                return super(InstrumentedGit, self).execute(
+                    command, *args, **kwargs)
+
+    class InstrumentedRepo(git.Repo):
+        GitCommandWrapperType = InstrumentedGit
+
+
 def make_content_object(obj, ci):
     """Makes a GitFile or GitFolder object
 
@@ -54,12 +83,29 @@ def make_content_object(obj, ci):
     return result
 
 
+def make_snapshot_object(tree, i, ci):
+    """Makes a GitFile or GitFolder object from entry i of a GitTree
+
+    :param tree GitTree
+    :param i int
+    :param ci GitCommit
+    :return GitFile || GitFolder
+
+    """
+    content_cls = GitFolder if tree.is_dir(i) else GitFile
+    result = content_cls(ci, tree.paths[i])
+    result._oid = tree.object_ids[i]
+    result._size = tree.sizes[i]
+    return result
+
+
 class GitCommit(Commit):
 
     class __mongometa__:
         name = 'git_commit'
         indexes = [('parent_ids', 'repository_id'),
-                   ("committed.date", pymongo.DESCENDING)]
+                   ("committed.date", pymongo.DESCENDING),
+                   ('app_config_id', 'authored.date')]
 
     parent_ids = FieldProperty([str])
     committed = FieldProperty(dict(
@@ -119,6 +165,28 @@ class GitCommit(Commit):
     def tree(self):
         return GitFolder(self, '/')
 
+    @LazyProperty
+    def tree_id(self):
+        return self._obj.tree.hexsha
+
+    @LazyProperty
+    def snapshot(self):
+        """Flattened tree of the commit, shared by the traversals of its
+        tree (see GitTree)
+
+        """
+        return GitTree.load(self.repo.git_repo, self.tree_id)
+
+    @property
+    def has_snapshot(self):
+        return 'snapshot' in self.__dict__
+
+    def snapshot_object(self, path):
+        """Content object at path from the snapshot (None if missing)"""
+        i = self.snapshot.find(path)
+        if i is not None:
+            return make_snapshot_object(self.snapshot, i, self)
+
     def get_obj_from_path(self, path):
         path = path.strip('/')
 
@@ -136,6 +204,8 @@ class GitCommit(Commit):
         if path == '/':
             return self.tree
 
+        if verify and self.has_snapshot:
+            return self.snapshot_object(path)
         if verify:
             obj = self.get_obj_from_path(path)
             if obj:
@@ -143,26 +213,59 @@ class GitCommit(Commit):
         else:
             return GitFile(self, path)
 
+    @staticmethod
+    def _snapshot_files(tree, i, ci, paths, files):
+        """Add the files at (or beneath) entry i of tree to files"""
+        indexes = tree.files(tree.paths[i]) if tree.is_dir(i) else [i]
+        for j in indexes:
+            if tree.paths[j] not in paths:
+                paths.add(tree.paths[j])
+                files.append(make_snapshot_object(tree, j, ci))
+
+    @property
+    def files_added(self):
+        paths = sorted(self.paths_added)
+        # git lists added files, except for the folders of copies (and
+        # every file of a root commit, as cheap to list with the snapshot)
+        if not (self.has_snapshot or not self.parent_ids or
+                any(path.endswith('/') for path in paths)):
+            return [self.get_path(path, verify=False) for path in paths]
+        added = []
+        added_paths = set()
+        tree = self.snapshot
+        for path in paths:
+            i = tree.find(path)
+            if i is not None:
+                self._snapshot_files(tree, i, self, added_paths, added)
+        return added
+
     @property
     def files_removed(self):
         """NOTE: returned with context of parent commit"""
         removed = []
         removed_paths = set()
         for path in self.diffs.removed:
-            if path not in removed_paths:
-                removed_paths.add(path)
-                obj = None
-                for parent in self.parents:
-                    obj = parent.get_path(path)
-                    if obj:
+            if path in removed_paths:
+                continue
+            for parent in self.parents:
+                if parent.has_snapshot:
+                    i = parent.snapshot.find(path)
+                    if i is not None:
+                        self._snapshot_files(
+                            parent.snapshot, i, parent, removed_paths,
+                            removed)
                         break
-                if obj.kind == 'File':
-                    removed.append(obj)
-                else:
-                    for child in obj.find_files():
-                        if child.path not in removed_paths:
-                            removed.append(child)
-                            removed_paths.add(child.path)
+                    continue
+                # look the path up alone, listing only a removed folder
+                obj = parent.get_path(path)
+                if obj is None:
+                    continue
+                files = [obj] if obj.kind == 'File' else obj.find_files()
+                for f in files:
+                    if f.path not in removed_paths:
+                        removed_paths.add(f.path)
+                        removed.append(f)
+                break
         return removed
 
     def branches(self):
@@ -178,6 +281,8 @@ class GitRepository(Repository):
 
     tool_name = 'Git'
     repo_id = 'git'
+    supports_parallel_refresh = True
+    client_attrs = ('git_repo',)
     type_s = 'Git Repository'
     url_map = {
         'ro': 'http://{host}{path}',
@@ -211,7 +316,7 @@ class GitRepository(Repository):
     @LazyProperty
     def git_repo(self):
         try:
-            return git.Repo(self.full_fs_path)
+            return InstrumentedRepo(self.full_fs_path)
         except (git.exc.NoSuchPathError,
                 git.exc.InvalidGitRepositoryError), err:  # pragma no cover
             LOG.error('Problem looking up repo: %r', err)
@@ -222,23 +327,32 @@ class GitRepository(Repository):
         LOG.info('git init %s', fullname)
         if os.path.exists(fullname):
             shutil.rmtree(fullname)
-        repo = git.Repo.init(
+        repo = InstrumentedRepo.init(
             path=fullname, mkdir=True, quiet=True, bare=True, shared='all')
         self.git_repo = repo
         self._setup_hooks()
         self.status = 'ready'
 
-    def clone_from(self, source_url):
+    def clone_from(self, source_url, source_repo=None):
         """Initialize a repo as a clone of another"""
         fullname = self._setup_paths(create_repo_dir=False)
         if os.path.exists(fullname):
             shutil.rmtree(fullname)
         LOG.info('Initialize %r as a clone of %s', self, source_url)
-        repo = git.Repo.clone_from(source_url, to_path=fullname, bare=True)
+        clone_kw = {}
+        if source_repo is not None:
+            # hardlink the objects of a repository on this host (not
+            # --shared, which would break the fork if the source is deleted)
+            clone_kw['local'] = True
+        repo = InstrumentedRepo.clone_from(
+            source_url, to_path=fullname, bare=True, **clone_kw)
         self.git_repo = repo
         self._setup_hooks()
         self.status = 'initializing'
         session(self.__class__).flush()
+        if source_repo is not None:
+            LOG.info('... %r cloned, copying commits', self)
+            self.copy_commits_from(source_repo)
         LOG.info('... %r cloned, analyzing', self)
         self.refresh(update_status=False)
         self.status = 'ready'
@@ -268,10 +382,39 @@ class GitRepository(Repository):
             pass
         return obj
 
-    def _find_head(self, name):
-        for head in self.heads:
-            if head.name == name:
-                return head
+    @LazyProperty
+    def refs(self):
+        """Map of branch and tag names to commit ids"""
+        return ref_map(self.heads, self.branches, self.repo_tags)
+
+    def split_ref(self, rev, args):
+        return split_ref(self.refs, rev, args)
+
+    @LazyProperty
+    def refs_key(self):
+        return refs_key(self.refs)
+
+    def resolve_rev(self, rev):
+        """Full id of the commit designated by rev, or None"""
+        if rev in self.refs:
+            return self.refs[rev]
+        if SHA_RE.match(rev):
+            return rev
+        key = None
+        if ABBREV_RE.match(rev):
+            key = (self._id, self.refs_key, rev)
+            object_id = ABBREV_CACHE.get(key)
+            if object_id is None:
+                object_id = CommitIndex.resolve(rev, self._id)
+            if object_id is not None:
+                ABBREV_CACHE.set(key, object_id)
+                return object_id
+        # anything else (HEAD, master~2...) goes through git
+        git_ci = self._commit_obj(rev)
+        if git_ci:
+            if key is not None and git_ci.hexsha.startswith(rev):
+                ABBREV_CACHE.set(key, git_ci.hexsha)
+            return git_ci.hexsha
 
     def commit(self, rev=None):
         """
@@ -283,24 +426,17 @@ class GitRepository(Repository):
         result = None
         if rev is None:
             rev = 'master'
-        git_ci = self._commit_obj(rev)
-        if git_ci:
+        object_id = self.resolve_rev(rev)
+        if object_id:
             result = GitCommit.query.get(
-                object_id=git_ci.hexsha,
+                object_id=object_id,
                 repository_id=self._id
             )
-            if not result:
-                head = self._find_head(rev)
-                if head:
-                    result = GitCommit.query.get(
-                        object_id=head.object_id,
-                        repository_id=self._id
-                    )
             if result is not None:
                 result.set_context(self)
             else:
                 LOG.warn('Commit {} Not Found in Repository {}'.format(
-                         git_ci.hexsha, self._id))
+                         object_id, self._id))
 
         return result
 
@@ -325,21 +461,18 @@ class GitRepository(Repository):
                 seen.add(obj.hexsha)
         return list(new)
 
-    def own_commits(self):
-        """Copy commits from previous repo to this repo"""
+    def own_commits(self, progress=None):
+        """Copy commits from previous repo to this repo
+
+        :param progress: callable(copied, total) (see CommitCopier)
+
+        """
         all_commit_ids = self.new_commits(True)
-        coll = session(GitCommit).impl.bind.db.git_commit
-        cursor = coll.find({
-            'object_id': {'$in': all_commit_ids},
-            'repository_id': {'$ne': self._id}
-        })
-        for ci_doc in cursor:
-            del ci_doc['_id']
-            ci_doc.update({
-                'repository_id': self._id,
-                'app_config_id': self.app_config_id
-            })
-            coll.save(ci_doc)
+        with instrument.timer('fork.copy_commits'):
+            copied = CommitCopier(self, progress=progress).copy_ids(
+                all_commit_ids)
+        CommitIndex.add(self, all_commit_ids)
+        return copied
 
     def refresh_heads(self):
         self.heads = [
@@ -351,52 +484,85 @@ class GitRepository(Repository):
         self.repo_tags = [
             Object(name=tag.name, object_id=tag.commit.hexsha)
             for tag in self.git_repo.tags if tag.is_valid()]
+        self.refs = ref_map(self.heads, self.branches, self.repo_tags)
         session(self.__class__).flush()
 
     def refresh_commit(self, ci):
         obj = self.git_repo.commit(ci.object_id)
         ci._obj = obj
-
-        # Save commit metadata
-        ci.committed = Object(
-            name=h.really_unicode(obj.committer.name),
-            email=h.really_unicode(obj.committer.email),
-            date=datetime.utcfromtimestamp(obj.committed_date))
-        ci.authored = Object(
-            name=h.really_unicode(obj.author.name),
-            email=h.really_unicode(obj.author.email),
-            date=datetime.utcfromtimestamp(obj.authored_date))
-        ci.message = h.really_unicode(obj.message or '')
+        self.apply_commit_info(ci, self._commit_info(obj))
+
+    def commit_info(self, object_id):
+        return self._commit_info(self.git_repo.commit(object_id))
+
+    def _commit_info(self, obj):
+        # commit metadata
+        info = {
+            'committed': dict(
+                name=h.really_unicode(obj.committer.name),
+                email=h.really_unicode(obj.committer.email),
+                date=datetime.utcfromtimestamp(obj.committed_date)),
+            'authored': dict(
+                name=h.really_unicode(obj.author.name),
+                email=h.really_unicode(obj.author.email),
+                date=datetime.utcfromtimestamp(obj.authored_date)),
+            'message': h.really_unicode(obj.message or ''),
+            'parent_ids': [],
+            'diffs': dict(added=[], removed=[], changed=[], copied=[])
+        }
 
         # diffs
-        ci.parent_ids = []
-        ci.diffs.added = []
-        ci.diffs.removed = []
-        ci.diffs.changed = []
-        ci.diffs.copied = []
-
+        diffs = info['diffs']
         if obj.parents:
             for parent in obj.parents:
-                ci.parent_ids.append(parent.hexsha)
+                info['parent_ids'].append(parent.hexsha)
 
                 for diff in parent.diff(obj):
                     if diff.deleted_file:
-                        ci.diffs.removed.append(
+                        diffs['removed'].append(
                             h.really_unicode('/' + diff.a_blob.path))
                     elif diff.new_file:
-                        ci.diffs.added.append(
+                        diffs['added'].append(
                             h.really_unicode('/' + diff.b_blob.path))
                     elif diff.renamed:
-                        ci.diffs.copied.append({
+                        diffs['copied'].append({
                             'old': h.really_unicode('/' + diff.a_blob.path),
                             'new': h.really_unicode('/' + diff.b_blob.path)
                         })
                     else:
-                        ci.diffs.changed.append(
+                        diffs['changed'].append(
                             h.really_unicode('/' + diff.b_blob.path))
         else:
-            ci.diffs.added = [('/' + o.path) for o in
+            diffs['added'] = [('/' + o.path) for o in
                               obj.tree.traverse(lambda o, z: o.type == 'blob')]
+        return info
+
+    def line_stats(self, commit_ids):
+        """Counts lines changed by the commits in a single git log process"""
+        result = {}
+        if not commit_ids:
+            return result
+        output = self.git_repo.git.log(
+            '--no-walk=unsorted', '--numstat', '--no-renames', '-m',
+            '--first-parent', '--format=%x01%H', *commit_ids)
+        stats = None
+        for line in output.splitlines():
+            if line.startswith('\x01'):
+                stats = result[line[1:]] = {
+                    'insertions': 0, 'deletions': 0, 'files': []}
+            elif line and stats is not None:
+                insertions, deletions, path = line.split('\t', 2)
+                # binary files are listed with '-'
+                insertions = int(insertions) if insertions.isdigit() else 0
+                deletions = int(deletions) if deletions.isdigit() else 0
+                stats['insertions'] += insertions
+                stats['deletions'] += deletions
+                stats['files'].append({
+                    'path': h.really_unicode('/' + path),
+                    'insertions': insertions,
+                    'deletions': deletions
+                })
+        return result
 
     def add_object_and_commit(self, branch, path):  # pragma no cover
         """
@@ -439,6 +605,9 @@ class GitContentMixin(object):
     repo = None
     commit = None
     path = None
+    # set from a GitTree snapshot (see make_snapshot_object)
+    _oid = None
+    _size = None
 
     @LazyProperty
     def _obj(self):
@@ -446,14 +615,22 @@ class GitContentMixin(object):
 
     @property
     def object_id(self):
-        return self._obj.hexsha
+        return self._oid or self._obj.hexsha
 
     @property
     def version_id(self):
         return self.object_id
 
-    @cache_str(name='{args[0].cache_name}', key='last_ci_oid')
     def last_commit_oid(self):
+        self._last_commit_oid_miss = False
+        oid = self._cached_last_commit_oid()
+        instrument.incr('cache.last_commit_oid.{}'.format(
+            'miss' if self._last_commit_oid_miss else 'hit'))
+        return oid
+
+    @cache_str(name='{args[0].cache_name}', key='last_ci_oid')
+    def _cached_last_commit_oid(self):
+        self._last_commit_oid_miss = True
         oid = None
         try:
             oid = self.repo.git_repo.git.rev_list(
@@ -503,8 +680,42 @@ class GitContentMixin(object):
 class GitFolder(RepositoryFolder, GitContentMixin):
 
     def __iter__(self):
-        for obj in self._obj.traverse(depth=1):
-            yield make_content_object(obj, self.commit)
+        if self.commit.has_snapshot:
+            tree = self.commit.snapshot
+            for i in tree.children(self.path):
+                yield make_snapshot_object(tree, i, self.commit)
+        else:
+            for obj in self._obj.traverse(depth=1):
+                yield make_content_object(obj, self.commit)
+
+    @LazyProperty
+    def folder_path(self):
+        return normalize_path(self.path, DIR)
+
+    @LazyProperty
+    def snapshot(self):
+        """The snapshot of the commit's tree if loaded (or if this is its
+        root), or else of this folder's subtree alone (see GitTree)
+
+        """
+        if self.commit.has_snapshot or self.folder_path == '/':
+            return self.commit.snapshot
+        return GitTree.load(
+            self.repo.git_repo, self.object_id, self.folder_path)
+
+    def walk(self, ignore=[]):
+        """Same as RepositoryFolder.walk (breadth first), from a snapshot of
+        the folder's tree
+
+        """
+        tree = self.snapshot
+        for i in tree.walk(self.folder_path, ignore):
+            yield make_snapshot_object(tree, i, self.commit)
+
+    def find_files(self):
+        tree = self.snapshot
+        for i in tree.files(self.folder_path):
+            yield make_snapshot_object(tree, i, self.commit)
 
     def ls_commits(self, include_self=False, paths=None):
         """
@@ -538,6 +749,8 @@ class GitFile(RepositoryFile, GitContentMixin):
 
     @LazyProperty
     def size(self):
+        if self._size is not None:
+            return self._size
         return self._obj.size
 
     def open(self):
@@ -640,19 +853,24 @@ class MergeRequest(VersionedArtifact):  # pragma no cover
         return self._commits()
 
     def _commits(self):
-        # FIXME
+        """Commits of the downstream repository not in this repository"""
         result = []
-        next = [self.downstream.commit_id]
-        while next:
-            oid = next.pop(0)
-            ci = GitCommit.query.get(object_id=oid)
-            if self.app.repo._id == ci.repository_id:
-                continue
-            result.append(ci)
-            next += ci.parent_ids
         with self.push_downstream_context():
-            for ci in result:
-                ci.set_context(c.app.repo)
+            downstream_repo = c.app.repo
+            seen = set()
+            next = [self.downstream.commit_id]
+            while next:
+                oid = next.pop(0)
+                if oid in seen or CommitIndex.contains(oid, self.app.repo._id):
+                    continue
+                seen.add(oid)
+                ci = GitCommit.query.get(
+                    object_id=oid, repository_id=downstream_repo._id)
+                if ci is None:
+                    continue
+                ci.set_context(downstream_repo)
+                result.append(ci)
+                next += ci.parent_ids
         return result
 
     @classmethod
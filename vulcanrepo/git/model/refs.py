@@ -0,0 +1,98 @@
+"""
+Resolution of git revisions (branch and tag names, abbreviated commit ids) to
+full commit ids without going through `git rev-parse`.
+
+Branches and tags are resolved with the map kept in the repository document,
+which `GitRepository.refresh_heads` updates whenever the repository is
+refreshed (and which therefore agrees with the commits in the database).
+Abbreviated commit ids are resolved with the commit index and remembered in a
+process wide LRU. An abbreviation can become ambiguous once more commits are
+pushed, so it is remembered along with the refs of the repository at the
+time: new commits move the refs, and the abbreviation is resolved again.
+
+"""
+import re
+import threading
+from collections import OrderedDict
+from itertools import chain
+
+import tg
+from paste.deploy.converters import asint
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+ABBREV_RE = re.compile(r'^[0-9a-f]{4,39}$')
+
+
+class LRUCache(object):
+    """Thread safe mapping keeping the `size` most recently used items"""
+
+    def __init__(self, size=None, size_setting='scm.git.abbrev_cache_size',
+                 default_size=10000):
+        self._size = size
+        self._size_setting = size_setting
+        self._default_size = default_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        if self._size is None:
+            return asint(tg.config.get(
+                self._size_setting, self._default_size))
+        return self._size
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+ABBREV_CACHE = LRUCache()
+
+
+def ref_map(heads, branches, tags):
+    """Map of ref name to commit id. Tags take precedence over branches of
+    the same name, as with git.
+
+    """
+    refs = {}
+    for ref in chain(heads or [], branches or [], tags or []):
+        refs[ref.name] = ref.object_id
+    return refs
+
+
+def refs_key(refs):
+    """Hashable summary of a ref map, which changes as commits are pushed"""
+    return hash(frozenset(refs.iteritems()))
+
+
+def split_ref(refs, rev, args):
+    """Find the longest ref name among rev joined with the leading elements
+    of args (ref names may contain slashes, which split them across url
+    path elements).
+
+    :return: (rev, remaining args)
+
+    """
+    args = list(args)
+    depth = max([name.count('/') for name in refs] or [0])
+    for i in range(min(depth, len(args)), 0, -1):
+        name = '/'.join([rev] + args[:i])
+        if name in refs:
+            return name, args[i:]
+    return rev, args
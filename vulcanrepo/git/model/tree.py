@@ -0,0 +1,85 @@
+"""
+Flattened snapshots of git trees.
+
+Walking a tree through `GitFolder` resolves every folder (and every file
+whose id or size is needed) with a separate object lookup. A `GitTree`
+lists the whole tree in a single `git ls-tree -r -l -t` pass instead, and
+serves every traversal of the commits sharing that tree (`walk`,
+`find_files`, `files_added`, `files_removed`, path lookups). A folder
+traversed alone gets a snapshot of its own subtree, with its paths beneath
+the folder's. A tree never changes, so snapshots are kept in a process wide
+LRU keyed by tree id and folder path (`scm.git.tree_cache_size` trees, 32
+by default).
+
+"""
+from vulcanforge.common import helpers as h
+
+from vulcanrepo import instrument
+from vulcanrepo.base.model.snapshot import (
+    TreeSnapshot,
+    FILE,
+    DIR,
+    normalize_path
+)
+from .refs import LRUCache
+
+TREE_CACHE = LRUCache(
+    size_setting='scm.git.tree_cache_size', default_size=32)
+
+
+class GitTree(TreeSnapshot):
+    """Paths, kinds, object ids and sizes of every file and folder of a git
+    tree, ordered by path
+
+    """
+
+    def __init__(self, paths, kinds, object_ids, sizes):
+        super(GitTree, self).__init__(paths, kinds)
+        self.object_ids = object_ids
+        self.sizes = sizes
+
+    @classmethod
+    def from_git(cls, git_repo, tree_id, folder=u'/'):
+        """List tree_id, as the tree of the folder at path folder"""
+        output = git_repo.git.ls_tree('-r', '-l', '-t', '-z', tree_id)
+        entries = [(folder, DIR, tree_id, 0)]
+        for line in output.split('\0'):
+            if not line:
+                continue
+            meta, path = line.split('\t', 1)
+            mode, obj_type, object_id, size = meta.split()
+            if obj_type == 'tree':
+                kind = DIR
+            elif obj_type == 'blob':
+                kind = FILE
+            else:  # submodules
+                continue
+            entries.append((
+                normalize_path(folder + h.really_unicode(path), kind),
+                kind,
+                object_id,
+                int(size) if kind == FILE else 0))
+        entries.sort()
+        tree = cls([], [], [], [])
+        for path, kind, object_id, size in entries:
+            tree.paths.append(path)
+            tree.kinds.append(kind)
+            tree.object_ids.append(object_id)
+            tree.sizes.append(size)
+        return tree
+
+    @classmethod
+    def load(cls, git_repo, tree_id, folder=u'/'):
+        """The snapshot of tree_id as the tree of folder, from the cache if
+        possible
+
+        """
+        key = (tree_id, folder)
+        tree = TREE_CACHE.get(key)
+        instrument.incr('cache.git_tree.{}'.format(
+            'miss' if tree is None else 'hit'))
+        if tree is None:
+            with instrument.timer('git.tree_snapshot'):
+                tree = cls.from_git(git_repo, tree_id, folder)
+            TREE_CACHE.set(key, tree)
+        return tree
@@ -0,0 +1,310 @@
+"""
+Lightweight timers and counters for the repository hot paths.
+
+Instrumentation is off unless enabled globally with the `scm.instrument`
+config option or for the current thread (i.e. the current request or task)
+with `instrumented()`. When it is off, `timer` returns a shared no-op context
+manager and `incr` returns immediately, so the calls can be left in hot code.
+
+Measurements are sent to the configured exporter and to any listeners
+registered for the current thread (see `vulcanrepo.profiler`).
+
+Mongo commands are timed by a pymongo command listener, which only applies
+to the clients created after it is registered. Call
+`install_mongo_listener()` from the application setup before the datastores
+are configured, or pass `mongo_event_listeners()` as the `event_listeners` of
+the clients created.
+
+Config options:
+
+    scm.instrument = false
+    scm.instrument.exporter = statsd | prometheus
+    scm.instrument.prefix = vulcanrepo
+    scm.instrument.statsd_host = localhost
+    scm.instrument.statsd_port = 8125
+
+"""
+import re
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+import tg
+from paste.deploy.converters import asbool
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+try:
+    from pymongo import monitoring
+except ImportError:
+    monitoring = None
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+_settings = {}
+_mongo_listener_installed = False
+
+
+class StatsdExporter(object):
+    """Sends timings and counters to statsd over UDP"""
+
+    def __init__(self, host='localhost', port=8125, prefix='vulcanrepo'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, msg):
+        try:
+            self.sock.sendto(msg, self.address)
+        except socket.error:  # pragma no cover
+            pass
+
+    def timing(self, name, seconds):
+        self._send('{}.{}:{:d}|ms'.format(
+            self.prefix, name, int(seconds * 1000)))
+
+    def incr(self, name, value):
+        self._send('{}.{}:{:d}|c'.format(self.prefix, name, value))
+
+
+class PrometheusExporter(object):
+    """Records timings and counters as prometheus summaries and counters in
+    the default registry, to be scraped by the application's metrics
+    endpoint.
+
+    """
+    NAME_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+    def __init__(self, prefix='vulcanrepo'):
+        if prometheus_client is None:
+            raise RuntimeError('prometheus_client is not installed')
+        self.prefix = prefix
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _metric(self, metric_cls, name, suffix):
+        key = (name, suffix)
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    full_name = self.NAME_RE.sub(
+                        '_', '{}_{}_{}'.format(self.prefix, name, suffix))
+                    metric = self.metrics[key] = metric_cls(full_name, name)
+        return metric
+
+    def timing(self, name, seconds):
+        self._metric(prometheus_client.Summary, name, 'seconds').observe(
+            seconds)
+
+    def incr(self, name, value):
+        self._metric(prometheus_client.Counter, name, 'total').inc(value)
+
+
+EXPORTERS = {
+    'statsd': lambda opts: StatsdExporter(
+        host=opts.get('statsd_host', 'localhost'),
+        port=opts.get('statsd_port', 8125),
+        prefix=opts.get('prefix', 'vulcanrepo')),
+    'prometheus': lambda opts: PrometheusExporter(
+        prefix=opts.get('prefix', 'vulcanrepo'))
+}
+
+
+def configure(config=None):
+    """(Re)read instrumentation settings from the config"""
+    if config is None:
+        config = tg.config
+    opts = {}
+    prefix = 'scm.instrument.'
+    for key, value in config.items():
+        if key.startswith(prefix):
+            opts[key[len(prefix):]] = value
+    exporter = None
+    exporter_name = opts.get('exporter')
+    if exporter_name:
+        try:
+            exporter = EXPORTERS[exporter_name](opts)
+        except Exception:
+            LOG.exception('Error setting up %s exporter', exporter_name)
+    _settings.update(
+        enabled=asbool(config.get('scm.instrument', False)),
+        exporter=exporter)
+
+
+def is_enabled():
+    enabled = getattr(_local, 'enabled', None)
+    if enabled is None:
+        if not _settings:
+            configure()
+        enabled = _settings['enabled']
+    return enabled
+
+
+@contextmanager
+def instrumented(enabled=True):
+    """Turn instrumentation on (or off) for the current thread for the
+    duration of the block.
+
+    """
+    previous = getattr(_local, 'enabled', None)
+    _local.enabled = enabled
+    try:
+        yield
+    finally:
+        _local.enabled = previous
+
+
+def add_listener(listener):
+    """Register a callable for the current thread that receives every
+    measurement as listener(kind, name, value, detail), where kind is 'timer'
+    or 'counter'.
+
+    """
+    listeners = getattr(_local, 'listeners', None)
+    if listeners is None:
+        listeners = _local.listeners = []
+    listeners.append(listener)
+
+
+def remove_listener(listener):
+    listeners = getattr(_local, 'listeners', [])
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+def _record(kind, name, value, detail):
+    exporter = _settings.get('exporter')
+    if exporter is not None:
+        try:
+            if kind == 'timer':
+                exporter.timing(name, value)
+            else:
+                exporter.incr(name, value)
+        except Exception:  # pragma no cover
+            LOG.exception('Error exporting %s', name)
+    for listener in getattr(_local, 'listeners', ()):
+        listener(kind, name, value, detail)
+
+
+class Timer(object):
+    """Context manager that records the duration of the block"""
+    __slots__ = ('name', 'detail', 'start')
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record('timer', self.name, time.time() - self.start, self.detail)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+
+def timer(name, detail=None):
+    """Time a block:
+
+        with instrument.timer('refresh.heads'):
+            ...
+
+    :param name: metric name. Keep the cardinality low; it is exported.
+    :param detail: optional extra information (e.g. the command line) that
+        is passed to listeners only.
+
+    """
+    if is_enabled():
+        return Timer(name, detail)
+    return NULL_TIMER
+
+
+def timed(name):
+    """Decorator version of `timer`"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def incr(name, value=1, detail=None):
+    """Increment a counter"""
+    if is_enabled():
+        _record('counter', name, value, detail)
+
+
+if monitoring is not None:
+    class MongoCommandListener(monitoring.CommandListener):
+        """Times mongo commands issued while instrumentation is enabled"""
+
+        def started(self, event):
+            if is_enabled():
+                pending = getattr(_local, 'mongo_pending', None)
+                if pending is None:
+                    pending = _local.mongo_pending = {}
+                collection = event.command.get(event.command_name)
+                pending[event.request_id] = collection
+
+        def _finish(self, event, failed=False):
+            pending = getattr(_local, 'mongo_pending', None)
+            if pending is None or event.request_id not in pending:
+                return
+            collection = pending.pop(event.request_id)
+            name = 'mongo.' + event.command_name
+            if failed:
+                name += '.failed'
+            _record('timer', name, event.duration_micros / 1e6, collection)
+
+        def succeeded(self, event):
+            self._finish(event)
+
+        def failed(self, event):
+            self._finish(event, failed=True)
+
+    MONGO_LISTENER = MongoCommandListener()
+else:  # pragma no cover
+    MONGO_LISTENER = None
+
+
+def mongo_event_listeners():
+    """Listeners to pass as the event_listeners of a MongoClient"""
+    if MONGO_LISTENER is None:
+        return []
+    return [MONGO_LISTENER]
+
+
+def install_mongo_listener():
+    """Register the mongo command listener for all the MongoClients created
+    from now on. Call before the datastores are configured; clients created
+    earlier are not instrumented.
+
+    """
+    global _mongo_listener_installed
+    if MONGO_LISTENER is None or _mongo_listener_installed:
+        return False
+    monitoring.register(MONGO_LISTENER)
+    _mongo_listener_installed = True
+    return True
@@ -0,0 +1,16 @@
+from ming.odm import ThreadLocalODMSession
+from vulcanforge.migration.base import BaseMigration
+from vulcanrepo.base.model import CommitRollup
+from vulcanrepo.git.model import GitRepository
+from vulcanrepo.svn.model import SVNRepository
+
+
+class BuildCommitRollups(BaseMigration):
+    def run(self):
+        count = 0
+        for repo_cls in (GitRepository, SVNRepository):
+            for repo in repo_cls.query.find({"stats_rollup_id": None}):
+                count += CommitRollup.rebuild(repo)
+            ThreadLocalODMSession.flush_all()
+            ThreadLocalODMSession.close_all()
+        self.write_output("Rolled up {} commits".format(count))
@@ -0,0 +1,16 @@
+from ming.odm import ThreadLocalODMSession
+from vulcanforge.migration.base import BaseMigration
+from vulcanrepo.base.model import CommitIndex
+from vulcanrepo.git.model import GitRepository
+from vulcanrepo.svn.model import SVNRepository
+
+
+class BuildCommitIndex(BaseMigration):
+    def run(self):
+        count = 0
+        for repo_cls in (GitRepository, SVNRepository):
+            for repo in repo_cls.query.find():
+                count += CommitIndex.add_all(repo)
+            ThreadLocalODMSession.flush_all()
+            ThreadLocalODMSession.close_all()
+        self.write_output("Indexed {} commits".format(count))
@@ -0,0 +1,23 @@
+from ming.odm import ThreadLocalODMSession
+from vulcanforge.common.util.model import pymongo_db_collection
+from vulcanforge.migration.base import BaseMigration
+from vulcanrepo.git.model import GitRepository
+from vulcanrepo.svn.model import SVNRepository
+
+
+class MarkCommitsIndexed(BaseMigration):
+    """Existing commits were indexed during refresh, so flag them indexed
+    for index_commits
+
+    """
+    def run(self):
+        count = 0
+        for repo_cls in (GitRepository, SVNRepository):
+            for repo in repo_cls.query.find():
+                db, coll = pymongo_db_collection(repo.commit_cls)
+                result = coll.update_many(
+                    {'repository_id': repo._id, 'indexed': {'$ne': True}},
+                    {'$set': {'indexed': True}})
+                count += result.modified_count
+            ThreadLocalODMSession.close_all()
+        self.write_output("Flagged {} commits indexed".format(count))
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from ming.odm import ThreadLocalODMSession
+from pylons import app_globals as g, tmpl_context as c
+from vulcanforge.common.exceptions import NoSuchAppError
+from vulcanforge.common.util.model import pymongo_db_collection
+from vulcanforge.migration.base import BaseMigration
+from vulcanrepo.forgeport.model import ForgeProjectFile
+
+
+class BuildForgePortCatalog(BaseMigration):
+    """Record the last modified time of the existing forge projects, which
+    the ForgePort listing used to read from the repository
+
+    """
+    def run(self):
+        count = 0
+        query = {'last_modified': None}
+        db, coll = pymongo_db_collection(ForgeProjectFile)
+        for ac_id in coll.distinct('app_config_id', query):
+            try:
+                with g.context_manager.push(app_config_id=ac_id):
+                    ci = c.app.repo.latest()
+                    if ci is None:
+                        continue
+                    for forge_project in ForgeProjectFile.query.find(
+                            dict(query, app_config_id=ac_id)):
+                        folder = ci.get_path(
+                            forge_project.folder_path.rstrip('/') + '/')
+                        if folder:
+                            forge_project.last_modified = \
+                                datetime.utcfromtimestamp(
+                                    folder.get_timestamp())
+                            count += 1
+            except NoSuchAppError:
+                continue
+            ThreadLocalODMSession.flush_all()
+            ThreadLocalODMSession.close_all()
+        self.write_output(
+            "Recorded the last modified time of {} forge projects".format(
+                count))
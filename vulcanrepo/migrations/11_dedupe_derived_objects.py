@@ -0,0 +1,40 @@
+from pymongo import DeleteMany
+from vulcanforge.common.util.model import pymongo_db_collection
+from vulcanforge.migration.base import BaseMigration
+from vulcanrepo.base.model.derived import RepoDerivedObject
+from vulcanrepo.forgeport.model import ForgeProjectFile
+
+
+class DedupeDerivedObjects(BaseMigration):
+    """Derived objects are now unique per file: keep the newest version of
+    each and remove the others
+
+    """
+    batch_size = 1000
+
+    def run(self):
+        count = 0
+        for cls in (RepoDerivedObject, ForgeProjectFile):
+            db, coll = pymongo_db_collection(cls)
+            cursor = coll.aggregate([
+                {'$sort': {'version': -1}},
+                {'$group': {
+                    '_id': {
+                        'app_config_id': '$blob_spec.app_config_id',
+                        'path': '$blob_spec.path'
+                    },
+                    'ids': {'$push': '$_id'},
+                    'count': {'$sum': 1}
+                }},
+                {'$match': {'count': {'$gt': 1}}}
+            ], allowDiskUse=True)
+            requests = []
+            for group in cursor:
+                requests.append(DeleteMany({'_id': {'$in': group['ids'][1:]}}))
+                count += group['count'] - 1
+                if len(requests) >= self.batch_size:
+                    coll.bulk_write(requests, ordered=False)
+                    requests = []
+            if requests:
+                coll.bulk_write(requests, ordered=False)
+        self.write_output("Removed {} duplicate derived objects".format(count))
@@ -2,7 +2,10 @@ from vulcanrepo.base.model import (
     Repository,
     Commit,
     PostCommitHook,
-    RepositoryThread
+    RepositoryThread,
+    CommitRollup,
+    CommitIndex,
+    CommitDigest
 )
 from vulcanrepo.git.model import *
 from vulcanrepo.svn.model import *
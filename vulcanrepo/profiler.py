@@ -0,0 +1,206 @@
+"""
+Per-request profiling of the repository controllers.
+
+Records every mongo command, git/svn call and cache operation made while
+handling a request (using the `vulcanrepo.instrument` listeners) and checks
+the totals against per-endpoint budgets.
+
+Profiling is turned on for a request by an admin of the tool passing the
+`_profile` request parameter, or for every profiled request with the
+`scm.profile` config option (e.g. in the test configuration). A summary is
+returned in the `X-Repo-Profile` response header. The full trace is kept in
+the cache for `scm.profile.trace_timeout` seconds and can be fetched as json
+from the `profile_trace` endpoint using the id in the `X-Repo-Profile-Id`
+header.
+
+Budgets are set per endpoint and category (mongo, git, svn, cache):
+
+    scm.profile.budget.folder = mongo:40, git:10
+    scm.profile.budget.dir_last_commits = mongo:100, git:20, cache:4
+
+A request that exceeds its budget is logged, or fails with `BudgetExceeded`
+when `scm.profile.strict` is set, so that the tests catch regressions.
+
+"""
+import json
+import time
+import uuid
+import logging
+from functools import wraps
+
+import tg
+from paste.deploy.converters import asbool, asint
+from pylons import tmpl_context as c, app_globals as g, request, response
+
+from vulcanrepo import instrument
+from vulcanrepo.exceptions import RepoError
+
+LOG = logging.getLogger(__name__)
+
+CATEGORIES = ('mongo', 'git', 'svn', 'cache')
+PROFILE_PARAM = '_profile'
+TRACE_CACHE_PREFIX = 'repo_profile.'
+
+
+class BudgetExceeded(RepoError):
+    pass
+
+
+def parse_budget(value):
+    """Parse a budget of the form "mongo:40, git:10" into a dictionary"""
+    budget = {}
+    if value:
+        for item in value.split(','):
+            category, _, limit = item.partition(':')
+            budget[category.strip()] = int(limit)
+    return budget
+
+
+def get_budget(endpoint, config=None):
+    if config is None:
+        config = tg.config
+    return parse_budget(config.get('scm.profile.budget.' + endpoint))
+
+
+class RequestProfile(object):
+    """Collects the measurements made on this thread while active:
+
+        with RequestProfile('folder') as profile:
+            ...
+        profile.summary()
+
+    """
+
+    def __init__(self, endpoint, budget=None):
+        self.endpoint = endpoint
+        self.budget = budget or {}
+        self.events = []
+        self.start = None
+        self.duration = None
+        self._instrumented = instrument.instrumented()
+
+    def __enter__(self):
+        self._instrumented.__enter__()
+        instrument.add_listener(self.record)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.time() - self.start
+        instrument.remove_listener(self.record)
+        self._instrumented.__exit__(*exc_info)
+        return False
+
+    def record(self, kind, name, value, detail):
+        if detail is not None and not isinstance(detail, basestring):
+            detail = repr(detail)
+        self.events.append({
+            'kind': kind,
+            'name': name,
+            'value': value,
+            'detail': detail,
+            'offset': time.time() - self.start
+        })
+
+    def totals(self):
+        """Number of operations and time spent per category"""
+        totals = dict((cat, {'count': 0, 'time': 0.0}) for cat in CATEGORIES)
+        for event in self.events:
+            category = event['name'].split('.', 1)[0]
+            if category not in totals:
+                continue
+            if event['kind'] == 'timer':
+                totals[category]['count'] += 1
+                totals[category]['time'] += event['value']
+            else:
+                totals[category]['count'] += event['value']
+        return totals
+
+    def violations(self):
+        """List of (category, count, limit) exceeding the budget"""
+        totals = self.totals()
+        violations = []
+        for category, limit in sorted(self.budget.iteritems()):
+            count = totals.get(category, {}).get('count', 0)
+            if count > limit:
+                violations.append((category, count, limit))
+        return violations
+
+    def summary(self):
+        return {
+            'endpoint': self.endpoint,
+            'time': self.duration,
+            'totals': self.totals(),
+            'budget': self.budget,
+            'violations': [
+                {'category': cat, 'count': count, 'limit': limit}
+                for cat, count, limit in self.violations()
+            ]
+        }
+
+    def trace(self):
+        result = self.summary()
+        result['events'] = self.events
+        return result
+
+    def check_budget(self, strict=False):
+        violations = self.violations()
+        if violations:
+            msg = '{} exceeded its budget: {}'.format(
+                self.endpoint, ', '.join(
+                    '{} {}/{}'.format(*v) for v in violations))
+            if strict:
+                raise BudgetExceeded(msg)
+            LOG.warn(msg)
+
+
+def _requested():
+    if PROFILE_PARAM not in request.params:
+        return False
+    return g.security.has_access(c.app, 'admin')
+
+
+def save_trace(profile):
+    """Store the full trace in the cache, returning its id"""
+    profile_id = uuid.uuid4().hex
+    timeout = asint(tg.config.get('scm.profile.trace_timeout', 600))
+    g.cache.redis.setex(
+        TRACE_CACHE_PREFIX + profile_id, timeout, json.dumps(profile.trace()))
+    return profile_id
+
+
+def load_trace(profile_id):
+    value = g.cache.redis.get(TRACE_CACHE_PREFIX + profile_id)
+    if value:
+        return json.loads(value)
+
+
+def profiled(endpoint=None):
+    """Decorator for controller methods that profiles the request when asked
+    to and checks it against the endpoint budget.
+
+    """
+    def decorator(func):
+        name = endpoint or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            config_enabled = asbool(tg.config.get('scm.profile', False))
+            requested = _requested()
+            if not (config_enabled or requested):
+                return func(*args, **kwargs)
+            kwargs.pop(PROFILE_PARAM, None)
+            profile = RequestProfile(name, get_budget(name))
+            with profile:
+                result = func(*args, **kwargs)
+            if requested:
+                response.headers['X-Repo-Profile'] = json.dumps(
+                    profile.summary())
+                if g.cache:
+                    response.headers['X-Repo-Profile-Id'] = save_trace(
+                        profile)
+            profile.check_budget(
+                strict=asbool(tg.config.get('scm.profile.strict', False)))
+            return result
+        return wrapper
+    return decorator
@@ -1,22 +1,354 @@
+from collections import OrderedDict
+from datetime import datetime
+
+from bson.son import SON
 from vulcanforge.common.util.model import pymongo_db_collection
 from vulcanforge.common.validators import JSONValidator
+from vulcanforge.project.model import AppConfig
 from vulcanforge.stats import BaseStatsAggregator, StatsQuerySchema
 
+from vulcanrepo.base.model.rollup import CommitRollup, period_start
+
+
+def _get_path(doc, path):
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    return value
+
+
+def sort_keys(sort):
+    """(field, direction) pairs of a $sort stage, in order. Sorting on
+    several fields takes a SON, an OrderedDict or a list of pairs, as the
+    order of a plain dict is arbitrary.
+
+    """
+    if isinstance(sort, (SON, OrderedDict)):
+        return sort.items()
+    elif isinstance(sort, dict):
+        if len(sort) > 1:
+            raise ValueError(
+                '$sort on several fields must be ordered (SON, OrderedDict '
+                'or a list of pairs)')
+        return sort.items()
+    return list(sort)
+
+
+def split_pipeline(pipeline):
+    """Split a pipeline of a $match, a $group whose accumulators are all
+    $sum, and then only $sort, $skip and $limit stages into (match, group,
+    rest), which can be combined across collections. Returns None for any
+    other pipeline.
+
+    """
+    if len(pipeline) < 2 or \
+            '$match' not in pipeline[0] or '$group' not in pipeline[1]:
+        return None
+    match, group, rest = pipeline[0]['$match'], pipeline[1]['$group'], \
+        pipeline[2:]
+    for stage in rest:
+        if not set(stage) <= {'$sort', '$skip', '$limit'}:
+            return None
+        if '$sort' in stage:
+            try:
+                sort_keys(stage['$sort'])
+            except ValueError:
+                return None
+    for key, acc in group.iteritems():
+        if key != '_id' and (not isinstance(acc, dict) or acc.keys() != [
+                '$sum']):
+            return None
+    return match, group, rest
+
+
+def combine(results, group, rest):
+    """Combine the rows of several $group results, summing the accumulators
+    of matching groups, then apply the remaining stages.
+
+    """
+    counters = [k for k in group if k != '_id']
+    rows = {}
+    for result in results:
+        for row in result:
+            key = _freeze(row['_id'])
+            if key in rows:
+                for counter in counters:
+                    rows[key][counter] += row[counter]
+            else:
+                rows[key] = row
+    combined = rows.values()
+    for stage in rest:
+        if '$sort' in stage:
+            for field, direction in reversed(sort_keys(stage['$sort'])):
+                combined.sort(key=lambda r: _get_path(r, field),
+                              reverse=direction < 0)
+        elif '$skip' in stage:
+            combined = combined[stage['$skip']:]
+        elif '$limit' in stage:
+            combined = combined[:stage['$limit']]
+    return combined
+
+
+class UnionCollection(object):
+    """Stands in for several commit collections (e.g. git and svn commits)
+    in an aggregation, running it on each and combining the groups.
+
+    """
+
+    def __init__(self, collections):
+        self.collections = collections
+
+    def aggregate(self, pipeline, **kwargs):
+        if not self.collections:
+            return iter([])
+        if len(self.collections) == 1:
+            return self.collections[0].aggregate(pipeline, **kwargs)
+        split = split_pipeline(pipeline)
+        if split is None:
+            raise ValueError(
+                'Aggregation can not be combined across collections')
+        match, group, rest = split
+        stages = [{'$match': match}, {'$group': group}]
+        return iter(combine(
+            [coll.aggregate(stages, **kwargs) for coll in self.collections],
+            group, rest))
+
+
+class SummingCollection(object):
+    """Adds sums of commit fields to the groups of the aggregations run on a
+    collection
+
+    """
+
+    def __init__(self, collection, sums):
+        self.collection = collection
+        self.sums = sums
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def aggregate(self, pipeline, **kwargs):
+        pipeline = list(pipeline)
+        for i, stage in enumerate(pipeline):
+            if '$group' in stage:
+                group = dict(stage['$group'])
+                for name, field in self.sums.iteritems():
+                    group[name] = {'$sum': field}
+                pipeline[i] = dict(stage, **{'$group': group})
+                break
+        return self.collection.aggregate(pipeline, **kwargs)
+
+
+class RollupCollection(object):
+    """Stands in for the commit collection(s) in CommitAggregator, answering
+    aggregations from the CommitRollup documents plus the commits that have
+    not been rolled up yet.
+
+    Only pipelines that match and group on the rolled up fields, count
+    commits and then sort, skip or limit can be answered this way; anything
+    else is run on the commit collections.
+
+    """
+    FIELDS = ('authored.date', 'authored.name', 'authored.email',
+              'app_config_id', 'repository_id')
+    # accumulators of commits and the equivalent for the rollups
+    SUMS = {
+        1: '$count',
+        '$line_stats.insertions': '$insertions',
+        '$line_stats.deletions': '$deletions'
+    }
+    PERIOD_OPS = [
+        ('month', {'$year', '$month'}),
+        ('week', {'$year', '$week'}),
+        ('day', {'$year', '$month', '$dayOfMonth', '$dayOfWeek',
+                 '$dayOfYear', '$week'})
+    ]
+    DATE_OPS = {'$gte', '$lt', '$ne'}
+    ALIGNED = {
+        'month': lambda d: d == datetime(d.year, d.month, 1),
+        'week': lambda d: d == period_start(d, 'week'),
+        'day': lambda d: d == datetime(d.year, d.month, d.day)
+    }
+
+    def __init__(self, repos):
+        self.repos = repos
+        by_cls = {}
+        for repo in repos:
+            by_cls.setdefault(repo.commit_cls, []).append(repo)
+        self.commit_collections = []
+        for commit_cls, cls_repos in by_cls.iteritems():
+            db, coll = pymongo_db_collection(commit_cls)
+            self.commit_collections.append((coll, cls_repos))
+        db, self.rollup_collection = pymongo_db_collection(CommitRollup)
+
+    def __getattr__(self, name):
+        if len(self.commit_collections) == 1:
+            return getattr(self.commit_collections[0][0], name)
+        raise AttributeError(name)
+
+    def _match_fields(self, match, dates):
+        for key, value in match.iteritems():
+            if key in ('$and', '$or'):
+                for sub in value:
+                    if not self._match_fields(sub, dates):
+                        return False
+            elif key not in self.FIELDS:
+                return False
+            elif key == 'authored.date':
+                if not isinstance(value, dict) or \
+                        not set(value) <= self.DATE_OPS:
+                    return False
+                dates.extend(
+                    v for v in value.values() if isinstance(v, datetime))
+        return True
+
+    def _expression_ops(self, expr, ops):
+        if isinstance(expr, dict):
+            for key, value in expr.iteritems():
+                if key.startswith('$'):
+                    ops.add(key)
+                if not self._expression_ops(value, ops):
+                    return False
+        elif isinstance(expr, (list, tuple)):
+            for value in expr:
+                if not self._expression_ops(value, ops):
+                    return False
+        elif isinstance(expr, basestring) and expr.startswith('$'):
+            return expr[1:] in self.FIELDS
+        return True
+
+    def plan(self, pipeline):
+        """Returns (period, match, group, rest) if the pipeline can be
+        answered from the rollups, else None
+
+        """
+        split = split_pipeline(pipeline)
+        if split is None:
+            return None
+        match, group, rest = split
+        for key, acc in group.iteritems():
+            if key != '_id' and acc['$sum'] not in self.SUMS:
+                return None
+        dates = []
+        if not self._match_fields(match, dates):
+            return None
+        ops = set()
+        if not self._expression_ops(group['_id'], ops):
+            return None
+        for period, allowed in self.PERIOD_OPS:
+            if ops <= allowed and all(self.ALIGNED[period](d) for d in dates):
+                return period, match, group, rest
+        return None
+
+    def aggregate(self, pipeline, **kwargs):
+        plan = self.plan(pipeline)
+        if plan is None:
+            return UnionCollection(
+                [coll for coll, repos in self.commit_collections]
+            ).aggregate(pipeline, **kwargs)
+        period, match, group, rest = plan
+        rollup_group = dict(group)
+        for key, acc in group.iteritems():
+            if key != '_id':
+                rollup_group[key] = {'$sum': self.SUMS[acc['$sum']]}
+        rollup_match = {
+            '$and': [match, {
+                'repository_id': {'$in': [r._id for r in self.repos]},
+                'period': period
+            }]
+        }
+        results = [self.rollup_collection.aggregate(
+            [{'$match': rollup_match}, {'$group': rollup_group}], **kwargs)]
+        for coll, repos in self.commit_collections:
+            tail_match = {'$and': [match, CommitRollup.tail_query(repos)]}
+            results.append(coll.aggregate(
+                [{'$match': tail_match}, {'$group': group}], **kwargs))
+        return iter(combine(results, group, rest))
+
+
+def find_repos(project_ids=None, app_config_ids=None):
+    """Git and svn repositories in the given projects and/or tools"""
+    from vulcanrepo.git.model import GitRepository
+    from vulcanrepo.svn.model import SVNRepository
+    if project_ids is not None:
+        query = {
+            'project_id': {'$in': list(project_ids)},
+            'tool_name': {'$in': ['git', 'svn']}
+        }
+        if app_config_ids is not None:
+            query['_id'] = {'$in': list(app_config_ids)}
+        app_config_ids = [ac._id for ac in AppConfig.query.find(query)]
+    query = {}
+    if app_config_ids is not None:
+        query['app_config_id'] = {'$in': list(app_config_ids)}
+    repos = []
+    for repo_cls in (GitRepository, SVNRepository):
+        repos.extend(repo_cls.query.find(query).all())
+    return repos
+
 
 class CommitQuerySchema(StatsQuerySchema):
     user = JSONValidator()
+    sums = JSONValidator()
 
 
 class CommitAggregator(BaseStatsAggregator):
     timestamp_field = 'authored.date'
+    # commit fields that can be summed in each group
+    SUM_FIELDS = {
+        'insertions': '$line_stats.insertions',
+        'deletions': '$line_stats.deletions'
+    }
+
+    def __init__(self, repo=None, collection=None, use_rollups=True,
+                 repos=None, sums=None, **kwargs):
+        """
+        :param repo: aggregate the commits of a repository
+        :param repos: aggregate the commits of several repositories, which
+            may be a mix of git and svn
+        :param collection: aggregate the commits in a pymongo collection
+        :param use_rollups: answer from the CommitRollup statistics where
+            possible
+        :param sums: names of SUM_FIELDS to total in each group, in addition
+            to the commit count
 
-    def __init__(self, repo=None, collection=None, **kwargs):
+        """
         super(CommitAggregator, self).__init__(**kwargs)
         self.repo = repo
+        self.repos = repos
         if self.repo:
-            db, self.collection = pymongo_db_collection(repo.commit_cls)
+            self.repos = [self.repo]
+        if self.repos:
+            if use_rollups and all(
+                    r.stats_rollup_id is not None for r in self.repos):
+                self.collection = RollupCollection(self.repos)
+            else:
+                collections = [pymongo_db_collection(commit_cls)[1]
+                               for commit_cls in set(
+                                   r.commit_cls for r in self.repos)]
+                if len(collections) == 1:
+                    self.collection = collections[0]
+                else:
+                    self.collection = UnionCollection(collections)
+        elif self.repos is not None:  # e.g. projects without repositories
+            self.collection = UnionCollection([])
         else:
             self.collection = collection
+        if sums:
+            self.collection = SummingCollection(self.collection, dict(
+                (name, self.SUM_FIELDS[name]) for name in sums))
+
+    @classmethod
+    def for_projects(cls, project_ids, **kwargs):
+        """Aggregate the commits of every repository in the given projects"""
+        return cls(repos=find_repos(project_ids=project_ids), **kwargs)
 
     def _make_user_query(self, user_spec):
         q = {}
@@ -31,6 +363,9 @@ class CommitAggregator(BaseStatsAggregator):
         self.query['authored.date'] = {'$ne': None}
         if self.repo:
             self.query['app_config_id'] = self.repo.app_config_id
+        elif self.repos:
+            self.query['app_config_id'] = {
+                '$in': [r.app_config_id for r in self.repos]}
         # user should be a dictionary (name, email) or list of such dicts
         if self.user:
             if isinstance(self.user, dict):
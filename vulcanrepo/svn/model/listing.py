@@ -0,0 +1,133 @@
+"""
+Recursive listings of svn revisions.
+
+Traversing a tree through `SVNFolder` issues an `svn.list` per folder (or a
+recursive one per `find_files` call). An `SVNListing` holds the whole tree of
+a folder at a revision instead, fetched with a single `depth=infinity` list,
+and serves every traversal beneath that folder (`walk`, `find_files`,
+`files_removed`, path lookups). A listing of the root of the revision, when
+one is cached, serves every folder.
+
+A revision never changes, so listings are kept in the cache of the revision
+as parallel arrays (paths, kinds, sizes, created revisions and times), one
+field per folder, and shared between processes for `scm.svn.listing_ttl`
+seconds (a day by default) after they are fetched.
+
+"""
+from ming.base import Object
+from paste.deploy.converters import asint
+from pylons import app_globals as g
+import tg
+from vulcanforge.common import helpers as h
+
+from vulcanrepo.base.model.snapshot import (
+    TreeSnapshot,
+    FILE,
+    DIR,
+    normalize_path
+)
+
+try:
+    import pysvn
+except ImportError:
+    pysvn = None
+
+
+class SVNListing(TreeSnapshot):
+    """Paths, kinds, sizes, created revisions and times of every file and
+    folder of an svn revision, ordered by path
+
+    """
+    CACHE_KEY = 'svn_listing'
+
+    def __init__(self, paths, kinds, sizes, created_revs, times):
+        super(SVNListing, self).__init__(paths, kinds)
+        self.sizes = sizes
+        self.created_revs = created_revs
+        self.times = times
+
+    @classmethod
+    def cache_name(cls, commit):
+        return '{}.r{}'.format(commit.repo.app_config_id, commit.commit_num)
+
+    @classmethod
+    def cache_key(cls, folder):
+        return '{}:{}'.format(cls.CACHE_KEY, folder.encode('utf8'))
+
+    @classmethod
+    def from_svn(cls, commit, folder=u'/'):
+        rev = commit.svn_revision
+        entries = []
+        for info, _ in commit.repo.svn.list(
+                commit.repo.svn_url + folder,
+                revision=rev,
+                peg_revision=rev,
+                depth=pysvn.depth.infinity):
+            kind = DIR if info.kind == pysvn.node_kind.dir else FILE
+            entries.append((
+                normalize_path(h.really_unicode(info.repos_path), kind),
+                kind,
+                info['size'] if kind == FILE else 0,
+                info['created_rev'].number,
+                info.time))
+        entries.sort()
+        listing = cls([], [], [], [], [])
+        for path, kind, size, created_rev, time in entries:
+            listing.paths.append(path)
+            listing.kinds.append(kind)
+            listing.sizes.append(size)
+            listing.created_revs.append(created_rev)
+            listing.times.append(time)
+        return listing
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['paths'], data['kinds'], data['sizes'],
+                   data['created_revs'], data['times'])
+
+    def __json__(self):
+        return {
+            'paths': self.paths,
+            'kinds': self.kinds,
+            'sizes': self.sizes,
+            'created_revs': self.created_revs,
+            'times': self.times
+        }
+
+    @classmethod
+    def load(cls, commit, folder=u'/'):
+        """The listing of folder at commit (or of its root, if cached), from
+        the cache if possible
+
+        """
+        folder = normalize_path(folder, DIR)
+        if g.cache:
+            cache_name = cls.cache_name(commit)
+            keys = [cls.cache_key(folder)]
+            if folder != u'/':
+                keys.insert(0, cls.cache_key(u'/'))
+            for key in keys:
+                data = g.cache.hget_json(cache_name, key)
+                if data:
+                    return cls.from_json(data)
+        listing = cls.from_svn(commit, folder)
+        if g.cache:
+            g.cache.hset_json(
+                cache_name, cls.cache_key(folder), listing.__json__())
+            g.cache.redis.expire(cache_name, asint(
+                tg.config.get('scm.svn.listing_ttl', 86400)))
+        return listing
+
+    def covers(self, folder):
+        """Whether the listing holds folder and everything beneath it"""
+        return bool(self.paths) and folder.startswith(self.paths[0])
+
+    def info(self, i):
+        """pysvn-like info of entry i, as used by SVNContentMixIn"""
+        kind = self.kinds[i]
+        return Object(
+            repos_path=self.paths[i],
+            kind=pysvn.node_kind.dir if kind == DIR else pysvn.node_kind.file,
+            size=self.sizes[i],
+            created_rev=Object(number=self.created_revs[i]),
+            time=self.times[i])
@@ -7,6 +7,7 @@ import pymongo
 from cStringIO import StringIO
 from datetime import datetime
 import hashlib
+import tempfile
 from itertools import chain, ifilter
 
 try:
@@ -21,6 +22,7 @@ import tg
 from vulcanforge.common import helpers as h
 from vulcanforge.auth.model import User
 
+from vulcanrepo import instrument
 from vulcanrepo.base.model import (
     RepositoryFolder,
     RepositoryFile,
@@ -28,6 +30,8 @@ from vulcanrepo.base.model import (
     Commit
 )
 from vulcanrepo.exceptions import RepoError
+from vulcanrepo.base.model.snapshot import DIR, normalize_path
+from .listing import SVNListing
 
 log = logging.getLogger(__name__)
 
@@ -40,6 +44,26 @@ class FileExists(SVNError):
     pass
 
 
+class InstrumentedClient(object):
+    """Wraps a pysvn.Client, timing each call made through it"""
+
+    def __init__(self, client):
+        self.__dict__['_client'] = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with instrument.timer('svn.' + name, args[:1]):
+                return attr(*args, **kwargs)
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+
 def make_content_object(info, ci):
     result = None
     path = info.repos_path
@@ -63,6 +87,7 @@ class SVNCommit(Commit):
         indexes = [
             'repository_id',
             ('repository_id', 'commit_num'),
+            ('app_config_id', 'authored.date'),
         ]
 
     commit_num = FieldProperty(int)
@@ -113,6 +138,55 @@ class SVNCommit(Commit):
     def tree(self):
         return SVNFolder(self, '/')
 
+    @LazyProperty
+    def listing(self):
+        """Recursive listing of the revision, shared by the traversals of
+        its tree (see SVNListing)
+
+        """
+        with instrument.timer('svn.listing'):
+            return SVNListing.load(self)
+
+    @property
+    def has_listing(self):
+        return 'listing' in self.__dict__
+
+    @LazyProperty
+    def _folder_listings(self):
+        return []
+
+    def folder_listing(self, folder):
+        """Recursive listing of folder alone, unless the listing of the
+        revision (or of a folder containing it) is already at hand
+
+        """
+        folder = normalize_path(folder, DIR)
+        if self.has_listing or folder == u'/':
+            return self.listing
+        for listing in self._folder_listings:
+            if listing.covers(folder):
+                return listing
+        with instrument.timer('svn.listing'):
+            listing = SVNListing.load(self, folder)
+        if listing.covers(u'/'):
+            self.listing = listing
+        else:
+            self._folder_listings.append(listing)
+        return listing
+
+    def listing_info(self, path):
+        """Info of path from the listing, if loaded and path is in it"""
+        if self.has_listing:
+            i = self.listing.find(path)
+            if i is not None:
+                return self.listing.info(i)
+
+    def listing_object(self, path):
+        """Content object at path from the listing (None if missing)"""
+        i = self.listing.find(path)
+        if i is not None:
+            return make_content_object(self.listing.info(i), self)
+
     @property
     def url_rev(self):
         return str(self.commit_num)
@@ -176,6 +250,8 @@ class SVNCommit(Commit):
         result = None
         if not path.startswith('/'):
             path = '/' + path
+        if verify and self.has_listing:
+            return self.listing_object(path)
         if verify:
             try:
                 info = self.repo.svn.list(
@@ -206,6 +282,8 @@ class SVNRepository(Repository):
 
     tool_name = 'SVN'
     repo_id = 'svn'
+    supports_parallel_refresh = True
+    client_attrs = ('svn',)
     type_s = 'SVN Repository'
     MAX_MEM_READ = 50 * 10 ** 6
     url_map = {
@@ -217,7 +295,7 @@ class SVNRepository(Repository):
 
     @LazyProperty
     def svn(self):
-        return pysvn.Client()
+        return InstrumentedClient(pysvn.Client())
 
     @LazyProperty
     def svn_url(self):
@@ -228,12 +306,13 @@ class SVNRepository(Repository):
         log.info('svn init %s', fullname)
         if os.path.exists(fullname):
             shutil.rmtree(fullname)
-        subprocess.call(
-            ['svnadmin', 'create', self.name],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=self.fs_path)
+        with instrument.timer('svn.svnadmin', 'create'):
+            subprocess.call(
+                ['svnadmin', 'create', self.name],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=self.fs_path)
         self._setup_hooks()
         self._setup_customizations()
         self.status = 'ready'
@@ -252,7 +331,7 @@ class SVNRepository(Repository):
             dest_path=self.suggested_clone_dest_path()
         )
 
-    def clone_from(self, source_url):
+    def clone_from(self, source_url, source_repo=None):
         """Initialize a repo as a clone of another using svnsync"""
         fullname = self._setup_paths()
         log.info('Initialize %r as a clone of %s', self, source_url)
@@ -260,8 +339,9 @@ class SVNRepository(Repository):
             shutil.rmtree(fullname)
 
         try:
-            subprocess.check_output(
-                ['svnadmin', 'hotcopy', source_url, self.full_fs_path])
+            with instrument.timer('svn.svnadmin', 'hotcopy'):
+                subprocess.check_output(
+                    ['svnadmin', 'hotcopy', source_url, self.full_fs_path])
         except subprocess.CalledProcessError, e:
             raise SVNError(
                 'Exception performing svnadmin hotcopy -- {}'.format(e.output))
@@ -270,6 +350,10 @@ class SVNRepository(Repository):
 
         self.status = 'initializing'
         session(self.__class__).flush()
+        if source_repo is not None:
+            # hotcopy preserves the revisions, so their metadata carries over
+            log.info('... %r cloned, copying commits', self)
+            self.copy_commits_from(source_repo)
         log.info('... %r cloned, analyzing', self)
         self.refresh(update_status=False)
         self.status = 'ready'
@@ -288,7 +372,8 @@ class SVNRepository(Repository):
 
     def latest(self):
         if self.head:
-            ci = SVNCommit.query.get(object_id=self.head.object_id)
+            ci = SVNCommit.query.get(
+                object_id=self.head.object_id, repository_id=self._id)
             if ci:
                 ci.set_context(self)
             return ci
@@ -301,7 +386,7 @@ class SVNRepository(Repository):
             rev = self._oid(rev)
         if rev.startswith('r') and rev[1:].isdigit():
             rev = self._oid(rev[1:])
-        result = SVNCommit.query.get(object_id=rev)
+        result = SVNCommit.query.get(object_id=rev, repository_id=self._id)
         if result is not None:
             result.set_context(self)
         return result
@@ -317,44 +402,45 @@ class SVNRepository(Repository):
         seen_oids = set(ci.object_id for ci in cursor)
         return sorted(list(set(oids).difference(seen_oids)))
 
-    def refresh_commit(self, ci):
-        rev = ci.svn_revision
+    def commit_info(self, object_id):
+        commit_num = self._revno(object_id)
+        revision = pysvn.Revision(pysvn.opt_revision_kind.number, commit_num)
         try:
             log_entry = self.svn.log(
                 self.svn_url,
-                revision_start=rev,
+                revision_start=revision,
                 limit=1,
                 discover_changed_paths=True)[0]
         except pysvn.ClientError:  # pragma no cover
             log.warn(
                 'ClientError processing %r %r, treating as empty',
-                ci, self, exc_info=True)
+                object_id, self, exc_info=True)
             log_entry = Object(date='', message='', changed_paths=[])
 
-        # Save commit metadata
-        ci.authored = Object(
-            name=log_entry.get('author', '--none--'),
-            email='',
-            date=datetime.utcfromtimestamp(log_entry.date)
-        )
-        ci.message = log_entry.message
+        # commit metadata
+        info = {
+            'authored': dict(
+                name=log_entry.get('author', '--none--'),
+                email='',
+                date=datetime.utcfromtimestamp(log_entry.date)
+            ),
+            'message': log_entry.message,
+            'diffs': dict(added=[], removed=[], changed=[], copied=[])
+        }
 
-        # Save diff info
-        ci.diffs.added = []
-        ci.diffs.removed = []
-        ci.diffs.changed = []
-        ci.diffs.copied = []
+        # diff info
+        diffs = info['diffs']
         lst = dict(
-            A=ci.diffs.added,
-            D=ci.diffs.removed,
-            M=ci.diffs.changed,
-            R=ci.diffs.changed)
+            A=diffs['added'],
+            D=diffs['removed'],
+            M=diffs['changed'],
+            R=diffs['changed'])
         parent_rev = pysvn.Revision(
             pysvn.opt_revision_kind.number,
-            ci.commit_num - 1)
+            commit_num - 1)
         for path in log_entry.changed_paths:
             p = path.path.decode('utf8')
-            rev = parent_rev if path.action == 'D' else ci.svn_revision
+            rev = parent_rev if path.action == 'D' else revision
             is_file = self._is_file(p, rev)
             if not is_file:
                 p += u'/'
@@ -362,12 +448,58 @@ class SVNRepository(Repository):
                 from_p = path.copyfrom_path
                 if not is_file:
                     from_p += u'/'
-                ci.diffs.copied.append({
+                diffs['copied'].append({
                     'old': h.really_unicode(from_p),
                     'new': h.really_unicode(p)
                 })
             else:
                 lst[path.action].append(h.really_unicode(p))
+        return info
+
+    def line_stats(self, commit_ids):
+        """Counts lines changed by each commit by streaming its diff"""
+        return dict((oid, self._revision_line_stats(self._revno(oid)))
+                    for oid in commit_ids)
+
+    def _revision_line_stats(self, revno):
+        stats = {'insertions': 0, 'deletions': 0, 'files': []}
+        current = None
+        in_header = False
+        cmd = ['svn', 'diff', '--non-interactive', '--internal-diff',
+               '-c', str(revno), self.svn_url]
+        # stderr goes to a file, as a full pipe would block svn while the
+        # diff is read
+        with instrument.timer('svn.diff', cmd), \
+                tempfile.TemporaryFile() as err:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+            for line in proc.stdout:
+                if line.startswith('Index: '):
+                    current = {
+                        'path': h.really_unicode('/' + line[7:].rstrip('\n')),
+                        'insertions': 0,
+                        'deletions': 0
+                    }
+                    stats['files'].append(current)
+                    in_header = True
+                elif line.startswith('Property changes on: '):
+                    current = None
+                elif current is None:
+                    continue
+                elif in_header:
+                    in_header = not line.startswith('@@')
+                elif line.startswith('+'):
+                    current['insertions'] += 1
+                    stats['insertions'] += 1
+                elif line.startswith('-'):
+                    current['deletions'] += 1
+                    stats['deletions'] += 1
+            proc.stdout.close()
+            if proc.wait():
+                err.seek(0)
+                log.warn('Error counting lines changed in r%d of %r: %s',
+                         revno, self, err.read())
+                return None
+        return stats
 
     def _is_file(self, path, rev=None):
         l_info = self.svn.list(
@@ -409,6 +541,18 @@ class SVNRepository(Repository):
     def _oid(self, revno):
         return '{}:{}'.format(self._id, revno)
 
+    def fork_commit_fields(self):
+        # object ids embed the repository id
+        fields = super(SVNRepository, self).fork_commit_fields()
+        fields['object_id'] = {'$concat': [
+            '{}:'.format(self._id), {'$toString': '$commit_num'}]}
+        return fields
+
+    def fork_commit_doc(self, doc):
+        doc = super(SVNRepository, self).fork_commit_doc(doc)
+        doc['object_id'] = self._oid(doc['commit_num'])
+        return doc
+
     def add_file(self, path, dest, msg='', author=None):
         """
         Add a file to the repository and commit the changes
@@ -502,6 +646,9 @@ class SVNFolder(RepositoryFolder, SVNContentMixIn):
 
     @LazyProperty
     def _info(self):
+        info = self.commit.listing_info(self.path)
+        if info is not None:
+            return info
         return self._listing[0][0]
 
     @LazyProperty
@@ -511,12 +658,26 @@ class SVNFolder(RepositoryFolder, SVNContentMixIn):
             self.svn_url, revision=rev, peg_revision=rev, recurse=False)
 
     def __iter__(self):
-        for l_info in self._listing[1:]:
-            obj = make_content_object(l_info[0], self.commit)
+        if self.commit.has_listing:
+            listing = self.commit.listing
+            infos = (listing.info(i) for i in listing.children(self.path))
+        else:
+            infos = (l_info[0] for l_info in self._listing[1:])
+        for info in infos:
+            obj = make_content_object(info, self.commit)
             if obj.kind == 'File':
                 obj.parent = self
             yield obj
 
+    def walk(self, ignore=[]):
+        """Same as RepositoryFolder.walk (breadth first), from the listing
+        of the folder
+
+        """
+        listing = self.commit.folder_listing(self.path)
+        for i in listing.walk(normalize_path(self.path, DIR), ignore):
+            yield make_content_object(listing.info(i), self.commit)
+
     def ls_commits(self, include_self=False, paths=None):
         data = {}
         commits = {}
@@ -540,15 +701,9 @@ class SVNFolder(RepositoryFolder, SVNContentMixIn):
 
     def find_files(self):
         """Find all file paths recursively beneath this folder"""
-        rev = self.commit.svn_revision
-        listing = self.repo.svn.list(
-            self.svn_url,
-            revision=rev,
-            peg_revision=rev,
-            depth=pysvn.depth.infinity)
-        for info, _ in listing:
-            if info.kind == pysvn.node_kind.file:
-                yield make_content_object(info, self.commit)
+        listing = self.commit.folder_listing(self.path)
+        for i in listing.files(normalize_path(self.path, DIR)):
+            yield make_content_object(listing.info(i), self.commit)
 
 
 class SVNFile(RepositoryFile, SVNContentMixIn):
@@ -560,6 +715,9 @@ class SVNFile(RepositoryFile, SVNContentMixIn):
 
     @LazyProperty
     def _info(self):
+        info = self.commit.listing_info(self.path)
+        if info is not None:
+            return info
         rev = self.commit.svn_revision
         l_info = self.repo.svn.list(
             self.svn_url, revision=rev, peg_revision=rev, recurse=False)[0][0]
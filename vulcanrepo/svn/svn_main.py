@@ -72,7 +72,8 @@ class ForgeSVNApp(RepositoryApp):
                     _id=cloned_from_repo_id)
                 repo_tasks.clone.post(
                     cloned_from_name=cloned_from.app.config.script_name(),
-                    cloned_from_url=cloned_from.full_fs_path)
+                    cloned_from_url=cloned_from.full_fs_path,
+                    cloned_from_repo_id=cloned_from._id)
         elif init_from_url:
             repo_tasks.clone.post(
                 cloned_from_name=None,
@@ -1,5 +1,6 @@
 import logging
 
+from pylons import app_globals as g
 from vulcanforge.auth.model import User
 from vulcanforge.cache.decorators import cache_literal
 
@@ -20,3 +21,33 @@ class SVNCommitAuthor(CommitAuthorWidget):
         else:
             author_content = value['author_name']
         return author_content
+
+    def author_id(self, value):
+        return value['author_name']
+
+    def author_cache_name(self, value):
+        if value['author_name']:
+            return '{}.avatar'.format(value['author_name'])
+
+    def render_many(self, values, size=16, **kw):
+        """Look up the users for all of the authors at once"""
+        names = list(set(
+            self.author_id(value) for value in values if value['author_name']))
+        users = dict(
+            (user.username, user)
+            for user in User.query.find({'username': {'$in': names}}))
+        cache_key = self.cache_key(kwargs={'size': size})
+        rendered = {}
+        for name in names:
+            user = users.get(name)
+            if user:
+                author_content = self.avatar_widget.display(
+                    user=user, size=size, compact=True)
+            else:
+                author_content = name
+            rendered[name] = author_content
+            if g.cache:
+                g.cache.hset(
+                    self.author_cache_name({'author_name': name}),
+                    cache_key, author_content)
+        return rendered
@@ -1,7 +1,9 @@
 import shutil
 import logging
 
+import tg
 from ming.odm import ThreadLocalODMSession
+from paste.deploy.converters import asbool
 from pylons import tmpl_context as c
 
 from vulcanforge.common.util.model import chunked_find
@@ -27,8 +29,13 @@ def init(**kwargs):
 
 
 @task
-def clone(cloned_from_name, cloned_from_url):
-    c.app.repo.init_as_clone(cloned_from_name, cloned_from_url)
+def clone(cloned_from_name, cloned_from_url, cloned_from_repo_id=None):
+    source_repo = None
+    if cloned_from_repo_id is not None and \
+            asbool(tg.config.get('scm.fork.copy_commits', True)):
+        source_repo = c.app.repo.query.get(_id=cloned_from_repo_id)
+    c.app.repo.init_as_clone(
+        cloned_from_name, cloned_from_url, source_repo=source_repo)
     subject_text = "{} Repository {} created by {}"
     subject = subject_text.format(c.app.tool_label,
                                   c.app.config.options['mount_label'],
@@ -53,12 +60,34 @@ def run_commit_hooks(commits=None):
         c.app.repo.run_post_commit_hooks(commits)
 
 
+@task
+def last_commits(rev, folder_path, paths):
+    """Compute the last commit for some of the entries of a folder for the
+    progressive file browser (see vulcanrepo.base.last_commits)
+
+    """
+    from vulcanrepo.base import last_commits
+    commit = c.app.repo.commit(rev)
+    folder = commit.get_path(folder_path) if commit else None
+    if folder is None:
+        LOG.warn('Folder %s not found at %s', folder_path, rev)
+        return
+    author_widget = c.app.root.Widgets.commit_author_widget
+    entries, commits = last_commits.compute_last_commits(
+        folder, author_widget, paths=paths, include_self=False)
+    last_commits.store_results(folder, entries, commits)
+
+
 @task
 def uninstall(**kwargs):
     from vulcanrepo.base.app import RepositoryApp
+    from vulcanrepo.base.model import CommitRollup, CommitIndex, CommitDigest
     repo = c.app.repo
     if repo is not None:
         shutil.rmtree(repo.full_fs_path, ignore_errors=True)
+        CommitRollup.query.remove({'repository_id': repo._id})
+        CommitIndex.remove_repo(repo)
+        CommitDigest.query.remove({'repository_id': repo._id})
         repo.delete()
     super(RepositoryApp, c.app).uninstall(c.project)
 
@@ -77,3 +106,19 @@ def purge_hook(hook_id):
                     if len(hooks) != len(c.app.repo.post_commit_hooks):
                         c.app.repo.post_commit_hooks = hooks
         ThreadLocalODMSession.flush_all()
+
+
+@task
+def post_process_derived(cls_path, object_ids):
+    """Post process derived objects upserted in bulk (see
+    vulcanrepo.base.model.derived.DerivedObjectSynchronizer)
+
+    """
+    from vulcanforge.common.util.filesystem import import_object
+    cls = import_object(cls_path)
+    for obj in cls.query.find({'_id': {'$in': object_ids}}):
+        try:
+            obj.post_process()
+        except Exception:
+            LOG.exception('Error post processing %s', obj._id)
+        ThreadLocalODMSession.flush_all()
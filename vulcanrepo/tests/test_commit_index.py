@@ -0,0 +1,49 @@
+import hashlib
+from unittest import TestCase
+
+from vulcanrepo.base.model.commit_index import (
+    CommitIndex,
+    PREFIX_LENGTH,
+    prefix_of
+)
+
+SHA = '3f786850e387550fdab836ed7e6dc881de23001b'
+
+
+class TestPrefixOf(TestCase):
+
+    def test_git_prefix(self):
+        self.assertEqual(prefix_of(SHA), SHA[:PREFIX_LENGTH])
+
+    def test_svn_prefix_is_hashed(self):
+        oid = '5e8f0a1b2c3d4e5f6a7b8c9d:42'
+        self.assertEqual(
+            prefix_of(oid), hashlib.md5(oid).hexdigest()[:PREFIX_LENGTH])
+        # revisions of a repository spread across prefixes
+        self.assertNotEqual(
+            prefix_of('5e8f0a1b2c3d4e5f6a7b8c9d:1'),
+            prefix_of('5e8f0a1b2c3d4e5f6a7b8c9d:2'))
+
+
+class TestLookupQuery(TestCase):
+
+    def test_short_abbreviation(self):
+        self.assertEqual(
+            CommitIndex.lookup_query('3f7'), {'prefix': {'$regex': '^3f7'}})
+
+    def test_prefix(self):
+        self.assertEqual(
+            CommitIndex.lookup_query(SHA[:4]), {'prefix': SHA[:4]})
+
+    def test_long_abbreviation(self):
+        self.assertEqual(CommitIndex.lookup_query(SHA[:8]), {
+            'prefix': SHA[:4],
+            'object_id': {'$regex': '^' + SHA[:8]}
+        })
+
+    def test_svn_id(self):
+        oid = '5e8f0a1b2c3d4e5f6a7b8c9d:42'
+        self.assertEqual(CommitIndex.lookup_query(oid), {
+            'prefix': prefix_of(oid),
+            'object_id': oid
+        })
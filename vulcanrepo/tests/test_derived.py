@@ -0,0 +1,163 @@
+import re
+from datetime import datetime
+from unittest import TestCase
+
+from ming.base import Object
+from pymongo import DeleteMany
+
+from vulcanrepo.base.model.derived import DerivedObjectSynchronizer
+
+
+class FakeCommit(object):
+
+    def __init__(self, object_id, parent_ids=(), date=None, commit_num=None,
+                 added=(), removed=(), changed=(), copied=(), missing=()):
+        self.object_id = object_id
+        self.parent_ids = list(parent_ids)
+        self.committed = Object(date=date or datetime(2020, 1, 1))
+        if commit_num is not None:
+            self.commit_num = commit_num
+        self.diffs = Object(
+            added=list(added), removed=list(removed), changed=list(changed),
+            copied=[dict(old=old, new=new) for old, new in copied])
+        # paths missing from the commit's tree
+        self.missing = set(missing)
+
+    def get_path(self, path, verify=True):
+        if verify and path in self.missing:
+            return None
+        return Object(path=path, commit=self)
+
+
+def ids(commits):
+    return [ci.object_id for ci in commits]
+
+
+class TestOldestFirst(TestCase):
+
+    def test_svn_by_revision(self):
+        commits = [FakeCommit('r3', commit_num=3),
+                   FakeCommit('r1', commit_num=1),
+                   FakeCommit('r2', commit_num=2)]
+        self.assertEqual(
+            ids(DerivedObjectSynchronizer.oldest_first(commits)),
+            ['r1', 'r2', 'r3'])
+
+    def test_git_parents_first(self):
+        # the child is dated before its parent (e.g. a rebase)
+        commits = [
+            FakeCommit('c', ['b'], datetime(2020, 1, 1)),
+            FakeCommit('b', ['a'], datetime(2020, 1, 3)),
+            FakeCommit('a', [], datetime(2020, 1, 2))]
+        self.assertEqual(
+            ids(DerivedObjectSynchronizer.oldest_first(commits)),
+            ['a', 'b', 'c'])
+
+    def test_git_unrelated_by_date(self):
+        commits = [
+            FakeCommit('merge', ['x', 'y'], datetime(2020, 1, 5)),
+            FakeCommit('y', ['base'], datetime(2020, 1, 4)),
+            FakeCommit('x', ['base'], datetime(2020, 1, 3))]
+        self.assertEqual(
+            ids(DerivedObjectSynchronizer.oldest_first(commits)),
+            ['x', 'y', 'merge'])
+
+
+class SynchronizerTestCase(TestCase):
+
+    def setUp(self):
+        self.sync = DerivedObjectSynchronizer(
+            None, None, lambda path: path.endswith('.json'), process=False,
+            concurrency=0)
+
+    def changes(self, commits):
+        blobs, sources, removed, removed_folders = self.sync.changes(commits)
+        return (dict((path, blob.commit.object_id)
+                     for path, blob in blobs.iteritems()),
+                sources, removed, removed_folders)
+
+
+class TestChanges(SynchronizerTestCase):
+
+    def test_newest_blob_of_each_file(self):
+        older = FakeCommit('a', [], added=['/p/f.json', '/p/f.txt'])
+        newer = FakeCommit('b', ['a'], changed=['/p/f.json'])
+        blobs, sources, removed, removed_folders = self.changes(
+            [newer, older])
+        self.assertEqual(blobs, {'/p/f.json': 'b'})
+        self.assertEqual(removed, set())
+
+    def test_added_then_removed(self):
+        blobs, sources, removed, removed_folders = self.changes([
+            FakeCommit('a', [], added=['/p/f.json']),
+            FakeCommit('b', ['a'], removed=['/p/f.json'])])
+        self.assertEqual(blobs, {})
+        self.assertEqual(removed, set(['/p/f.json']))
+
+    def test_removed_then_added_back(self):
+        blobs, sources, removed, removed_folders = self.changes([
+            FakeCommit('a', [], removed=['/p/f.json']),
+            FakeCommit('b', ['a'], added=['/p/f.json'])])
+        self.assertEqual(blobs, {'/p/f.json': 'b'})
+        self.assertEqual(removed, set())
+
+
+class TestMovesAndDeletions(SynchronizerTestCase):
+
+    def test_rename(self):
+        blobs, sources, removed, removed_folders = self.changes([
+            FakeCommit('a', [], copied=[('/p/f.json', '/q/f.json')],
+                       missing=['/p/f.json'])])
+        self.assertEqual(blobs, {'/q/f.json': 'a'})
+        self.assertEqual(sources, {'/q/f.json': '/p/f.json'})
+        self.assertEqual(removed, set(['/p/f.json']))
+
+    def test_copy_keeps_source(self):
+        blobs, sources, removed, removed_folders = self.changes([
+            FakeCommit('a', [], copied=[('/p/f.json', '/q/f.json')])])
+        self.assertEqual(blobs, {'/q/f.json': 'a'})
+        self.assertEqual(sources, {'/q/f.json': '/p/f.json'})
+        self.assertEqual(removed, set())
+
+    def test_renamed_twice_maps_to_first_path(self):
+        blobs, sources, removed, removed_folders = self.changes([
+            FakeCommit('a', [], copied=[('/p/f.json', '/q/f.json')],
+                       missing=['/p/f.json']),
+            FakeCommit('b', ['a'], copied=[('/q/f.json', '/r/f.json')],
+                       missing=['/q/f.json'])])
+        self.assertEqual(blobs, {'/r/f.json': 'b'})
+        self.assertEqual(sources['/r/f.json'], '/p/f.json')
+        self.assertEqual(removed, set(['/p/f.json', '/q/f.json']))
+
+    def test_removed_folder_drops_files_beneath(self):
+        blobs, sources, removed, removed_folders = self.changes([
+            FakeCommit('a', [], added=['/p/f.json', '/q/g.json']),
+            FakeCommit('b', ['a'], removed=['/p/'])])
+        self.assertEqual(blobs, {'/q/g.json': 'a'})
+        self.assertEqual(removed_folders, set(['/p/']))
+
+    def test_copied_folder_maps_tracked_files(self):
+        self.sync._tracked_under = \
+            lambda folder, blobs, removed, removed_folders: ['/p/f.json']
+        blobs, sources, removed, removed_folders = self.changes([
+            FakeCommit('a', [], copied=[('/p/', '/q/')], removed=['/p/'])])
+        self.assertEqual(blobs, {'/q/f.json': 'a'})
+        self.assertEqual(sources, {'/q/f.json': '/p/f.json'})
+        self.assertEqual(removed_folders, set(['/p/']))
+
+    def test_remove_op_spares_kept_and_moved_objects(self):
+        self.sync.repo = Object(app_config_id='ac')
+        op = self.sync._remove_op(
+            set(['/p/f.json']), set(['/q/']), {'/q/g.json': None}, ['moved'])
+        self.assertEqual(op, DeleteMany({
+            'blob_spec.app_config_id': 'ac',
+            '$or': [
+                {'blob_spec.path': {'$in': ['/p/f.json']}},
+                {'blob_spec.path': {'$regex': '^' + re.escape('/q/')}}
+            ],
+            'blob_spec.path': {'$nin': ['/q/g.json']},
+            '_id': {'$nin': ['moved']}
+        }))
+
+    def test_nothing_removed(self):
+        self.assertIsNone(self.sync._remove_op(set(), set(), {}, []))
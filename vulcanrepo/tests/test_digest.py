@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import mock
+import mongomock
+from bson import ObjectId
+from ming.base import Object
+
+from vulcanrepo.base.model.digest import CommitDigest
+
+
+class TestCommitDigest(TestCase):
+
+    def setUp(self):
+        self.digests = mongomock.MongoClient().db.digests
+        self.repo = Object(_id=ObjectId(), app_config_id=ObjectId())
+        for name, value in [
+                ('pymongo_db_collection', lambda cls: (None, self.digests)),
+                ('digest_max_commits', lambda: 3),
+                ('digest_window', lambda: timedelta(minutes=5))]:
+            patcher = mock.patch(
+                'vulcanrepo.base.model.digest.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_first_digest_is_due_now(self):
+        self.assertIsNone(CommitDigest.queue(self.repo, ['a', 'b']))
+        doc = self.digests.find_one({'repository_id': self.repo._id})
+        self.assertEqual(doc['commit_ids'], ['a', 'b'])
+        self.assertEqual(doc['count'], 2)
+        self.assertEqual(doc['app_config_id'], self.repo.app_config_id)
+
+    def test_only_newest_commits_are_listed(self):
+        CommitDigest.queue(self.repo, ['a', 'b'])
+        CommitDigest.queue(self.repo, ['c', 'd', 'e', 'f'])
+        self.assertEqual(
+            CommitDigest.take(self.repo), (['d', 'e', 'f'], 6))
+
+    def test_take_empties_digest(self):
+        CommitDigest.queue(self.repo, ['a'])
+        self.assertEqual(CommitDigest.take(self.repo), (['a'], 1))
+        self.assertEqual(CommitDigest.take(self.repo), ([], 0))
+        doc = self.digests.find_one({'repository_id': self.repo._id})
+        self.assertIsNotNone(doc['last_sent'])
+        self.assertNotIn('first_queued', doc)
+
+    def test_held_back_within_window(self):
+        CommitDigest.queue(self.repo, ['a'])
+        CommitDigest.take(self.repo)
+        due = CommitDigest.queue(self.repo, ['b'])
+        self.assertIsNotNone(due)
+        self.assertGreater(due, datetime.utcnow())
+
+    def test_due_after_window(self):
+        self.digests.insert_one({
+            'repository_id': self.repo._id,
+            'commit_ids': [],
+            'count': 0,
+            'last_sent': datetime.utcnow() - timedelta(minutes=10)
+        })
+        self.assertIsNone(CommitDigest.queue(self.repo, ['a']))
@@ -0,0 +1,95 @@
+from datetime import datetime
+from unittest import TestCase
+
+import mock
+
+from vulcanrepo.base.model.repo import Repository
+
+
+def checkpoint(**fields):
+    return dict({
+        'phase': 'ingest',
+        'since': None,
+        'last_oid': None,
+        'done': 0,
+        'total': 0,
+        'all_commits': False,
+        'notify': True,
+        'with_hooks': True,
+        'updated': datetime.utcnow()
+    }, **fields)
+
+
+class TestRefreshCheckpoint(TestCase):
+
+    def setUp(self):
+        self.repo = mock.Mock()
+        self.repo.REFRESH_PHASES = Repository.REFRESH_PHASES
+        self.repo.BATCH_SIZE = 10
+        self.repo.refresh_checkpoint = None
+        self.repo._refresh_requested.return_value = False
+        patcher = mock.patch('vulcanrepo.base.model.repo.session')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refresh(self, **kwargs):
+        return Repository.refresh.__func__(self.repo, **kwargs)
+
+    def test_refresh_under_way_is_left_alone(self):
+        self.repo.refresh_checkpoint = checkpoint()
+        self.repo._checkpoint_stale.return_value = False
+        self.assertEqual(self.refresh(), 0)
+        self.repo._request_refresh.assert_called_once_with()
+        self.assertFalse(self.repo._refresh.called)
+
+    def test_interrupted_refresh_is_resumed_first(self):
+        interrupted = checkpoint(phase='notify', since='since')
+        self.repo.refresh_checkpoint = interrupted
+        self.repo._checkpoint_stale.return_value = True
+        self.repo._refresh.side_effect = [2, 3]
+        self.assertEqual(self.refresh(), 5)
+        self.assertEqual(self.repo._refresh.call_args_list, [
+            mock.call(interrupted, True),
+            mock.call(self.repo._new_checkpoint.return_value, True)
+        ])
+
+    def test_requested_refresh_runs_once_done(self):
+        self.repo._refresh_requested.side_effect = [True, False]
+        self.repo._refresh.return_value = 1
+        self.assertEqual(
+            self.refresh(all_commits=True, notify=False, with_hooks=True), 2)
+        self.assertEqual(self.repo._new_checkpoint.call_args_list, [
+            mock.call(True, False, True),
+            mock.call(False, False, True)
+        ])
+
+    def test_resumes_at_checkpointed_phase(self):
+        resumed = checkpoint(phase='notify', total=4)
+        self.assertEqual(
+            Repository._refresh.__func__(self.repo, resumed, False), 4)
+        self.assertFalse(self.repo._refresh_ingest.called)
+        self.assertFalse(self.repo._refresh_index.called)
+        self.repo._refresh_notify.assert_called_once_with(resumed)
+        self.repo._refresh_hooks.assert_called_once_with(resumed)
+        self.repo._checkpoint.assert_called_once_with(
+            resumed, phase='hooks', done=0)
+        self.assertIsNone(self.repo.refresh_checkpoint)
+
+    @mock.patch('vulcanrepo.base.model.repo.ParallelAnalyzer')
+    def test_ingest_skips_commits_written_before(self, analyzer):
+        analyzer.should_use.return_value = False
+        self.repo.new_commits.return_value = ['a', 'b', 'c', 'd']
+        self.repo._commit_docs.side_effect = lambda batch: batch
+        self.repo._write_commits.side_effect = \
+            lambda docs, overwrite: len(docs)
+        resumed = checkpoint(last_oid='b', done=2, all_commits=True)
+        Repository._refresh_ingest.__func__(self.repo, resumed)
+        self.repo._discard_unanalyzed.assert_called_once_with(resumed)
+        self.repo._commit_docs.assert_called_once_with(
+            [('c', None), ('d', None)])
+        self.repo._write_commits.assert_called_once_with(
+            [('c', None), ('d', None)], True)
+        self.assertEqual(self.repo._checkpoint.call_args_list, [
+            mock.call(resumed, total=4),
+            mock.call(resumed, last_oid='d', done=4)
+        ])
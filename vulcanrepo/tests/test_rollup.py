@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import mock
+import mongomock
+from bson import ObjectId
+from ming.base import Object
+from pymongo import ASCENDING
+
+from vulcanrepo.base.model.rollup import CommitRollup, period_start
+
+
+class FakeCommit(object):
+    pass
+
+
+class InterruptedFlag(Exception):
+    pass
+
+
+class InterruptingCollection(object):
+    """Commit collection whose next flagging of commits as rolled up fails,
+    as if the update was interrupted right after writing the rollups
+
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.interrupt = True
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def update_many(self, query, update, *args, **kwargs):
+        if self.interrupt and update.get('$set', {}).get('rolled_up'):
+            self.interrupt = False
+            raise InterruptedFlag()
+        return self.collection.update_many(query, update, *args, **kwargs)
+
+
+class TestPeriodStart(TestCase):
+
+    def test_day(self):
+        self.assertEqual(
+            period_start(datetime(2020, 3, 4, 15, 30), 'day'),
+            datetime(2020, 3, 4))
+
+    def test_week_starts_on_sunday(self):
+        # Wednesday
+        self.assertEqual(
+            period_start(datetime(2020, 3, 4, 15, 30), 'week'),
+            datetime(2020, 3, 1))
+
+    def test_week_split_at_start_of_year(self):
+        # Friday Jan 1, in the week starting Sunday Dec 27
+        self.assertEqual(
+            period_start(datetime(2021, 1, 1), 'week'), datetime(2021, 1, 1))
+        self.assertEqual(
+            period_start(datetime(2020, 12, 31), 'week'),
+            datetime(2020, 12, 27))
+
+    def test_month(self):
+        self.assertEqual(
+            period_start(datetime(2020, 3, 4), 'month'), datetime(2020, 3, 1))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            period_start(datetime(2020, 3, 4), 'year')
+
+
+class TestCommitRollupClaims(TestCase):
+
+    def setUp(self):
+        db = mongomock.MongoClient().db
+        self.commits = db.commits
+        self.rollups = db.rollups
+        self.rollups.create_index([
+            ('repository_id', ASCENDING),
+            ('period', ASCENDING),
+            ('authored.date', ASCENDING),
+            ('authored.name', ASCENDING),
+            ('authored.email', ASCENDING)
+        ], unique=True)
+        self.repo = Object(
+            _id=ObjectId(), app_config_id=ObjectId(), commit_cls=FakeCommit,
+            stats_rollup_id=ObjectId())
+        patcher = mock.patch(
+            'vulcanrepo.base.model.rollup.pymongo_db_collection',
+            self.db_collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def db_collection(self, cls):
+        if cls is FakeCommit:
+            return None, self.commits
+        return None, self.rollups
+
+    def add_commit(self, date=datetime(2020, 3, 4, 12), name='Alice',
+                   **fields):
+        doc = dict({
+            'repository_id': self.repo._id,
+            'authored': {'name': name, 'email': name.lower() + '@example.com',
+                         'date': date},
+            'line_stats': {'insertions': 2, 'deletions': 1}
+        }, **fields)
+        self.commits.insert_one(doc)
+        return doc
+
+    def rollup(self, period, name='Alice'):
+        return self.rollups.find_one(
+            {'period': period, 'authored.name': name})
+
+    def test_update_rolls_up_each_commit_once(self):
+        self.add_commit()
+        self.add_commit(name='Bob')
+        self.assertEqual(CommitRollup.update(self.repo), 2)
+        self.add_commit()
+        self.assertEqual(CommitRollup.update(self.repo), 1)
+        self.assertEqual(CommitRollup.update(self.repo), 0)
+        for period in ('day', 'week', 'month'):
+            alice = self.rollup(period)
+            self.assertEqual(alice['count'], 2)
+            self.assertEqual(alice['insertions'], 4)
+            self.assertEqual(alice['deletions'], 2)
+            self.assertEqual(alice['claims'], [])
+            self.assertEqual(self.rollup(period, 'Bob')['count'], 1)
+        self.assertEqual(
+            self.commits.find({'rolled_up': True}).count(), 3)
+
+    def test_claimed_commits_are_not_claimed_again(self):
+        self.add_commit()
+        query = {'rolled_up': {'$ne': True}, 'rollup_claim': None}
+        self.assertIsNotNone(CommitRollup._claim(self.repo, query))
+        self.assertIsNone(CommitRollup._claim(self.repo, query))
+
+    def test_interrupted_claim_is_not_counted_twice(self):
+        self.add_commit()
+        self.add_commit()
+        claim = CommitRollup._claim(
+            self.repo, {'rolled_up': {'$ne': True}, 'rollup_claim': None})
+        interrupting = InterruptingCollection(self.commits)
+        with mock.patch(
+                'vulcanrepo.base.model.rollup.pymongo_db_collection',
+                lambda cls: (None, interrupting) if cls is FakeCommit
+                else (None, self.rollups)):
+            with self.assertRaises(InterruptedFlag):
+                CommitRollup._roll(self.repo, claim)
+            self.assertEqual(self.rollup('day')['claims'], [claim])
+            CommitRollup._roll(self.repo, claim)
+        self.assertEqual(self.rollup('day')['count'], 2)
+        self.assertEqual(self.rollup('day')['claims'], [])
+
+    def test_update_finishes_stale_claims(self):
+        stale = ObjectId.from_datetime(datetime.utcnow() - timedelta(hours=1))
+        fresh = ObjectId()
+        self.add_commit(rollup_claim=stale)
+        self.add_commit(rollup_claim=fresh)
+        self.add_commit()
+        self.assertEqual(CommitRollup.update(self.repo), 2)
+        self.assertEqual(self.rollup('day')['count'], 2)
+        # the fresh claim is left to the update holding it
+        self.assertEqual(
+            self.commits.find({'rollup_claim': fresh}).count(), 1)
+
+    def test_tail_query(self):
+        other = Object(_id=ObjectId())
+        self.assertEqual(CommitRollup.tail_query([self.repo, other]), {
+            'repository_id': {'$in': [self.repo._id, other._id]},
+            'rolled_up': {'$ne': True}
+        })